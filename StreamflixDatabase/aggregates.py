@@ -0,0 +1,162 @@
+'''
+   Streamflix Database Aggregates
+   Script: aggregates.py
+   Description: Builds and incrementally maintains the per-title and per-user
+                review and viewing totals in Content_Stats and User_Stats.
+   Authors: Ashley Davis
+'''
+
+import argparse, os, sys, time
+
+# Source IDs folded into the aggregates per transaction
+REFRESH_BATCH_SIZE = int(os.getenv('STREAMFLIX_AGGREGATE_BATCH_SIZE', 1000000))
+
+CONTENT_REVIEWS = '''
+    INSERT INTO Content_Stats (content_id, review_count, star_total)
+    SELECT * FROM (
+        SELECT cr.content_id, COUNT(*) AS review_count, SUM(r.stars) AS star_total
+        FROM Review r
+        JOIN Content_Review cr ON r.review_id = cr.review_id
+        WHERE r.review_id > %s AND r.review_id <= %s
+        GROUP BY cr.content_id
+    ) AS delta
+    ON DUPLICATE KEY UPDATE
+        review_count = Content_Stats.review_count + delta.review_count,
+        star_total = Content_Stats.star_total + delta.star_total
+'''
+
+USER_REVIEWS = '''
+    INSERT INTO User_Stats (user_id, review_count, star_total)
+    SELECT * FROM (
+        SELECT r.user_id, COUNT(*) AS review_count, SUM(r.stars) AS star_total
+        FROM Review r
+        WHERE r.review_id > %s AND r.review_id <= %s AND r.user_id IS NOT NULL
+        GROUP BY r.user_id
+    ) AS delta
+    ON DUPLICATE KEY UPDATE
+        review_count = User_Stats.review_count + delta.review_count,
+        star_total = User_Stats.star_total + delta.star_total
+'''
+
+CONTENT_VIEWING = '''
+    INSERT INTO Content_Stats (content_id, watch_count, watch_seconds, completed_count)
+    SELECT * FROM (
+        SELECT um.content_id, COUNT(*) AS watch_count, SUM(um.duration) AS watch_seconds,
+               SUM(um.completed) AS completed_count
+        FROM User_Metrics um
+        WHERE um.metric_id > %s AND um.metric_id <= %s AND um.content_id IS NOT NULL
+        GROUP BY um.content_id
+    ) AS delta
+    ON DUPLICATE KEY UPDATE
+        watch_count = Content_Stats.watch_count + delta.watch_count,
+        watch_seconds = Content_Stats.watch_seconds + delta.watch_seconds,
+        completed_count = Content_Stats.completed_count + delta.completed_count
+'''
+
+USER_VIEWING = '''
+    INSERT INTO User_Stats (user_id, watch_count, watch_seconds, completed_count, last_watched)
+    SELECT * FROM (
+        SELECT um.user_id, COUNT(*) AS watch_count, SUM(um.duration) AS watch_seconds,
+               SUM(um.completed) AS completed_count, MAX(um.start_time) AS last_watched
+        FROM User_Metrics um
+        WHERE um.metric_id > %s AND um.metric_id <= %s AND um.user_id IS NOT NULL
+        GROUP BY um.user_id
+    ) AS delta
+    ON DUPLICATE KEY UPDATE
+        watch_count = User_Stats.watch_count + delta.watch_count,
+        watch_seconds = User_Stats.watch_seconds + delta.watch_seconds,
+        completed_count = User_Stats.completed_count + delta.completed_count,
+        last_watched = GREATEST(COALESCE(User_Stats.last_watched, delta.last_watched), delta.last_watched)
+'''
+
+# {source table: (ID column, statements folding an ID range into the
+# aggregates)}. The high-water mark of each source is its last folded ID
+SOURCES = {
+    'Review': ('review_id', (CONTENT_REVIEWS, USER_REVIEWS)),
+    'User_Metrics': ('metric_id', (CONTENT_VIEWING, USER_VIEWING)),
+}
+
+AGGREGATE_TABLES = ('Content_Stats', 'User_Stats')
+
+
+# Folds the rows of a source added since its high-water mark into the
+# aggregates, one batch of IDs per transaction. Each batch locks the mark,
+# so concurrent refreshes take turns instead of counting a batch twice.
+# Sources are append-only: rows updated or deleted after they have been
+# folded are not reflected, and a row must be committed before any row
+# with a higher ID, since the mark never goes back. Returns the first and
+# last ID folded, or None when there was nothing new
+def refresh_source(conn, cursor, source, batch_size=REFRESH_BATCH_SIZE):
+    id_column, statements = SOURCES[source]
+    cursor.execute('INSERT IGNORE INTO Aggregate_Watermark (source, last_id) VALUES (%s, 0)', (source,))
+    conn.commit()
+    cursor.execute(f'SELECT COALESCE(MAX({id_column}), 0) FROM {source}')
+    high = cursor.fetchone()[0]
+
+    first_id = None
+    while True:
+        cursor.execute('SELECT last_id FROM Aggregate_Watermark WHERE source = %s FOR UPDATE', (source,))
+        last_id = cursor.fetchone()[0]
+        if last_id >= high:
+            conn.commit()
+            break
+        # Batches start at the next ID present, so gaps in the IDs are skipped
+        cursor.execute(f'SELECT MIN({id_column}) FROM {source} WHERE {id_column} > %s', (last_id,))
+        upper = min(cursor.fetchone()[0] - 1 + batch_size, high)
+        for statement in statements:
+            cursor.execute(statement, (last_id, upper))
+        cursor.execute('UPDATE Aggregate_Watermark SET last_id = %s WHERE source = %s', (upper, source))
+        conn.commit()
+        if first_id is None:
+            first_id = last_id + 1
+    return None if first_id is None else (first_id, high)
+
+
+# Brings every aggregate up to date. Returns {source: (first, last ID)}
+# for the sources that had new rows
+def refresh_aggregates(conn, cursor, batch_size=REFRESH_BATCH_SIZE):
+    start = time.perf_counter()
+    folded = {}
+    for source in SOURCES:
+        ids = refresh_source(conn, cursor, source, batch_size)
+        if ids is not None:
+            folded[source] = ids
+            print(f"-->  Folded {source} rows {ids[0]} to {ids[1]} into the aggregates")
+    if not folded:
+        print("-->  Aggregates already up to date")
+    print(f"-->  Aggregates refreshed in {time.perf_counter() - start:.2f}s")
+    return folded
+
+
+# Rebuilds the aggregates from scratch: every title and user starts at
+# zero, and every source row is then folded in from ID 0
+def rebuild_aggregates(conn, cursor, batch_size=REFRESH_BATCH_SIZE):
+    for table in AGGREGATE_TABLES:
+        cursor.execute(f'TRUNCATE TABLE {table}')
+    cursor.execute('INSERT INTO Content_Stats (content_id) SELECT content_id FROM Video_Content')
+    cursor.execute('INSERT INTO User_Stats (user_id) SELECT user_id FROM User')
+    for source in SOURCES:
+        cursor.execute('REPLACE INTO Aggregate_Watermark (source, last_id) VALUES (%s, 0)', (source,))
+    conn.commit()
+    return refresh_aggregates(conn, cursor, batch_size)
+
+
+def main(argv=None):
+    # Imported here rather than at the top, as data_generation builds the
+    # aggregates with this module after generating the data
+    from data_generation import with_db_connection
+
+    parser = argparse.ArgumentParser(description='Maintains the Content_Stats and User_Stats aggregates.')
+    parser.add_argument('command', choices=('refresh', 'rebuild'),
+                        help="'refresh' folds in the rows added since the last refresh, "
+                             "'rebuild' recomputes everything")
+    parser.add_argument('--batch-size', type=int, default=REFRESH_BATCH_SIZE,
+                        help=f'source IDs folded in per transaction (default: {REFRESH_BATCH_SIZE})')
+    args = parser.parse_args(argv)
+
+    update = rebuild_aggregates if args.command == 'rebuild' else refresh_aggregates
+    return 0 if with_db_connection(update)(args.batch_size) is not None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+'''
+   Streamflix Database Benchmark
+   Script: benchmark.py
+   Description: Times the data generation stages at several scale factors and
+                compares their throughput with a stored baseline.
+   Authors: Ashley Davis
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from data_generation import parse_args, run_generation
+from datetime import datetime
+import multiprocessing
+import argparse, json, os, platform, resource, subprocess, sys, threading, time
+
+BENCHMARK_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+BASELINE_FILE = os.path.join(BENCHMARK_DIRECTORY, 'baseline.json')
+RESULTS_FILE = os.path.join(BENCHMARK_DIRECTORY, 'latest.json')
+DEFAULT_SCALES = (1, 5, 10)
+
+# Fraction of a stage's baseline rows/sec it may lose before it counts as
+# a regression
+DEFAULT_TOLERANCE = 0.2
+
+# MySQL server started by --container, published on CONTAINER_PORT
+CONTAINER_IMAGE = 'mysql:8.0'
+CONTAINER_NAME = 'streamflix-benchmark'
+CONTAINER_PORT = int(os.getenv('STREAMFLIX_BENCHMARK_PORT', 3307))
+CONTAINER_PASSWORD = 'streamflix-benchmark'
+CONTAINER_START_TIMEOUT = 180
+
+# Seconds between resident set size samples
+RSS_SAMPLE_SECONDS = 0.02
+
+
+# Resident set size of this process now, in MB, or None where /proc is not
+# available
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:
+        return None
+
+
+# Highest resident set size reached so far, in MB, by this process or any
+# worker process it has finished waiting for. Linux reports KB, macOS bytes
+def peak_rss_mb():
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+# Samples the resident set size of the generator process while stages run
+# and keeps the highest value seen during each one, so a stage isn't
+# charged with the peak of a stage before it. --workers processes are not
+# included. Without /proc, each stage gets the process peak reached by its
+# end, which only ever grows, and the results say so
+class StageRss:
+    def __init__(self):
+        self.per_stage = current_rss_mb() is not None
+        self.lock = threading.Lock()
+        self.running = {}
+        self.peaks = {}
+        self.stop = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        if self.per_stage:
+            self.sampler.start()
+
+    def sample(self):
+        while not self.stop.wait(RSS_SAMPLE_SECONDS):
+            self.observe()
+
+    def observe(self):
+        rss = current_rss_mb()
+        with self.lock:
+            for stage in self.running:
+                self.running[stage] = max(self.running[stage], rss)
+
+    def started(self, stage):
+        if self.per_stage:
+            with self.lock:
+                self.running[stage] = current_rss_mb()
+
+    def finished(self, stage):
+        if not self.per_stage:
+            self.peaks[stage] = peak_rss_mb()
+            return
+        self.observe()
+        with self.lock:
+            self.peaks[stage] = round(self.running.pop(stage), 1)
+
+    def close(self):
+        self.stop.set()
+
+
+# Runs the generator once at the given scale and returns its measurements.
+# Called in a fresh process per scale, so one run's memory doesn't carry
+# over into the next
+def run_scale(scale, generator_args):
+    args = parse_args([*generator_args, '--scale', str(scale)])
+    rss = StageRss()
+
+    def wrap_stage(stage, insert_data):
+        def measured():
+            rss.started(stage)
+            try:
+                return insert_data()
+            finally:
+                rss.finished(stage)
+        return measured
+
+    start = time.perf_counter()
+    try:
+        _, stage_stats, timings, phase_seconds = run_generation(args, wrap_stage)
+    finally:
+        rss.close()
+    seconds = time.perf_counter() - start
+
+    stages = {}
+    for stage, stats in stage_stats.items():
+        if stats is None:
+            stages[stage] = {'failed': True}
+            continue
+        stage_start, stage_end = timings[stage]
+        stage_seconds = stage_end - stage_start
+        stages[stage] = {
+            'seconds': round(stage_seconds, 3),
+            'rows': stats['rows'],
+            'rows_per_second': round(stats['rows'] / stage_seconds, 1) if stage_seconds else None,
+            'statements': stats['statements'],
+            'commits': stats['commits'],
+            'peak_rss_mb': rss.peaks[stage],
+        }
+    return {
+        'scale': scale,
+        'seconds': round(seconds, 3),
+        'peak_rss': 'per stage' if rss.per_stage else 'cumulative',
+        'phases': {phase: round(phase_seconds[phase], 3) for phase in phase_seconds},
+        'stages': stages,
+    }
+
+
+def run_benchmark(scales, generator_args):
+    runs = []
+    for scale in scales:
+        print(f"\n-->  Benchmarking scale {scale:g}")
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            runs.append(executor.submit(run_scale, scale, generator_args).result())
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'arguments': generator_args,
+        'runs': runs,
+    }
+
+
+def print_results(results):
+    for run in results['runs']:
+        phases = ', '.join(f"{phase} {seconds:.2f}s" for phase, seconds in run['phases'].items())
+        print(f"\n-->  Scale {run['scale']:g}: {run['seconds']:.2f}s ({phases}), "
+              f"peak RSS {run.get('peak_rss', 'cumulative')}")
+        for stage, stats in run['stages'].items():
+            if stats.get('failed'):
+                print(f"     {stage:<14} failed")
+                continue
+            print(f"     {stage:<14} {stats['seconds']:>8.2f}s {stats['rows_per_second'] or 0:>11.1f} rows/s "
+                  f"{stats['statements']:>8} statements {stats['commits']:>6} commits {stats['peak_rss_mb']:>8.1f} MB")
+
+
+# Compares each stage's rows/sec with the baseline run at the same scale.
+# Returns (scale, stage, baseline rows/sec, current rows/sec) for every
+# stage that fell by more than the tolerance, or failed
+def compare_with_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    if baseline['arguments'] != results['arguments']:
+        print(f"\n-->  Note: the baseline was recorded with {' '.join(baseline['arguments']) or 'no arguments'}")
+
+    baseline_runs = {run['scale']: run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        baseline_run = baseline_runs.get(run['scale'])
+        if baseline_run is None:
+            print(f"\n-->  No baseline at scale {run['scale']:g}")
+            continue
+
+        print(f"\n-->  Scale {run['scale']:g} against the baseline from {baseline['created']}")
+        for stage, stats in run['stages'].items():
+            expected = baseline_run['stages'].get(stage, {}).get('rows_per_second')
+            if not expected:
+                continue
+            current = stats.get('rows_per_second') or 0
+            change = current / expected - 1
+            regressed = change < -tolerance
+            if regressed:
+                regressions.append((run['scale'], stage, expected, current))
+            flag = '\033[31mREGRESSED\033[0m' if regressed else ''
+            print(f"     {stage:<14} {expected:>11.1f} -> {current:>11.1f} rows/s {change:>+8.1%}   {flag}")
+    return regressions
+
+
+def docker(*args, check=True):
+    return subprocess.run(['docker', *args], check=check, capture_output=True, text=True)
+
+
+# Starts a throwaway MySQL server in Docker and points the generator at it
+# through the MYSQL_ variables, which the per-scale processes inherit. The
+# server is ready once it accepts TCP connections: while it initializes its
+# data directory it only listens on its socket
+def start_container(image):
+    print(f"-->  Starting {image} as {CONTAINER_NAME} on port {CONTAINER_PORT}")
+    docker('run', '--detach', '--rm', '--name', CONTAINER_NAME, '--publish', f'{CONTAINER_PORT}:3306',
+           '--env', f'MYSQL_ROOT_PASSWORD={CONTAINER_PASSWORD}', image, '--local-infile=1')
+    deadline = time.monotonic() + CONTAINER_START_TIMEOUT
+    while docker('exec', CONTAINER_NAME, 'mysql', '--protocol=TCP', '-uroot', f'-p{CONTAINER_PASSWORD}',
+                 '-e', 'SELECT 1', check=False).returncode != 0:
+        if time.monotonic() >= deadline:
+            stop_container()
+            raise SystemExit(f"{CONTAINER_NAME} did not accept connections within {CONTAINER_START_TIMEOUT}s")
+        time.sleep(1)
+    os.environ.update({'MYSQL_HOST': '127.0.0.1', 'MYSQL_PORT': str(CONTAINER_PORT), 'MYSQL_USER': 'root',
+                       'MYSQL_PASSWORD': CONTAINER_PASSWORD})
+
+
+def stop_container():
+    docker('stop', CONTAINER_NAME, check=False)
+    print(f"-->  Stopped {CONTAINER_NAME}")
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as json_file:
+        json.dump(data, json_file, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the data generation stages against the MySQL server given by the MYSQL_ '
+                    'variables, or against a throwaway server in Docker with --container. Options not listed '
+                    'here, e.g. --loader infile, are passed on to data_generation.py.')
+    parser.add_argument('--scales', type=float, nargs='+', default=DEFAULT_SCALES,
+                        help=f"scale factors to run (default: {' '.join(map(str, DEFAULT_SCALES))})")
+    parser.add_argument('--output', default=RESULTS_FILE,
+                        help=f'where to write the results (default: {RESULTS_FILE})')
+    parser.add_argument('--baseline', default=BASELINE_FILE,
+                        help=f'results to compare against (default: {BASELINE_FILE})')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='fraction of baseline rows/sec a stage may lose before it fails '
+                             f'(default: {DEFAULT_TOLERANCE})')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='store these results as the new baseline')
+    parser.add_argument('--no-compare', action='store_true',
+                        help='only record the results; without it, a missing baseline is an error')
+    parser.add_argument('--container', nargs='?', const=CONTAINER_IMAGE, metavar='IMAGE',
+                        help=f'start a MySQL server in Docker for the run and stop it afterwards '
+                             f'(default image: {CONTAINER_IMAGE}, port: STREAMFLIX_BENCHMARK_PORT or {CONTAINER_PORT})')
+    args, generator_args = parser.parse_known_args(argv)
+
+    # Checked before anything runs, rather than after every scale has
+    compare = not (args.update_baseline or args.no_compare)
+    if compare and not os.path.exists(args.baseline):
+        print(f"-->  No baseline at {args.baseline}; run with --update-baseline to record one, "
+              f"or --no-compare to skip the comparison")
+        return 1
+
+    if args.container:
+        start_container(args.container)
+    try:
+        results = run_benchmark(args.scales, generator_args)
+    finally:
+        if args.container:
+            stop_container()
+    print_results(results)
+    write_json(args.output, results)
+    print(f"\n-->  Results written to {args.output}")
+
+    if args.update_baseline:
+        write_json(args.baseline, results)
+        print(f"-->  Baseline updated at {args.baseline}")
+        return 0
+    if not compare:
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        regressions = compare_with_baseline(results, json.load(baseline_file), args.tolerance)
+    if regressions:
+        print(f"\n-->  {len(regressions)} stage(s) regressed by more than {args.tolerance:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+'''
+   Streamflix Database Catalog Preparation
+   Script: catalog.py
+   Description: Parses the movie and series CSVs into normalized title and
+                bridge tables, cached on disk between runs.
+   Authors: Ashley Davis
+'''
+
+from collections import namedtuple
+import pandas as pd
+import hashlib, os
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+MOVIES_CSV = 'StreamflixDatabase/assets/imdb_top_1000_movies.csv'
+SERIES_CSV = 'StreamflixDatabase/assets/netflix_top_series.csv'
+# Next to this file, wherever the scripts are run from, so the cache
+# matches the .gitignore entry and is shared between runs
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'catalog_cache')
+
+# Bump when the preparation below changes, so older caches are not reused
+CATALOG_VERSION = 1
+
+# A prepared catalog: one row per title, plus (title, name) bridge tables
+# where title is the row position in titles
+Catalog = namedtuple('Catalog', ['titles', 'genres', 'directors', 'actors'])
+
+
+# Read the CSV data from the file into a DataFrame
+def csv_to_dataframe(file_path):
+    df = pd.read_csv(file_path)
+    df = df.dropna()
+    return df
+
+
+# Builds a (title, name) bridge table from a Series of names, or lists of
+# names, indexed by title position, keeping the order of the source
+def bridge_table(names):
+    bridge = names.explode().str.strip().rename('name').rename_axis('title').reset_index()
+    return bridge[bridge['name'].notna() & (bridge['name'] != '')].reset_index(drop=True)
+
+
+def prepare_movies(file_path=MOVIES_CSV):
+    movies = csv_to_dataframe(file_path).reset_index(drop=True)
+
+    titles = pd.DataFrame({
+        'title': movies['Series_Title'],
+        'description': movies['Overview'],
+        'release_year': movies['Released_Year'].astype(str).str[:4],
+        'duration': movies['Runtime'].str.replace(' min', '', regex=False).astype(int),
+    })
+    stars = movies[['Star1', 'Star2', 'Star3', 'Star4']]
+
+    return Catalog(
+        titles=titles,
+        genres=bridge_table(movies['Genre'].str.split(',')),
+        directors=bridge_table(movies['Director']),
+        actors=bridge_table(pd.Series(stars.to_numpy().tolist(), index=stars.index)),
+    )
+
+
+def prepare_series(file_path=SERIES_CSV):
+    series = csv_to_dataframe(file_path)
+    series = series[series['type'] == 'TV Show'].reset_index(drop=True)
+
+    titles = pd.DataFrame({
+        'title': series['title'],
+        'description': series['description'],
+        'release_year': series['release_year'].astype(int).astype(str),
+        'country': series['country'],
+    })
+    genres = series['listed_in'].str.split(', ').explode()
+    genres = genres.str.replace(r'\b(TV|Series|Shows)\b', '', case=False, regex=True)
+
+    return Catalog(
+        titles=titles,
+        genres=bridge_table(genres),
+        directors=bridge_table(series['director']),
+        actors=bridge_table(series['cast'].str.split(', ')),
+    )
+
+
+def file_digest(file_path):
+    digest = hashlib.sha256(f'catalog-v{CATALOG_VERSION}'.encode())
+    with open(file_path, 'rb') as source:
+        for block in iter(lambda: source.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+# Returns the prepared catalog for a source CSV. The prepared tables are
+# stored as uncompressed Arrow files named after the CSV's hash, so later
+# runs memory-map them instead of parsing the CSV again. Without pyarrow
+# the CSV is parsed on every call
+def load_catalog(prepare, file_path):
+    if feather is None:
+        return prepare(file_path)
+
+    cache_path = os.path.join(CACHE_DIRECTORY, f'{prepare.__name__}-{file_digest(file_path)}')
+    if os.path.isdir(cache_path):
+        return Catalog(*(feather.read_table(os.path.join(cache_path, f'{table}.arrow'), memory_map=True).to_pandas()
+                         for table in Catalog._fields))
+
+    catalog = prepare(file_path)
+    os.makedirs(cache_path + '.tmp', exist_ok=True)
+    for table, frame in zip(Catalog._fields, catalog):
+        feather.write_feather(frame, os.path.join(cache_path + '.tmp', f'{table}.arrow'), compression='uncompressed')
+    os.replace(cache_path + '.tmp', cache_path)
+    return catalog
+
+
+def load_movie_catalog():
+    return load_catalog(prepare_movies, MOVIES_CSV)
+
+
+def load_series_catalog():
+    return load_catalog(prepare_series, SERIES_CSV)
+
+
+# Groups a bridge table into {title position: [names]}
+def names_by_title(bridge):
+    return bridge.groupby('title', sort=False)['name'].agg(list).to_dict()
@@ -0,0 +1,415 @@
+'''
+   Streamflix Database Catalog Queries
+   Script: catalog_queries.py
+   Description: Read-side lookups over the Streamflix schema, run as server-side
+                prepared statements with an in-process result cache.
+   Authors: Ashley Davis
+'''
+
+import data_generation
+from data_generation import POOL_TIMEOUT, get_pooled_connection
+from instrumentation import InstrumentedConnection
+from collections import OrderedDict, namedtuple
+import mysql.connector
+import argparse, os, sys, threading, time, weakref
+
+# Results kept by the cache before the least recently used are evicted
+CACHE_SIZE = int(os.getenv('STREAMFLIX_CATALOG_CACHE_SIZE', 4096))
+
+# Seconds a cached result is served for. The catalog only changes when it
+# is loaded, while lists and watch history change as users act
+CATALOG_TTL = float(os.getenv('STREAMFLIX_CATALOG_TTL', 300))
+USER_TTL = float(os.getenv('STREAMFLIX_USER_TTL', 15))
+
+# Seconds rankings and user totals read from the aggregate tables are
+# cached. aggregates.py refreshes those tables in batches
+STATS_TTL = float(os.getenv('STREAMFLIX_STATS_TTL', 60))
+
+# A lookup: its statement, the tables it reads, which decide what an
+# invalidation drops, and how long its results are cached
+CatalogQuery = namedtuple('CatalogQuery', ['statement', 'tables', 'ttl'])
+
+QUERIES = {
+    'content_by_genre': CatalogQuery('''
+        SELECT vc.content_id, vc.title, vc.release_year, vc.language
+        FROM Genre g
+        JOIN Content_Genre cg ON g.genre_id = cg.genre_id
+        JOIN Video_Content vc ON cg.content_id = vc.content_id
+        WHERE g.name = %s
+        ORDER BY vc.title
+        LIMIT %s
+    ''', ('Genre', 'Content_Genre', 'Video_Content'), CATALOG_TTL),
+    'titles_by_actor': CatalogQuery('''
+        SELECT vc.content_id, vc.title, vc.release_year
+        FROM Actor a
+        JOIN Content_Actor ca ON a.actor_id = ca.actor_id
+        JOIN Video_Content vc ON ca.content_id = vc.content_id
+        WHERE a.name = %s
+        ORDER BY vc.title
+    ''', ('Actor', 'Content_Actor', 'Video_Content'), CATALOG_TTL),
+    'titles_by_director': CatalogQuery('''
+        SELECT vc.content_id, vc.title, vc.release_year
+        FROM Director d
+        JOIN Content_Director cd ON d.director_id = cd.director_id
+        JOIN Video_Content vc ON cd.content_id = vc.content_id
+        WHERE d.name = %s
+        ORDER BY vc.title
+    ''', ('Director', 'Content_Director', 'Video_Content'), CATALOG_TTL),
+    'series_episodes': CatalogQuery('''
+        SELECT se.season_id, e.episode_id, e.title, e.duration
+        FROM Series s
+        JOIN Season se ON s.series_id = se.series_id
+        JOIN Episode e ON se.season_id = e.season_id
+        WHERE s.content_id = %s
+        ORDER BY se.season_id, e.episode_id
+    ''', ('Series', 'Season', 'Episode'), CATALOG_TTL),
+    'similar_titles': CatalogQuery('''
+        SELECT vc.content_id, vc.title, vc.release_year, sc.score
+        FROM Similar_Content sc
+        JOIN Video_Content vc ON sc.similar_content_id = vc.content_id
+        WHERE sc.content_id = %s
+        ORDER BY sc.similar_rank
+        LIMIT %s
+    ''', ('Similar_Content', 'Video_Content'), CATALOG_TTL),
+    # Ranked keyword search through the FULLTEXT index, with optional genre
+    # and content type filters; search.py falls back to its own index on
+    # databases without one
+    'search_titles': CatalogQuery('''
+        SELECT vc.content_id, vc.title, vc.release_year,
+               CASE WHEN m.content_id IS NOT NULL THEN 'Movie'
+                    WHEN s.content_id IS NOT NULL THEN 'Series' END AS content_type,
+               MATCH(vc.title, vc.description) AGAINST (%s IN NATURAL LANGUAGE MODE) AS relevance
+        FROM Video_Content vc
+        LEFT JOIN Movie m ON vc.content_id = m.content_id
+        LEFT JOIN Series s ON vc.content_id = s.content_id
+        WHERE MATCH(vc.title, vc.description) AGAINST (%s IN NATURAL LANGUAGE MODE)
+          AND (%s IS NULL OR EXISTS (SELECT 1
+                                     FROM Content_Genre cg
+                                     JOIN Genre g ON cg.genre_id = g.genre_id
+                                     WHERE cg.content_id = vc.content_id AND g.name = %s))
+          AND (%s IS NULL OR %s = CASE WHEN m.content_id IS NOT NULL THEN 'Movie'
+                                       WHEN s.content_id IS NOT NULL THEN 'Series' END)
+        ORDER BY relevance DESC, vc.content_id
+        LIMIT %s
+    ''', ('Video_Content', 'Movie', 'Series', 'Content_Genre', 'Genre'), CATALOG_TTL),
+    'my_list': CatalogQuery('''
+        SELECT ml.mylist_id, ml.name AS list_name, vc.content_id, vc.title, lc.added_at
+        FROM My_List ml
+        JOIN Listed_Content lc ON ml.mylist_id = lc.mylist_id
+        JOIN Video_Content vc ON lc.content_id = vc.content_id
+        WHERE ml.user_id = %s
+        ORDER BY ml.mylist_id, lc.added_at
+    ''', ('My_List', 'Listed_Content', 'Video_Content'), USER_TTL),
+    'watch_history': CatalogQuery('''
+        SELECT um.metric_id, um.start_time, um.duration, um.completed, vc.content_id, vc.title
+        FROM User_Metrics um
+        JOIN Video_Content vc ON um.content_id = vc.content_id
+        WHERE um.user_id = %s
+        ORDER BY um.start_time DESC
+        LIMIT %s
+    ''', ('User_Metrics', 'Video_Content'), USER_TTL),
+    'top_rated': CatalogQuery('''
+        SELECT vc.content_id, vc.title, cs.review_count, cs.star_total / cs.review_count AS average_stars
+        FROM Content_Stats cs
+        JOIN Video_Content vc ON cs.content_id = vc.content_id
+        WHERE cs.review_count >= %s
+        ORDER BY average_stars DESC, cs.review_count DESC
+        LIMIT %s
+    ''', ('Content_Stats', 'Video_Content'), STATS_TTL),
+    'most_watched': CatalogQuery('''
+        SELECT vc.content_id, vc.title, cs.watch_count, cs.watch_seconds,
+               cs.completed_count / cs.watch_count AS completion_rate
+        FROM Content_Stats cs
+        JOIN Video_Content vc ON cs.content_id = vc.content_id
+        WHERE cs.watch_count > 0
+        ORDER BY cs.watch_count DESC
+        LIMIT %s
+    ''', ('Content_Stats', 'Video_Content'), STATS_TTL),
+    'user_stats': CatalogQuery('''
+        SELECT review_count, star_total / NULLIF(review_count, 0) AS average_stars_given,
+               watch_count, watch_seconds, completed_count / NULLIF(watch_count, 0) AS completion_rate,
+               last_watched
+        FROM User_Stats
+        WHERE user_id = %s
+    ''', ('User_Stats',), STATS_TTL),
+}
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'expired', 'evictions', 'maxsize', 'currsize'])
+
+
+# Size-bounded LRU cache whose entries also expire after their TTL. Each
+# entry remembers the tables it was read from, so a write to a table can
+# drop just the results that depend on it
+class ResultCache:
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.expired = self.evictions = 0
+        # Bumped by every invalidation, so a result read before one is not
+        # cached after it
+        self.version = 0
+
+    # Returns (True, value) for a live entry, and (False, None) otherwise
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, _, value = entry
+                if time.monotonic() < expires_at:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self.entries[key]
+                self.expired += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, ttl, tables, version):
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries[key] = (time.monotonic() + ttl, frozenset(tables), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.version += 1
+            self.entries.pop(key, None)
+
+    # Drops every entry read from any of the tables, or everything when no
+    # tables are given. Returns the number of entries dropped
+    def invalidate(self, *tables):
+        with self.lock:
+            self.version += 1
+            if not tables:
+                dropped = len(self.entries)
+                self.entries.clear()
+                return dropped
+            tables = set(tables)
+            stale = [key for key, (_, read_from, _) in self.entries.items() if read_from & tables]
+            for key in stale:
+                del self.entries[key]
+            return len(stale)
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.expired, self.evictions, self.maxsize, len(self.entries))
+
+
+# A connection held by one thread for as long as the thread runs, with
+# a prepared cursor per lookup. Prepared statements belong to a session, and
+# the pool resets sessions when connections are returned, so the connection
+# is not handed back between lookups
+class PreparedSession:
+    def __init__(self):
+        conn = get_pooled_connection()
+        if data_generation.statement_stats is not None:
+            conn = InstrumentedConnection(conn, data_generation.statement_stats)
+        self.conn = conn
+        self.cursors = {}
+        self.row_types = {}
+
+    # The first execute of a cursor prepares its statement on the server;
+    # later ones only send the parameters
+    def execute(self, name, params):
+        cursor = self.cursors.get(name)
+        if cursor is None:
+            cursor = self.cursors[name] = self.conn.cursor(prepared=True)
+        cursor.execute(QUERIES[name].statement, params)
+        row_type = self.row_types.get(name)
+        if row_type is None:
+            row_type = self.row_types[name] = namedtuple(name, cursor.column_names)
+        rows = tuple(row_type(*row) for row in cursor.fetchall())
+        # Ends the read's transaction, so the next lookup sees new commits
+        self.conn.commit()
+        return rows
+
+    def close(self):
+        try:
+            for cursor in self.cursors.values():
+                cursor.close()
+        finally:
+            self.conn.close()
+
+
+# A thread's session, kept in its thread-local storage. The holder goes
+# away with the thread, and its finalizer hands the session's connection
+# back to the pool
+class ThreadSession:
+    __slots__ = ('session', '__weakref__')
+
+    def __init__(self, session):
+        self.session = session
+
+
+# Catalog and user lookups. Results are cached by lookup and parameters,
+# and returned as tuples of named tuples, so cached results can be shared
+# between callers. Safe to use from several threads, each of which gets
+# its own session for as long as it runs
+class CatalogQueries:
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache = ResultCache(cache_size)
+        self.local = threading.local()
+        self.sessions = set()
+        self.sessions_lock = threading.Lock()
+
+    def session(self):
+        holder = getattr(self.local, 'holder', None)
+        if holder is None:
+            session = PreparedSession()
+            holder = self.local.holder = ThreadSession(session)
+            with self.sessions_lock:
+                self.sessions.add(session)
+            weakref.finalize(holder, self.release_session, session)
+        return holder.session
+
+    # Closes a session and returns its connection to the pool, once
+    def release_session(self, session):
+        with self.sessions_lock:
+            if session not in self.sessions:
+                return
+            self.sessions.remove(session)
+        try:
+            session.close()
+        except mysql.connector.Error:
+            pass
+
+    def drop_session(self):
+        holder = getattr(self.local, 'holder', None)
+        if holder is None:
+            return
+        self.local.holder = None
+        self.release_session(holder.session)
+
+    # Serves a lookup from the cache, or runs it and caches the result. A
+    # failed lookup returns None and is not cached, and its session is
+    # replaced, since its prepared statements may not have survived. Every
+    # thread with a session holds a pooled connection, so running out of
+    # them is raised rather than reported as a failed lookup
+    def run(self, name, *params):
+        key = (name, params)
+        hit, rows = self.cache.get(key)
+        if hit:
+            return rows
+        version = self.cache.version
+        try:
+            rows = self.session().execute(name, params)
+        except mysql.connector.errors.PoolError as err:
+            raise RuntimeError(f"No pooled connection was free for {name} after {POOL_TIMEOUT:g}s; each thread "
+                               f"running lookups holds one, so the pool needs at least as many connections "
+                               f"as there are threads") from err
+        except mysql.connector.Error as err:
+            print(f"Database Error: {err}")
+            self.drop_session()
+            return None
+        query = QUERIES[name]
+        self.cache.put(key, rows, query.ttl, query.tables, version)
+        return rows
+
+    def content_by_genre(self, genre, limit=100):
+        return self.run('content_by_genre', genre, limit)
+
+    def titles_by_actor(self, name):
+        return self.run('titles_by_actor', name)
+
+    def titles_by_director(self, name):
+        return self.run('titles_by_director', name)
+
+    # Episodes of a series, by the series' content_id, in season order
+    def series_episodes(self, content_id):
+        return self.run('series_episodes', content_id)
+
+    # "More like this": the titles similarity.py ranked closest to a title
+    def similar_titles(self, content_id, limit=10):
+        return self.run('similar_titles', content_id, limit)
+
+    def my_list(self, user_id):
+        return self.run('my_list', user_id)
+
+    # A user's most recent viewing sessions, newest first
+    def watch_history(self, user_id, limit=50):
+        return self.run('watch_history', user_id, limit)
+
+    # Titles by average stars, among those with at least min_reviews reviews
+    def top_rated(self, limit=20, min_reviews=5):
+        return self.run('top_rated', min_reviews, limit)
+
+    def most_watched(self, limit=20):
+        return self.run('most_watched', limit)
+
+    def user_stats(self, user_id):
+        return self.run('user_stats', user_id)
+
+    # Invalidation hooks for code that writes to the database: drop the
+    # results read from the given tables, or everything without tables
+    def invalidate(self, *tables):
+        return self.cache.invalidate(*tables)
+
+    # Drops one cached result, e.g. a user's list after they change it
+    def invalidate_lookup(self, name, *params):
+        self.cache.discard((name, params))
+
+    def cache_info(self):
+        return self.cache.info()
+
+    def close(self):
+        with self.sessions_lock:
+            sessions, self.sessions = self.sessions, set()
+        for session in sessions:
+            session.close()
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+LOOKUPS = {
+    'genre': ('content_by_genre', str),
+    'actor': ('titles_by_actor', str),
+    'director': ('titles_by_director', str),
+    'series': ('series_episodes', int),
+    'similar': ('similar_titles', int),
+    'my-list': ('my_list', int),
+    'history': ('watch_history', int),
+    'top-rated': ('top_rated', int),
+    'most-watched': ('most_watched', int),
+    'user-stats': ('user_stats', int),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs a catalog lookup against the Streamflix database.')
+    parser.add_argument('lookup', choices=LOOKUPS)
+    parser.add_argument('value', help='genre, actor, or director name, series or title content_id, user_id, '
+                                      'or number of titles to rank')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='run the lookup this many times, to compare cached and uncached latency')
+    args = parser.parse_args(argv)
+
+    name, value_type = LOOKUPS[args.lookup]
+    with CatalogQueries() as queries:
+        for attempt in range(args.repeat):
+            start = time.perf_counter()
+            rows = getattr(queries, name)(value_type(args.value))
+            elapsed = time.perf_counter() - start
+            if rows is None:
+                return 1
+            if attempt == 0:
+                for row in rows:
+                    print('     ' + ', '.join(f'{field}={value}' for field, value in row._asdict().items()))
+            print(f"-->  {len(rows)} rows in {elapsed * 1000:.3f}ms")
+        print(f"-->  {queries.cache_info()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,33 +6,175 @@
 '''
 
 from faker import Faker
-from functools import wraps
+from functools import lru_cache, partial, wraps
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 import mysql.connector
+from mysql.connector import errorcode, pooling
 from dotenv import load_dotenv
-import random, os, re
+from catalog import csv_to_dataframe, load_movie_catalog, load_series_catalog, names_by_title
+from schema import (SCHEMA_FILE, SCHEMA_MODES, defer_constraints, foreign_key_columns, foreign_keys, orphan_query,
+                    read_schema)
+from stage_scheduler import print_schedule_report, run_stages, stage_dependencies
+from instrumentation import InstrumentedConnection, StatementStats, print_statement_report, write_prometheus
+from aggregates import rebuild_aggregates
+from partitions import FUTURE_MONTHS, add_months, month_start, partition_table
+from rollups import rebuild_rollups
+from sqlite_backend import SQLitePool
+import argparse, json, random, os, tempfile, threading, time
 
-fake = Faker()
 load_dotenv()
 
+
+# Forwards attribute access to an instance created separately for each
+# thread, so stages running concurrently never share random state
+class ThreadLocalInstance:
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        instance = getattr(self._local, 'instance', None)
+        if instance is None:
+            instance = self._local.instance = self._factory()
+        return getattr(instance, name)
+
+
+fake = ThreadLocalInstance(Faker)
+rand = ThreadLocalInstance(random.Random)
+
+DATABASE_NAME = 'Streamflix'
+
+# Size of the process-wide connection pool, and how long a caller waits
+# for a free connection before giving up
+POOL_SIZE = int(os.getenv('MYSQL_POOL_SIZE', 5))
+POOL_TIMEOUT = float(os.getenv('MYSQL_POOL_TIMEOUT', 30))
+
+# Database the tools connect to: 'mysql' for the server given by the
+# MYSQL_ variables, or 'sqlite' for an embedded database at SQLITE_PATH,
+# which ':memory:' keeps in this process only
+BACKENDS = ('mysql', 'sqlite')
+BACKEND = os.getenv('STREAMFLIX_BACKEND', 'mysql')
+SQLITE_PATH = os.getenv('STREAMFLIX_SQLITE_PATH', ':memory:')
+
+connection_pool = None
+pool_lock = threading.Lock()
+
+# The connection held by the outermost with_db_connection call on each thread
+active_connection = threading.local()
+
+
+def configure_pool(size):
+    global POOL_SIZE
+    if connection_pool is not None and size != POOL_SIZE:
+        raise RuntimeError("The connection pool has already been created")
+    POOL_SIZE = size
+
+
+def configure_backend(backend, sqlite_path=None):
+    global BACKEND, SQLITE_PATH
+    sqlite_path = sqlite_path or SQLITE_PATH
+    if connection_pool is not None and (backend, sqlite_path) != (BACKEND, SQLITE_PATH):
+        raise RuntimeError("The connection pool has already been created")
+    BACKEND, SQLITE_PATH = backend, sqlite_path
+
+
+# Creates the connection pool on first use. The check for the Streamflix
+# database only runs here, and its result is stored in the pool
+# configuration, so pooled connections start with the database selected
+def get_connection_pool():
+    global connection_pool
+    with pool_lock:
+        if connection_pool is None and BACKEND == 'sqlite':
+            connection_pool = SQLitePool(SQLITE_PATH, POOL_TIMEOUT)
+        elif connection_pool is None:
+            connection_pool = pooling.MySQLConnectionPool(
+                pool_name='streamflix',
+                pool_size=POOL_SIZE,
+                host=os.getenv('MYSQL_HOST'),
+                port=os.getenv('MYSQL_PORT'),
+                user=os.getenv('MYSQL_USER'),
+                password=os.getenv('MYSQL_PASSWORD'), 
+                allow_local_infile=True,
+            )
+            conn = connection_pool.get_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(f"SHOW DATABASES LIKE '{DATABASE_NAME}';")
+                exists = cursor.fetchone() is not None
+                cursor.close()
+            finally:
+                conn.close()
+            if exists:
+                connection_pool.set_config(database=DATABASE_NAME)
+    return connection_pool
+
+
+# Names the database the pool connects to, for caches of data read from
+# it: the server and schema, or the SQLite file. None for an in-memory
+# database, which no other process can see
+def database_identity():
+    if BACKEND == 'sqlite':
+        return None if SQLITE_PATH == ':memory:' else f'sqlite:{os.path.abspath(SQLITE_PATH)}'
+    return f"mysql://{os.getenv('MYSQL_HOST')}:{os.getenv('MYSQL_PORT')}/{DATABASE_NAME}"
+
+
+# Selects the database on the given connection and on every pooled
+# connection handed out afterwards
+def select_database(cursor):
+    cursor.execute(f"USE `{DATABASE_NAME}`;")
+    get_connection_pool().set_config(database=DATABASE_NAME)
+
+
+# Statement statistics gathered from every connection while instrumentation
+# is on, or None when it is off
+statement_stats = None
+
+
+def configure_instrumentation(enabled):
+    global statement_stats
+    statement_stats = StatementStats() if enabled else None
+    return statement_stats
+
+
+# Checks a connection out of the pool, waiting up to POOL_TIMEOUT seconds
+# when every connection is in use. The pool pings the connection on
+# checkout and reconnects it if the server closed it
+def get_pooled_connection():
+    pool = get_connection_pool()
+    deadline = time.monotonic() + POOL_TIMEOUT
+    while True:
+        try:
+            return pool.get_connection()
+        except mysql.connector.errors.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
 # Decorator to ensure database connection stays open and
-# only rolls back when error occurs
+# only rolls back when error occurs. Connections come from a shared pool,
+# and a decorated function called from inside another one runs on the
+# caller's connection and transaction instead of checking out its own
 def with_db_connection(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        conn = mysql.connector.connect(
-            host=os.getenv('MYSQL_HOST'),
-            port=os.getenv('MYSQL_PORT'),
-            user=os.getenv('MYSQL_USER'),
-            password=os.getenv('MYSQL_PASSWORD'), 
-        )
+        conn = getattr(active_connection, 'conn', None)
+        if conn is not None:
+            cursor = conn.cursor()
+            try:
+                return func(conn, cursor, *args, **kwargs)
+            finally:
+                cursor.close()
+
+        conn = get_pooled_connection()
+        if statement_stats is not None:
+            conn = InstrumentedConnection(conn, statement_stats)
         cursor = conn.cursor()
-        
-        cursor.execute("SHOW DATABASES LIKE 'Streamflix';")
-        result = cursor.fetchone()
-        if result:
-            conn.database = 'Streamflix'
+        active_connection.conn = conn
 
         try:
             result = func(conn, cursor, *args, **kwargs)
@@ -42,33 +184,25 @@ def with_db_connection(func):
             conn.rollback()
             result = None
         finally:
+            active_connection.conn = None
             if conn.is_connected():
                 cursor.close()
-                conn.close()
+            conn.close()
         return result
     return wrapper
 
 
-# Read the CSV data from the file into a DataFrame
-def csv_to_dataframe(file_path):
-    df = pd.read_csv(file_path)
-    df = df.dropna()
-    return df
-
-
-# Initializes a database at the given file path
+# Initializes a database from the given schema script
 @with_db_connection
-def initialize_database(conn, cursor):
+def initialize_database(conn, cursor, schema):
     cursor.execute("SHOW DATABASES LIKE 'Streamflix';")
     result = cursor.fetchone()
     
     if result:
         cursor.execute("DROP DATABASE IF EXISTS `Streamflix`;")
     cursor.execute("CREATE DATABASE `Streamflix`;")
-    conn.database = 'Streamflix'
+    select_database(cursor)
     
-    with open('StreamflixDatabase/streamflix-db.sql', 'r') as sql_file:
-        schema = sql_file.read()
     for result in cursor.execute(schema, multi=True):
         try:
             if result.with_rows:
@@ -79,445 +213,1350 @@ def initialize_database(conn, cursor):
             return
         
     print("-->  Database schema initialized")
-    
 
-# Function to execute batch insertions 
+
+# Post-load phase of the bulk schema mode. Reports the rows whose foreign
+# keys match no referenced row, then adds the deferred indexes and foreign
+# keys. Checks stay off for the ALTERs, so InnoDB builds each index in place
+# from the loaded rows instead of copying the table to revalidate them.
+# Returns {(table, column): orphaned rows}
 @with_db_connection
-def batch_insertion(conn, cursor, insertion_format, data):
-    try:
-        cursor.executemany(insertion_format, data)
-    except mysql.connector.Error as err:
-            print(f"Error processing SQL script: {err}")
-            conn.rollback()
-            return
+def apply_deferred_constraints(conn, cursor, schema, deferred):
+    start = time.perf_counter()
+    orphans = {}
+    for table, column, parent, parent_column in foreign_key_columns(schema):
+        cursor.execute(orphan_query(table, column, parent, parent_column))
+        count = cursor.fetchone()[0]
+        if count:
+            orphans[(table, column)] = count
+            print(f"-->  {count} {table} rows reference a missing {parent}.{parent_column} ({column})")
+    if not orphans:
+        print("-->  Foreign keys validated, no orphaned rows")
+
+    cursor.execute('SET SESSION foreign_key_checks = 0')
+    for statement in deferred.values():
+        cursor.execute(statement)
+    cursor.execute('SET SESSION foreign_key_checks = 1')
+    cursor.execute('''
+        REPLACE INTO Generation_Checkpoint (stage, next_chunk, id_marks, rows_written, commits, finished)
+        VALUES ('deferred_constraints', 0, '{}', 0, 0, TRUE)
+    ''')
+    print(f"-->  Indexes and foreign keys added in {time.perf_counter() - start:.2f}s")
+    return orphans
+
+
+# Builds Content_Stats and User_Stats from all of the generated rows
+@with_db_connection
+def build_aggregates(conn, cursor):
+    return rebuild_aggregates(conn, cursor)
 
 
+# Builds the daily rollups of every generated session
 @with_db_connection
-def insert_user_data(conn, cursor):
+def build_rollups(conn, cursor):
+    return rebuild_rollups(conn, cursor)
+
+
+# Partitions User_Metrics by month, from the month of the earliest session
+# the run generates to FUTURE_MONTHS past the reference time. SQLite has no
+# partitioning, so the table is left whole there
+@with_db_connection
+def partition_user_metrics(conn, cursor):
+    if BACKEND == 'sqlite':
+        return []
+    first_month = month_start(reference_time - timedelta(days=365))
+    return partition_table(conn, cursor, first_month, add_months(month_start(reference_time), FUTURE_MONTHS))
+
+
+# Columns of every generated table, listed in foreign key order so parent
+# rows are always written before the rows that reference them. For tables
+# with a surrogate key, the ID column comes first
+TABLE_COLUMNS = {
+    'User': ('user_id', 'username', 'password', 'name', 'email', 'phone', 'date_of_birth', 'subscription_plan', 'date_joined'),
+    'Profile': ('profile_id', 'name', 'user_id'),
+    'Device': ('device_id', 'ip_address', 'user_id'),
+    'Video_Content': ('content_id', 'title', 'thumbnail', 'country', 'description', 'release_year', 'language'),
+    'Movie': ('movie_id', 'duration', 'content_id'),
+    'Series': ('series_id', 'content_id'),
+    'Season': ('season_id', 'series_id'),
+    'Episode': ('episode_id', 'title', 'duration', 'season_id'),
+    'Genre': ('genre_id', 'name'),
+    'Actor': ('actor_id', 'name', 'date_of_birth', 'gender', 'biography', 'content_id'),
+    'Director': ('director_id', 'name', 'date_of_birth', 'biography', 'content_id'),
+    'Content_Genre': ('content_id', 'genre_id'),
+    'Content_Actor': ('content_id', 'actor_id'),
+    'Content_Director': ('content_id', 'director_id'),
+    'Review': ('review_id', 'review_content', 'stars', 'user_id', 'date_posted'),
+    'Content_Review': ('content_id', 'review_id'),
+    'My_List': ('mylist_id', 'name', 'user_id'),
+    'Listed_Content': ('content_id', 'mylist_id', 'added_at'),
+    'User_Metrics': ('metric_id', 'start_time', 'end_time', 'duration', 'completed', 'content_id', 'user_id'),
+}
+
+LOADER_MODES = ('bulk', 'infile', 'row')
+
+# Server and client errors raised when LOAD DATA LOCAL INFILE is disabled
+LOCAL_INFILE_DISABLED_ERRORS = {
+    errorcode.ER_CLIENT_LOCAL_FILES_DISABLED,
+    errorcode.ER_NOT_ALLOWED_COMMAND,
+    errorcode.CR_LOAD_DATA_LOCAL_INFILE_REJECTED,
+}
+
+# The server's reason once it has refused LOAD DATA LOCAL INFILE. It holds
+# for the rest of the run, so every later loader, in any stage or worker,
+# goes straight to batch inserts, and the fallback is reported once
+local_infile_refused = None
+local_infile_lock = threading.Lock()
+
+
+def refuse_local_infile(reason):
+    global local_infile_refused
+    with local_infile_lock:
+        if local_infile_refused is not None:
+            return
+        local_infile_refused = reason
+    print(f"-->  LOAD DATA LOCAL INFILE unavailable ({reason}), using batch inserts for the rest of the run")
+
+# Commit policies: 'row' commits after every row, 'every:N' after every N
+# rows, and 'stage' runs each stage in a single transaction
+DEFAULT_COMMIT_POLICY = os.getenv('STREAMFLIX_COMMIT_POLICY', 'stage')
+
+# Number of buffered rows at which a loader flushes, which bounds the
+# memory a stage uses regardless of how many rows it generates
+CHUNK_SIZE = int(os.getenv('STREAMFLIX_CHUNK_SIZE', 50000))
+
+# Row volumes at --scale 1. Reviews are drawn per title and lists per user,
+# so those are upper bounds for a single title or user
+BASE_VOLUMES = {
+    'users': 100,
+    'user_metrics': 800,
+    'reviews_per_title': 30,
+    'lists_per_user': 3,
+}
+
+# Upper bound on rows per executemany call, keeping each multi-row
+# INSERT statement well below max_allowed_packet
+FLUSH_BATCH_SIZE = 5000
+
+
+TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+
+
+def tsv_field(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return str(value).translate(TSV_ESCAPES)
+
+
+# In-memory column buffer for the generated rows of one table
+class TableBuffer:
+    def __init__(self, table):
+        self.table = table
+        self.columns = {column: [] for column in TABLE_COLUMNS[table]}
+
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+
+    def append(self, row):
+        for values, value in zip(self.columns.values(), row):
+            values.append(value)
+
+    def extend(self, columns):
+        for values, column in zip(self.columns.values(), columns):
+            values.extend(column)
+
+    def rows(self):
+        return list(zip(*self.columns.values()))
+
+    def clear(self):
+        for values in self.columns.values():
+            values.clear()
+
+    # Streams the buffered rows to a TSV file using the default LOAD DATA
+    # escaping, with \N for NULL
+    def write_tsv(self, tsv_file):
+        for row in zip(*self.columns.values()):
+            tsv_file.write('\t'.join(map(tsv_field, row)) + '\n')
+
+    def load_data_statement(self):
+        return f'''
+            LOAD DATA LOCAL INFILE %s INTO TABLE {self.table}
+            CHARACTER SET utf8mb4
+            FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'
+            LINES TERMINATED BY '\\n'
+            ({', '.join(self.columns)})
+        '''
+
+    def insert_statement(self):
+        placeholders = ', '.join(['%s'] * len(self.columns))
+        return f'''
+            INSERT INTO {self.table} ({', '.join(self.columns)})
+            VALUES ({placeholders})
+        '''
+
+
+# Decides when a stage commits the rows it has written so far, and counts
+# the commits it makes
+class CommitPolicy:
+    def __init__(self, spec='stage'):
+        self.spec = spec
+        kind, _, rows = spec.partition(':')
+        if spec == 'stage':
+            self.every = None
+        elif spec == 'row':
+            self.every = 1
+        elif kind == 'every' and rows.isdigit() and int(rows) > 0:
+            self.every = int(rows)
+        else:
+            raise ValueError(f"Unknown commit policy: {spec} (expected 'row', 'every:N', or 'stage')")
+        self.uncommitted = 0
+        self.commits = 0
+
+    # Largest batch that can be written without overshooting the next commit
+    @property
+    def batch_size(self):
+        return min(FLUSH_BATCH_SIZE, self.every or FLUSH_BATCH_SIZE)
+
+    def rows_written(self, conn, count):
+        self.uncommitted += count
+        if self.every and self.uncommitted >= self.every:
+            self.commit(conn)
+
+    def commit(self, conn):
+        conn.commit()
+        self.commits += 1
+        self.uncommitted = 0
+
+    def finish(self, conn):
+        if self.uncommitted:
+            self.commit(conn)
+
+
+# Tables without a surrogate key, with the column that ties each row to a
+# table whose IDs the same stage assigns
+OWNED_ROWS = {
+    'Content_Genre': ('content_id', 'Video_Content'),
+    'Content_Actor': ('content_id', 'Video_Content'),
+    'Content_Director': ('content_id', 'Video_Content'),
+    'Content_Review': ('review_id', 'Review'),
+    'Listed_Content': ('mylist_id', 'My_List'),
+}
+
+
+# Returns {table: highest ID} for the given tables that have a surrogate key
+def id_marks(cursor, tables):
+    marks = {}
+    for table in TABLE_COLUMNS:
+        if table in tables and table not in OWNED_ROWS:
+            id_column = TABLE_COLUMNS[table][0]
+            cursor.execute(f'SELECT COALESCE(MAX({id_column}), 0) FROM {table}')
+            marks[table] = cursor.fetchone()[0]
+    return marks
+
+
+# Deletes the rows of the given tables written after the marks were taken,
+# children before their parents
+def delete_past_marks(cursor, tables, marks):
+    for table in reversed(TABLE_COLUMNS):
+        if table in tables:
+            column, owner = OWNED_ROWS.get(table, (TABLE_COLUMNS[table][0], table))
+            cursor.execute(f'DELETE FROM {table} WHERE {column} > %s', (marks[owner],))
+
+
+# Collects the rows of a generation stage and writes them to the database.
+# Primary keys are assigned here rather than read back from cursor.lastrowid,
+# so child rows can be built before their parents are written. In 'bulk'
+# mode every table is flushed once, in foreign key order, with executemany.
+# 'infile' mode writes each table to a temporary TSV file and ingests it with
+# LOAD DATA LOCAL INFILE, falling back to executemany when the server does
+# not allow local infile. In 'row' mode each row is inserted as soon as it
+# is added. Buffers are flushed whenever they hold chunk_size rows, so only
+# one chunk of a stage is in memory at a time. When the stage commits is up
+# to its CommitPolicy
+class BulkLoader:
+    def __init__(self, conn, cursor, mode='bulk', commit_policy=DEFAULT_COMMIT_POLICY, chunk_size=CHUNK_SIZE,
+                 deferred_checks=False, checkpoint_commits=False):
+        if mode not in LOADER_MODES:
+            raise ValueError(f"Unknown loader mode: {mode}")
+        # The bulk schema mode validates the foreign keys after the load,
+        # so the session skips the per-row checks while loading
+        if deferred_checks:
+            cursor.execute('SET SESSION foreign_key_checks = 0, unique_checks = 0')
+        self.conn = conn
+        self.cursor = cursor
+        self.mode = mode
+        self.commit_policy = CommitPolicy(commit_policy)
+        self.checkpoint_commits = checkpoint_commits
+        self.rows_written = 0
+        self.chunk_size = chunk_size
+        self.buffered = 0
+        self.buffers = {table: TableBuffer(table) for table in TABLE_COLUMNS}
+        self.last_ids = {}
+        self.local_infile = mode == 'infile'
+        self.stage = None
+        self.next_chunk = 0
+        self.statements_at_start = self.session_statements()
+
+    # Statements the server has received on this session so far
+    def session_statements(self):
+        self.cursor.execute("SHOW SESSION STATUS LIKE 'Questions'")
+        return int(self.cursor.fetchone()[1])
+
+    # Returns the next primary key for the table, continuing from the
+    # highest ID already stored in the database
+    def next_id(self, table):
+        if table not in self.last_ids:
+            id_column = TABLE_COLUMNS[table][0]
+            self.cursor.execute(f'SELECT COALESCE(MAX({id_column}), 0) FROM {table}')
+            self.last_ids[table] = self.cursor.fetchone()[0]
+        self.last_ids[table] += 1
+        return self.last_ids[table]
+
+    # Adds a row to a table without a surrogate key (e.g. a bridge table)
+    def append(self, table, row):
+        self.buffers[table].append(row)
+        self.buffered += 1
+        if self.mode == 'row':
+            self.flush_table(table)
+        elif self.buffered >= self.chunk_size:
+            self.flush()
+
+    # Adds a row to a table with a surrogate key and returns the assigned ID
+    def insert(self, table, row):
+        row_id = self.next_id(table)
+        self.append(table, (row_id, *row))
+        return row_id
+
+    # Adds whole columns of rows to a table without a surrogate key
+    def append_columns(self, table, columns):
+        if self.mode == 'row':
+            for row in zip(*columns):
+                self.append(table, row)
+            return
+        self.buffers[table].extend(columns)
+        self.buffered += len(columns[0])
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    # Adds whole columns of rows to a table with a surrogate key, assigning
+    # them a contiguous block of IDs, and returns the IDs
+    def insert_columns(self, table, columns):
+        ids = self.reserve_ids(table, len(columns[0]))
+        self.append_columns(table, (ids, *columns))
+        return ids
+
+    # Reserves a contiguous block of IDs for rows written outside the loader
+    def reserve_ids(self, table, count):
+        if not count:
+            return range(0)
+        first_id = self.next_id(table)
+        self.last_ids[table] += count - 1
+        return range(first_id, first_id + count)
+
+    def flush_table(self, table):
+        buffer = self.buffers[table]
+        if not len(buffer):
+            return
+        self.buffered -= len(buffer)
+        if self.local_infile and local_infile_refused is None and self.load_data(buffer):
+            self.written(len(buffer))
+            buffer.clear()
+            return
+        statement = buffer.insert_statement()
+        rows = buffer.rows()
+        batch_size = self.commit_policy.batch_size
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            self.cursor.executemany(statement, batch)
+            self.written(len(batch))
+        buffer.clear()
+
+    def written(self, count):
+        self.rows_written += count
+        self.commit_policy.rows_written(self.conn, count)
+
+    # Returns False when the server rejects LOAD DATA LOCAL INFILE, in which
+    # case local infile is not attempted again during the run
+    def load_data(self, buffer):
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='',
+                                         prefix=f'{buffer.table}_', suffix='.tsv', delete=False) as tsv_file:
+            buffer.write_tsv(tsv_file)
+        try:
+            self.cursor.execute(buffer.load_data_statement(), (tsv_file.name,))
+        except mysql.connector.Error as err:
+            if err.errno not in LOCAL_INFILE_DISABLED_ERRORS:
+                raise
+            refuse_local_infile(err.msg)
+            return False
+        finally:
+            os.remove(tsv_file.name)
+        return True
+
+    # Every buffered child row has its parent either already written or in
+    # the same flush, so writing tables in foreign key order is always safe
+    def flush(self):
+        for table in TABLE_COLUMNS:
+            self.flush_table(table)
+
+    # Writes the remaining rows, commits them, and returns the stage totals
+    def finish(self):
+        self.flush()
+        if self.stage is None:
+            self.commit_policy.finish(self.conn)
+        else:
+            self.save_checkpoint(finished=True)
+            self.commit_policy.commit(self.conn)
+        statements = self.session_statements() - self.statements_at_start - 1
+        commit_policy = self.commit_policy.spec
+        if self.checkpoint_commits:
+            commit_policy += ', and every chunk'
+        return {'rows': self.rows_written, 'commits': self.commit_policy.commits,
+                'statements': statements, 'commit_policy': commit_policy}
+
+    # Starts recording the stage's progress in Generation_Checkpoint, or
+    # picks it up from an earlier run. A checkpoint is written after every
+    # chunk and becomes durable with the stage's next commit, so rows can be
+    # committed past the last durable checkpoint, and those are deleted
+    # using the ID high-water marks stored with it. Totals continue from
+    # the checkpoint: the commits it stores are those made before it was
+    # written, and the commit that made it durable is added here. Returns
+    # the first chunk still to be generated
+    def resume(self, stage):
+        self.stage = stage
+        self.cursor.execute('SELECT next_chunk, id_marks, rows_written, commits FROM Generation_Checkpoint '
+                            'WHERE stage = %s', (stage,))
+        checkpoint = self.cursor.fetchone()
+        if checkpoint is None:
+            self.save_checkpoint()
+            if self.checkpoint_commits:
+                self.commit_policy.commit(self.conn)
+            return 0
+
+        self.next_chunk, marks, self.rows_written, commits = checkpoint
+        self.commit_policy.commits = commits + 1
+        delete_past_marks(self.cursor, STAGE_TABLES[stage], json.loads(marks))
+        if self.next_chunk:
+            print(f"-->  Resuming {stage} from chunk {self.next_chunk}")
+        return self.next_chunk
+
+    # Writes the rows of every chunk up to and including chunk, and a
+    # checkpoint that records them. The checkpoint is committed with the
+    # rows when the commit policy next commits, or right away with
+    # checkpoint_commits, so a failed stage resumes from its last chunk
+    # rather than from its last commit
+    def checkpoint(self, chunk):
+        self.flush()
+        self.next_chunk = chunk + 1
+        self.save_checkpoint()
+        if self.checkpoint_commits:
+            self.commit_policy.commit(self.conn)
+
+    def save_checkpoint(self, finished=False):
+        marks = id_marks(self.cursor, STAGE_TABLES[self.stage])
+        self.cursor.execute('''
+            REPLACE INTO Generation_Checkpoint (stage, next_chunk, id_marks, rows_written, commits, finished)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        ''', (self.stage, self.next_chunk, json.dumps(marks), self.rows_written,
+              self.commit_policy.commits, finished))
+
+
+# Rows are synthesized in chunks of GENERATION_CHUNK_SIZE IDs. Each chunk
+# gets its own random and Faker state, derived from the generation seed,
+# the stage, and the chunk index. Chunk boundaries don't depend on the
+# number of workers, so a seed always produces the same rows
+GENERATION_CHUNK_SIZE = 10000
+
+# Seeded runs are anchored to a fixed date unless --as-of is given, since
+# Faker's relative dates ('-1y', 'now') would differ from day to day
+SEEDED_REFERENCE_TIME = datetime(2024, 9, 18)
+
+generation_seed = random.SystemRandom().getrandbits(32)
+reference_time = datetime.now()
+
+
+# Sets the seed and reference time for this process. Also used as the
+# initializer of worker processes
+def configure_generation(seed=None, as_of=None):
+    global generation_seed, reference_time
+    if seed is not None:
+        generation_seed = seed
+    if as_of is not None:
+        reference_time = as_of
+
+
+def seed_chunk(stage, index):
+    chunk_seed = random.Random(f'{generation_seed}:{stage}:{index}').getrandbits(64)
+    rand.seed(chunk_seed)
+    fake.seed_instance(chunk_seed)
+
+
+def run_generation_task(task):
+    stage, index, generate_chunk, ids, params = task
+    seed_chunk(stage, index)
+    return generate_chunk(ids, **params)
+
+
+# NumPy generator for a chunk, seeded from the chunk's random state
+def chunk_rng():
+    return np.random.default_rng(rand.getrandbits(64))
+
+
+# Returns the IDs at the given positions of a range or list of IDs
+def ids_at(ids, positions):
+    if isinstance(ids, range):
+        return ids.start + positions
+    return np.asarray(ids)[positions]
+
+
+# Draws size IDs uniformly, with replacement
+def draw_ids(rng, ids, size):
+    return ids_at(ids, rng.integers(0, len(ids), size))
+
+
+# Draws counts[i] distinct positions out of population_size for every i,
+# returned as one flat array grouped by i. Candidates are drawn with
+# replacement and any group that repeats a position is drawn again
+def sample_positions(rng, population_size, counts):
+    width = int(counts.max(initial=0))
+    if width > population_size:
+        raise ValueError("Sample larger than population")
+    used = np.arange(width) < counts[:, None]
+    positions = rng.integers(0, population_size, (len(counts), width))
+    while True:
+        # Unused slots get distinct negative values so they never collide
+        keyed = np.where(used, positions, -1 - np.arange(width))
+        keyed.sort(axis=1)
+        repeated = (keyed[:, 1:] == keyed[:, :-1]).any(axis=1)
+        if not repeated.any():
+            return positions[used]
+        positions[repeated] = rng.integers(0, population_size, (int(repeated.sum()), width))
+
+
+# Splits ids into chunks and yields the rows generated for each chunk, in
+# chunk order, starting at first_chunk. With more than one worker the chunks are generated in a
+# process pool, keeping at most two chunks per worker in flight so memory
+# stays bounded while the caller writes the results
+def generate_in_chunks(stage, generate_chunk, ids, workers=1, first_chunk=0, **params):
+    starts = range(first_chunk * GENERATION_CHUNK_SIZE, len(ids), GENERATION_CHUNK_SIZE)
+    tasks = ((stage, index, generate_chunk, ids[start:start + GENERATION_CHUNK_SIZE], params)
+             for index, start in enumerate(starts, first_chunk))
+    if workers <= 1:
+        yield from map(run_generation_task, tasks)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=configure_generation,
+                             initargs=(generation_seed, reference_time)) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(run_generation_task, task))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Returns the primary keys of a table. Generated keys are contiguous, in
+# which case they are returned as a range so they can be sampled without
+# loading millions of IDs into memory
+def table_ids(cursor, table):
+    id_column = TABLE_COLUMNS[table][0]
+    cursor.execute(f'SELECT MIN({id_column}), MAX({id_column}), COUNT(*) FROM {table}')
+    low, high, count = cursor.fetchone()
+    if count and high - low + 1 == count:
+        return range(low, high + 1)
+    cursor.execute(f'SELECT {id_column} FROM {table}')
+    return [row[0] for row in cursor.fetchall()]
+
+
+# Faker's date_of_birth() is relative to today, so birth dates are drawn
+# relative to the reference time instead to keep seeded output reproducible
+def date_of_birth():
+    today = reference_time.date()
+    return fake.date_between(start_date=today - timedelta(days=115 * 365), end_date=today)
+
+
+# Faker's passport_gender() draws from the shared random module, so the same
+# weighting is drawn from this thread's generator instead
+def passport_gender():
+    return rand.choices(['M', 'F', 'X'], weights=[0.493, 0.493, 0.014])[0]
+
+
+# Returns one (user, profiles, devices) group per position in the chunk.
+# IDs are assigned by the loader when the groups are written
+def generate_user_rows(positions):
     subscription_options = ['Family', 'Student', 'Regular']
-    user_data = []
-    profile_data = []
-    device_data = []
+    users = []
     
-    for i in range(100):
+    for i in positions:
         username = fake.user_name()
         password = fake.password()
         name = fake.name()
         email = fake.email()
         phone = fake.basic_phone_number().strip("()-+")
-        date_of_birth = fake.date_of_birth()
-        subscription_plan = subscription_options[random.randint(0, 2)]
+        subscription_plan = subscription_options[rand.randint(0, 2)]
         
-        user_data.append((i, username, password, name, email, phone, date_of_birth, subscription_plan))
-        
-        profile_data.extend(generate_profile_data(i))
-        device_data.extend(generate_device_data(i))
-
-    # Batch insert for User, Profile, and Device tables
-    batch_insertion('''INSERT INTO User (user_id, username, password, name, email, phone, date_of_birth, subscription_plan)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)''', user_data)
+        user = (username, password, name, email, phone, date_of_birth(), subscription_plan, reference_time)
+        users.append((user, list(generate_profile_data()), list(generate_device_data())))
+    return users
 
-    batch_insertion('''INSERT INTO Profile (name, user_id)
-                            VALUES (%s, %s)''', profile_data)
 
-    batch_insertion('''INSERT INTO Device (ip_address, user_id)
-                            VALUES (%s, %s)''', device_data)
+@with_db_connection
+def insert_user_data(conn, cursor, users=BASE_VOLUMES['users'], workers=1, **loader_options):
+    loader = BulkLoader(conn, cursor, **loader_options)
+    first_chunk = loader.resume('users')
+    
+    chunks = generate_in_chunks('users', generate_user_rows, range(users), workers, first_chunk)
+    for index, chunk in enumerate(chunks, first_chunk):
+        for user, profiles, devices in chunk:
+            user_id = loader.insert('User', user)
+            for name in profiles:
+                loader.insert('Profile', (name, user_id))
+            for ip_address in devices:
+                loader.insert('Device', (ip_address, user_id))
+        loader.checkpoint(index)
+
+    stats = loader.finish()
             
     print("-->  User, Profile, and Device Data Generated and Populated")
+    return stats
 
 
-def generate_profile_data(user_id):
-    profile_data = []
-    num_profiles = random.randint(1, 4)
+def generate_profile_data():
+    num_profiles = rand.randint(1, 4)
     for _ in range(num_profiles):
-        name = fake.name()
-        profile_data.append((name, user_id))
-    return profile_data
+        yield fake.name()
  
 
-def generate_device_data(user_id):
-    device_data = []
-    num_devices = random.randint(1, 3)
+def generate_device_data():
+    num_devices = rand.randint(1, 3)
     for _ in range(num_devices):
-        ip_address = fake.ipv4()
-        device_data.append((ip_address, user_id))
-    return device_data
+        yield fake.ipv4()
+
+
+# In-process name -> ID cache for the Genre, Actor, and Director tables.
+# Existing names are loaded with a single query, and new names are given
+# IDs by the loader and written with the rest of the stage's rows
+class EntityCache:
+    def __init__(self, loader, table):
+        self.loader = loader
+        self.table = table
+        self.ids = {}
+
+        id_column = TABLE_COLUMNS[table][0]
+        loader.cursor.execute(f'SELECT {id_column}, name FROM {table}')
+        for entity_id, name in loader.cursor.fetchall():
+            self.ids.setdefault(self._key(name), entity_id)
+
+    # Mirrors the column collation, which ignores case and trailing spaces
+    @staticmethod
+    def _key(name):
+        return name.rstrip().lower()
+
+    # Returns the ID for the given name, adding a new row when it is unseen.
+    # make_attributes is only called for new names, so Faker data is not
+    # generated for entities that already exist
+    def resolve(self, name, make_attributes=None):
+        key = self._key(name)
+        entity_id = self.ids.get(key)
+        if entity_id is None:
+            attributes = make_attributes() if make_attributes else ()
+            entity_id = self.loader.insert(self.table, (name, *attributes))
+            self.ids[key] = entity_id
+        return entity_id
+
+
+def load_entity_caches(loader):
+    return EntityCache(loader, 'Genre'), EntityCache(loader, 'Director'), EntityCache(loader, 'Actor')
+
+
+def new_director_attributes(content_id):
+    return lambda: (date_of_birth(), fake.paragraph(), content_id)
+
+
+def new_actor_attributes(content_id):
+    return lambda: (date_of_birth(), passport_gender(), fake.paragraph(), content_id)
+
+
+# Adds one bridge row per distinct ID, keeping the original order
+def append_bridge_rows(loader, table, content_id, ids):
+    for related_id in dict.fromkeys(ids):
+        loader.append(table, (content_id, related_id))
 
 
 @with_db_connection
-def insert_movie_genre_actor_director_data(conn, cursor):
-    movies = csv_to_dataframe('StreamflixDatabase/assets/imdb_top_1000_movies.csv')
+def insert_movie_genre_actor_director_data(conn, cursor, **loader_options):
+    stage = 'movies'
+    movies = load_movie_catalog()
+    genres, directors, actors = (names_by_title(bridge) for bridge in movies[1:])
+    loader = BulkLoader(conn, cursor, **loader_options)
+    loader.resume(stage)
+    genre_cache, director_cache, actor_cache = load_entity_caches(loader)
+    seed_chunk(stage, 0)
     
-    for i, row in movies.iterrows():
-        title = row['Series_Title']
-        description = row['Overview']
-        duration = int(row['Runtime'].replace(' min', ''))
+    for i, movie in enumerate(movies.titles.itertuples(index=False)):
         country = fake.country()
-        release_year = row['Released_Year'][:4]
         thumbnail = fake.pystr(max_chars=10)
         language = fake.language_name()
-        genres = row['Genre']
-        director_name = row['Director']
-        actors = [row['Star1'], row['Star2'], row['Star3'], row['Star4']]
-        
-        if isinstance(genres, str):
-            genres = [genre.strip() for genre in genres.split(',')] 
 
-        cursor.execute('''
-            INSERT INTO Video_Content (title, thumbnail, country, description, release_year, language)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        ''', (title, thumbnail, country, description, release_year, language))
-        
-        conn.commit()
-        content_id = cursor.lastrowid
+        content_id = loader.insert('Video_Content', (movie.title, thumbnail, country, movie.description, movie.release_year, language))
+        loader.insert('Movie', (movie.duration, content_id))
 
-        cursor.execute('''
-            INSERT INTO Movie (duration, content_id)
-            VALUES (%s, %s)
-        ''', (duration, content_id))
+        genre_ids = [genre_cache.resolve(genre_name) for genre_name in genres.get(i, [])]
+        append_bridge_rows(loader, 'Content_Genre', content_id, genre_ids)
         
-        conn.commit()
-        movie_id = cursor.lastrowid
+        director_ids = [director_cache.resolve(director_name, new_director_attributes(content_id))
+                        for director_name in directors.get(i, [])]
+        append_bridge_rows(loader, 'Content_Director', content_id, director_ids)
 
-        processed_genres = set()
+        actor_ids = [actor_cache.resolve(actor_name, new_actor_attributes(content_id))
+                     for actor_name in actors.get(i, [])]
+        append_bridge_rows(loader, 'Content_Actor', content_id, actor_ids)
 
-        for genre_name in genres:
-            if genre_name not in processed_genres:
-                processed_genres.add(genre_name)
-            
-                cursor.execute('''
-                    SELECT genre_id FROM Genre WHERE name = %s
-                ''', (genre_name,))
-                result = cursor.fetchone()
-
-                if result:
-                    genre_id = result[0]
-                else:
-                    cursor.execute('''
-                        INSERT INTO Genre (name)
-                        VALUES (%s)
-                    ''', (genre_name,))
-                    conn.commit()
-                    genre_id = cursor.lastrowid
-
-                cursor.execute('''
-                    INSERT INTO Content_Genre (content_id, genre_id)
-                    VALUES (%s, %s)
-                ''', (movie_id, genre_id))
-                conn.commit()
-        
-        if pd.notna(director_name):
-            cursor.execute('''
-                SELECT director_id FROM Director WHERE name = %s
-            ''', (director_name,))
-            result = cursor.fetchone()
-
-            if result:
-                director_id = result[0]
-            else:
-                cursor.execute('''
-                    INSERT INTO Director (name, date_of_birth, biography, content_id)
-                    VALUES (%s, %s, %s, %s)
-                ''', (director_name, fake.date_of_birth(), fake.paragraph(), content_id))
-                conn.commit()
-                director_id = cursor.lastrowid
-            
-            cursor.execute('''
-                SELECT 1 FROM Content_Director WHERE content_id = %s AND director_id = %s
-            ''', (movie_id, director_id))
-            if cursor.fetchone() is None:
-                cursor.execute('''
-                    INSERT INTO Content_Director (content_id, director_id)
-                    VALUES (%s, %s)
-                ''', (movie_id, director_id))
-                conn.commit()
-
-        processed_actors = set()
-        for actor_name in actors:
-            if pd.notna(actor_name) and actor_name not in processed_actors:
-                processed_actors.add(actor_name)
-                cursor.execute('''
-                    SELECT actor_id FROM Actor WHERE name = %s
-                ''', (actor_name,))
-                result = cursor.fetchone()
-
-                if result:
-                    actor_id = result[0]
-                else:
-                    cursor.execute('''
-                        INSERT INTO Actor (name, date_of_birth, gender, biography, content_id)
-                        VALUES (%s, %s, %s, %s, %s)
-                    ''', (actor_name, fake.date_of_birth(), fake.passport_gender(), fake.paragraph(), content_id))
-                    conn.commit()
-                    actor_id = cursor.lastrowid
-
-                cursor.execute('''
-                    SELECT 1 FROM Content_Actor WHERE content_id = %s AND actor_id = %s
-                ''', (movie_id, actor_id))
-                if cursor.fetchone() is None:
-                    cursor.execute('''
-                        INSERT INTO Content_Actor (content_id, actor_id)
-                        VALUES (%s, %s)
-                    ''', (movie_id, actor_id))
-                    conn.commit()
+    stats = loader.finish()
 
     print("-->  Movie, Genre, Actor, and Director Data Generated and Populated")
+    return stats
     
 
 @with_db_connection
-def insert_series_data(conn, cursor):
-    series_df = csv_to_dataframe('StreamflixDatabase/assets/netflix_top_series.csv')
-    series_df = series_df[series_df['type'] == 'TV Show']
+def insert_series_data(conn, cursor, ingest='client', **loader_options):
+    stage = 'series'
+    series = load_series_catalog()
+    loader = BulkLoader(conn, cursor, **loader_options)
+    loader.resume(stage)
+    seed_chunk(stage, 0)
+
+    if ingest == 'staging':
+        for series_id in ingest_series_staged(loader, series):
+            total_episodes = rand.randint(1, 50) 
+            insert_season_data(loader, series_id, total_episodes)
+        stats = loader.finish()
+
+        print("-->  Series, Season, and Episode Data Generated and Populated")
+        return stats
+
+    genres, directors, actors = (names_by_title(bridge) for bridge in series[1:])
+    genre_cache, director_cache, actor_cache = load_entity_caches(loader)
     
-    for i, row in series_df.iterrows():
-        title = row['title']
-        description = row['description']
-        release_year = str(int(row['release_year']))
-        country = row['country']
+    for i, show in enumerate(series.titles.itertuples(index=False)):
         language = fake.language_name()
-        genres = row['listed_in'].split(', ')
-        director_name = row['director']
-        actors = row['cast'].split(', ')
-
-        cursor.execute('''
-            INSERT INTO Video_Content (title, thumbnail, country, description, release_year, language)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        ''', (title, fake.pystr(max_chars=10), country, description, release_year, language))
-        conn.commit()
 
-        content_id = cursor.lastrowid
-
-        cursor.execute('''
-            INSERT INTO Series (content_id)
-            VALUES (%s)
-        ''', (content_id,))
-        conn.commit()
-
-        series_id = cursor.lastrowid
-        pattern = re.compile(r'\b(TV|Series|Shows)\b', re.IGNORECASE)
+        content_id = loader.insert('Video_Content', (show.title, fake.pystr(max_chars=10), show.country, show.description, show.release_year, language))
+        series_id = loader.insert('Series', (content_id,))
         
-        for genre in genres:
-            cleaned_genre = pattern.sub('', genre).strip()
-            cursor.execute('SELECT genre_id FROM Genre WHERE name = %s', (cleaned_genre,))
-            genre_row = cursor.fetchone()
-            
-            if cleaned_genre:
-                if genre_row:
-                    genre_id = genre_row[0]
-                else:
-                    cursor.execute('INSERT INTO Genre (name) VALUES (%s)', (cleaned_genre,))
-                    conn.commit()
-                    genre_id = cursor.lastrowid
-                
-                cursor.execute('''
-                    INSERT INTO Content_Genre (content_id, genre_id)
-                    VALUES (%s, %s)
-                ''', (content_id, genre_id))
-                conn.commit()
+        genre_ids = [genre_cache.resolve(genre) for genre in genres.get(i, [])]
+        append_bridge_rows(loader, 'Content_Genre', content_id, genre_ids)
             
-            # Insert Director
-            if pd.notna(director_name):
-                cursor.execute('SELECT director_id FROM Director WHERE name = %s', (director_name,))
-                director_row = cursor.fetchone()
-
-                if director_row:
-                    director_id = director_row[0]
-                else:
-                    cursor.execute('''
-                        INSERT INTO Director (name, date_of_birth, biography, content_id)
-                        VALUES (%s, %s, %s, %s)
-                    ''', (director_name, fake.date_of_birth(), fake.paragraph(), content_id))
-                    conn.commit()
-                    director_id = cursor.lastrowid
-
-                # Check for existing Content_Director entry
-                cursor.execute('''
-                    SELECT 1 FROM Content_Director WHERE content_id = %s AND director_id = %s
-                ''', (content_id, director_id))
-                if not cursor.fetchone():
-                    cursor.execute('''
-                        INSERT INTO Content_Director (content_id, director_id)
-                        VALUES (%s, %s)
-                    ''', (content_id, director_id))
-                    conn.commit()
-
-            # Insert Actors
-            processed_actors = set()
-            for actor_name in actors:
-                if pd.notna(actor_name) and actor_name not in processed_actors:
-                    processed_actors.add(actor_name)
-                    
-                    cursor.execute('SELECT actor_id FROM Actor WHERE name = %s', (actor_name,))
-                    actor_row = cursor.fetchone()
-
-                    if actor_row:
-                        actor_id = actor_row[0]
-                    else:
-                        cursor.execute('''
-                            INSERT INTO Actor (name, date_of_birth, gender, biography, content_id)
-                            VALUES (%s, %s, %s, %s, %s)
-                        ''', (actor_name, fake.date_of_birth(), fake.passport_gender(), fake.paragraph(), content_id))
-                        conn.commit()
-                        actor_id = cursor.lastrowid
-
-                    # Check for existing Content_Actor entry
-                    cursor.execute('''
-                        SELECT 1 FROM Content_Actor WHERE content_id = %s AND actor_id = %s
-                    ''', (content_id, actor_id))
-                    if not cursor.fetchone():
-                        cursor.execute('''
-                            INSERT INTO Content_Actor (content_id, actor_id)
-                            VALUES (%s, %s)
-                        ''', (content_id, actor_id))
-                        conn.commit()
-
-        total_episodes = random.randint(1, 50) 
-        insert_season_data(conn, cursor, series_id, total_episodes)
-        
+        # Insert Director
+        director_ids = [director_cache.resolve(director_name, new_director_attributes(content_id))
+                        for director_name in directors.get(i, [])]
+        append_bridge_rows(loader, 'Content_Director', content_id, director_ids)
+
+        # Insert Actors
+        actor_ids = [actor_cache.resolve(actor_name, new_actor_attributes(content_id))
+                     for actor_name in actors.get(i, [])]
+        append_bridge_rows(loader, 'Content_Actor', content_id, actor_ids)
+
+        total_episodes = rand.randint(1, 50) 
+        insert_season_data(loader, series_id, total_episodes)
+    
+    stats = loader.finish()
+
     print("-->  Series, Season, and Episode Data Generated and Populated")
+    return stats
+    
     
+SERIES_INGEST_MODES = ('client', 'staging')
+
+SERIES_STAGING_TABLES = '''
+    CREATE TEMPORARY TABLE Series_Staging (
+        content_id INT PRIMARY KEY,
+        series_id INT NOT NULL,
+        title VARCHAR(300) NOT NULL,
+        thumbnail VARCHAR(10),
+        country VARCHAR(100),
+        description LONGTEXT,
+        release_year VARCHAR(4),
+        language VARCHAR(100)
+    );
+    CREATE TEMPORARY TABLE Credit_Staging (
+        credit_id INT AUTO_INCREMENT PRIMARY KEY,
+        kind ENUM('genre', 'director', 'actor') NOT NULL,
+        content_id INT NOT NULL,
+        name VARCHAR(150) NOT NULL,
+        INDEX (kind, name)
+    );
+    CREATE TEMPORARY TABLE Person_Staging (
+        kind ENUM('director', 'actor') NOT NULL,
+        name VARCHAR(150) NOT NULL,
+        date_of_birth DATE NOT NULL,
+        gender VARCHAR(10),
+        biography LONGTEXT,
+        PRIMARY KEY (kind, name)
+    );
+'''
+
+# Adds every credited name of one kind that is not in the entity table yet,
+# in order of first appearance, crediting it to the first title it is in
+NEW_ENTITY_INSERTS = {
+    'genre': '''
+        INSERT INTO Genre (name)
+        SELECT credit.name
+        FROM (SELECT name, MIN(credit_id) AS first_credit
+              FROM Credit_Staging WHERE kind = 'genre' GROUP BY name) AS credit
+        WHERE NOT EXISTS (SELECT 1 FROM Genre g WHERE g.name = credit.name)
+        ORDER BY credit.first_credit
+    ''',
+    'director': '''
+        INSERT INTO Director (name, date_of_birth, biography, content_id)
+        SELECT credit.name, p.date_of_birth, p.biography, credit.content_id
+        FROM (SELECT name, MIN(content_id) AS content_id, MIN(credit_id) AS first_credit
+              FROM Credit_Staging WHERE kind = 'director' GROUP BY name) AS credit
+        JOIN Person_Staging p ON p.kind = 'director' AND p.name = credit.name
+        WHERE NOT EXISTS (SELECT 1 FROM Director d WHERE d.name = credit.name)
+        ORDER BY credit.first_credit
+    ''',
+    'actor': '''
+        INSERT INTO Actor (name, date_of_birth, gender, biography, content_id)
+        SELECT credit.name, p.date_of_birth, p.gender, p.biography, credit.content_id
+        FROM (SELECT name, MIN(content_id) AS content_id, MIN(credit_id) AS first_credit
+              FROM Credit_Staging WHERE kind = 'actor' GROUP BY name) AS credit
+        JOIN Person_Staging p ON p.kind = 'actor' AND p.name = credit.name
+        WHERE NOT EXISTS (SELECT 1 FROM Actor a WHERE a.name = credit.name)
+        ORDER BY credit.first_credit
+    ''',
+}
+
+CREDIT_BRIDGE_INSERTS = {
+    'genre': '''
+        INSERT INTO Content_Genre (content_id, genre_id)
+        SELECT DISTINCT c.content_id, g.genre_id
+        FROM Credit_Staging c JOIN Genre g ON g.name = c.name
+        WHERE c.kind = 'genre'
+    ''',
+    'director': '''
+        INSERT INTO Content_Director (content_id, director_id)
+        SELECT DISTINCT c.content_id, d.director_id
+        FROM Credit_Staging c JOIN Director d ON d.name = c.name
+        WHERE c.kind = 'director'
+    ''',
+    'actor': '''
+        INSERT INTO Content_Actor (content_id, actor_id)
+        SELECT DISTINCT c.content_id, a.actor_id
+        FROM Credit_Staging c JOIN Actor a ON a.name = c.name
+        WHERE c.kind = 'actor'
+    ''',
+}
+
+
+def load_staging_rows(cursor, statement, rows):
+    for start in range(0, len(rows), FLUSH_BATCH_SIZE):
+        cursor.executemany(statement, rows[start:start + FLUSH_BATCH_SIZE])
+
+
+# Set-based alternative to the per-title series loop. The raw catalog rows
+# are bulk loaded into temporary staging tables, and Video_Content, Series,
+# Genre, Director, Actor, and the Content_* bridges are then filled with one
+# INSERT ... SELECT each, so every relationship is written exactly once.
+# Faker attributes are generated once per distinct person in the catalog,
+# since the server cannot call Faker. Returns the new series IDs
+def ingest_series_staged(loader, series):
+    cursor = loader.cursor
+    titles = series.titles
+    content_ids = loader.reserve_ids('Video_Content', len(titles))
+    series_ids = loader.reserve_ids('Series', len(titles))
+
+    for statement in filter(str.strip, SERIES_STAGING_TABLES.split(';')):
+        cursor.execute(statement)
+
+    title_rows = [(content_id, series_id, show.title, fake.pystr(max_chars=10), show.country,
+                   show.description, show.release_year, fake.language_name())
+                  for content_id, series_id, show in zip(content_ids, series_ids, titles.itertuples(index=False))]
+    load_staging_rows(cursor, '''
+        INSERT INTO Series_Staging (content_id, series_id, title, thumbnail, country, description, release_year, language)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ''', title_rows)
+
+    credits = [(kind, content_ids[title], name)
+               for kind, bridge in (('genre', series.genres), ('director', series.directors), ('actor', series.actors))
+               for title, name in bridge.itertuples(index=False)]
+    load_staging_rows(cursor, '''
+        INSERT INTO Credit_Staging (kind, content_id, name)
+        VALUES (%s, %s, %s)
+    ''', credits)
+
+    people = [('director', name, date_of_birth(), None, fake.paragraph())
+              for name in series.directors['name'].drop_duplicates()]
+    people += [('actor', name, date_of_birth(), passport_gender(), fake.paragraph())
+               for name in series.actors['name'].drop_duplicates()]
+    load_staging_rows(cursor, '''
+        INSERT IGNORE INTO Person_Staging (kind, name, date_of_birth, gender, biography)
+        VALUES (%s, %s, %s, %s, %s)
+    ''', people)
+
+    statements = [
+        '''
+        INSERT INTO Video_Content (content_id, title, thumbnail, country, description, release_year, language)
+        SELECT content_id, title, thumbnail, country, description, release_year, language FROM Series_Staging
+        ''',
+        '''
+        INSERT INTO Series (series_id, content_id)
+        SELECT series_id, content_id FROM Series_Staging
+        ''',
+        *NEW_ENTITY_INSERTS.values(),
+        *CREDIT_BRIDGE_INSERTS.values(),
+    ]
+    for statement in statements:
+        cursor.execute(statement)
+        loader.written(cursor.rowcount)
+
+    cursor.execute('DROP TEMPORARY TABLE Series_Staging, Credit_Staging, Person_Staging')
+    return series_ids
     
-def insert_season_data(conn, cursor, series_id, total_episodes):
-    num_seasons = random.randint(1, 5)
+    
+def insert_season_data(loader, series_id, total_episodes):
+    num_seasons = rand.randint(1, 5)
     episodes_per_season = max(1, total_episodes // num_seasons)
     
     for i in range(num_seasons):
-        cursor.execute('''
-            INSERT INTO Season (series_id)
-            VALUES (%s)
-        ''', (series_id,))
-        conn.commit()
-        season_id = cursor.lastrowid
-
-        insert_episode_data(conn, cursor, season_id, episodes_per_season)
+        season_id = loader.insert('Season', (series_id,))
+        insert_episode_data(loader, season_id, episodes_per_season)
         
 
-def insert_episode_data(conn, cursor, season_id, episodes_per_season):
+def insert_episode_data(loader, season_id, episodes_per_season):
     for i in range(episodes_per_season):
         title = fake.sentence(nb_words=5)
-        duration = random.randint(20, 60)
-        
-        cursor.execute('''
-            INSERT INTO Episode (title, duration, season_id)
-            VALUES (%s, %s, %s)
-        ''', (title, duration, season_id))
-        conn.commit()
+        duration = rand.randint(20, 60)
+        loader.insert('Episode', (title, duration, season_id))
 
 
-@with_db_connection
-def insert_review_data(conn, cursor):
+@lru_cache(maxsize=None)
+def load_review_samples():
     df = csv_to_dataframe('StreamflixDatabase/assets/generic_movie_series_reviews.csv')
-
     df['Date Posted'] = pd.to_datetime(df['Date Posted'], format='%m/%d/%Y').dt.strftime('%Y-%m-%d')
-    
-    cursor.execute('SELECT content_id FROM Video_Content')
-    content_ids = [row[0] for row in cursor.fetchall()]
+    return df
 
-    cursor.execute('SELECT user_id FROM User')
-    user_ids = [row[0] for row in cursor.fetchall()]
 
-    for content_id in content_ids:
-        num_reviews = random.randint(1, 30)
-        
-        sampled_reviews = df.sample(n=num_reviews, replace=True).reset_index(drop=True)
-        
-        for i, row in sampled_reviews.iterrows():
-            user_id = random.choice(user_ids)
-            
-            cursor.execute('''
-                INSERT INTO Review (review_content, stars, user_id, date_posted)
-                VALUES (%s, %s, %s, %s)
-            ''', (row['Review'], row['Stars'], user_id, row['Date Posted']))
-            
-            review_id = cursor.lastrowid
+# The reviewed content_id of every review, in review order, worked out a
+# chunk at a time from the number of reviews of each title. Reviews are
+# split into chunks of GENERATION_CHUNK_SIZE reviews rather than titles, so
+# a chunk stays the same size however many reviews each title gets
+class ReviewedTitles:
+    def __init__(self, content_ids, counts):
+        self.content_ids = content_ids
+        self.ends = np.cumsum(counts)
 
-            cursor.execute('''
-                INSERT INTO Content_Review (content_id, review_id)
-                VALUES (%s, %s)
-            ''', (content_id, review_id))
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) else 0
 
-    print("-->  Reviews Data Generated and Populated")
+    def __getitem__(self, reviews):
+        positions = np.arange(*reviews.indices(len(self)))
+        return ids_at(self.content_ids, np.searchsorted(self.ends, positions, side='right'))
+
+
+# Every title gets between 1 and reviews_per_title reviews. The counts are
+# drawn from their own seed before the chunks are, so every worker and
+# resumed run splits the reviews the same way
+def reviewed_titles(content_ids, reviews_per_title):
+    rng = np.random.default_rng(random.Random(f'{generation_seed}:reviews:counts').getrandbits(64))
+    return ReviewedTitles(content_ids, rng.integers(1, reviews_per_title + 1, len(content_ids)))
+
+
+# Returns the Review columns (without review_id) for a chunk of reviews and
+# the content_id of each review. Reviews are sampled with replacement from
+# the review CSV
+def generate_review_rows(reviewed_content_ids, user_ids):
+    df = load_review_samples()
+    rng = chunk_rng()
+    samples = rng.integers(0, len(df), len(reviewed_content_ids))
+
+    reviews = (
+        df['Review'].to_numpy()[samples].tolist(),
+        df['Stars'].to_numpy()[samples].tolist(),
+        draw_ids(rng, user_ids, len(samples)).tolist(),
+        df['Date Posted'].to_numpy()[samples].tolist(),
+    )
+    return reviews, reviewed_content_ids.tolist()
 
-    
 
 @with_db_connection
-def insert_my_list_data(conn, cursor):
-    cursor.execute('SELECT user_id FROM User')
-    user_ids = cursor.fetchall()
+def insert_review_data(conn, cursor, reviews_per_title=BASE_VOLUMES['reviews_per_title'], workers=1, **loader_options):
+    loader = BulkLoader(conn, cursor, **loader_options)
+    first_chunk = loader.resume('reviews')
+    
+    content_ids = table_ids(cursor, 'Video_Content')
+    user_ids = table_ids(cursor, 'User')
+
+    chunks = generate_in_chunks('reviews', generate_review_rows, reviewed_titles(content_ids, reviews_per_title),
+                                workers, first_chunk, user_ids=user_ids)
+    for index, (reviews, reviewed_content_ids) in enumerate(chunks, first_chunk):
+        review_ids = loader.insert_columns('Review', reviews)
+        loader.append_columns('Content_Review', (reviewed_content_ids, review_ids))
+        loader.checkpoint(index)
+
+    stats = loader.finish()
+
+    print("-->  Reviews Data Generated and Populated")
+    return stats
 
-    cursor.execute('SELECT content_id FROM Video_Content')
-    content_ids = cursor.fetchall()
     
-    list_names = ["Favorites", "Watch Later", "Must Watch", "Classics", "Top Picks"]
+# Returns the My_List columns (without mylist_id) for a chunk of users, the
+# content_ids on every list, grouped by list, and the size of each list.
+# Each user gets between 1 and lists_per_user lists of 3 to 10 distinct titles
+def generate_my_list_rows(user_ids, content_ids, lists_per_user):
+    list_names = np.array(["Favorites", "Watch Later", "Must Watch", "Classics", "Top Picks"])
+    rng = chunk_rng()
     
-    for user in user_ids:
-        user_id = user[0]
-        num_lists = random.randint(1, 3)
-
-        for i in range(num_lists):
-            list_name = random.choice(list_names)
+    num_lists = rng.integers(1, lists_per_user + 1, len(user_ids))
+    owners = np.repeat(ids_at(user_ids, np.arange(len(user_ids))), num_lists)
+    names = list_names[rng.integers(0, len(list_names), len(owners))]
+    num_items = rng.integers(3, 11, len(owners))
+    listed = ids_at(content_ids, sample_positions(rng, len(content_ids), num_items))
 
-            cursor.execute('''
-                INSERT INTO My_List (name, user_id)
-                VALUES (%s, %s)
-            ''', (list_name, user_id))
-            conn.commit()
-            mylist_id = cursor.lastrowid
+    return (names.tolist(), owners.tolist()), listed.tolist(), num_items
 
-            num_items = random.randint(3, 10)
-            selected_content_ids = random.sample(content_ids, num_items)
 
-            for content in selected_content_ids:
-                content_id = content[0]
+@with_db_connection
+def insert_my_list_data(conn, cursor, lists_per_user=BASE_VOLUMES['lists_per_user'], workers=1, **loader_options):
+    loader = BulkLoader(conn, cursor, **loader_options)
+    first_chunk = loader.resume('my_lists')
 
-                cursor.execute('''
-                    INSERT INTO Listed_Content (content_id, mylist_id)
-                    VALUES (%s, %s)
-                ''', (content_id, mylist_id))
-            conn.commit()
+    user_ids = table_ids(cursor, 'User')
+    content_ids = table_ids(cursor, 'Video_Content')
+    
+    chunks = generate_in_chunks('my_lists', generate_my_list_rows, user_ids, workers, first_chunk,
+                                content_ids=content_ids, lists_per_user=lists_per_user)
+    for index, (lists, listed_content_ids, num_items) in enumerate(chunks, first_chunk):
+        mylist_ids = loader.insert_columns('My_List', lists)
+        loader.append_columns('Listed_Content', (
+            listed_content_ids,
+            np.repeat(mylist_ids, num_items).tolist(),
+            [reference_time] * len(listed_content_ids),
+        ))
+        loader.checkpoint(index)
+
+    stats = loader.finish()
 
     print("-->  User Lists Data Generated and Populated")
+    return stats
     
 
+# Returns the User_Metrics columns (without metric_id) for a chunk of
+# sessions. Sessions start within the year before the reference time, last
+# 10 to 240 minutes, and end exactly duration seconds after they start
+def generate_user_metrics_rows(sessions, user_ids, content_ids):
+    rng = chunk_rng()
+    count = len(sessions)
+
+    user_column = draw_ids(rng, user_ids, count)
+    content_column = draw_ids(rng, content_ids, count)
+    latest_start = np.datetime64(reference_time, 's')
+    start_times = latest_start - rng.integers(0, 365 * 24 * 60 * 60 + 1, count).astype('timedelta64[s]')
+    durations = rng.integers(10 * 60, 240 * 60 + 1, count)
+    end_times = start_times + durations.astype('timedelta64[s]')
+    completed = rng.random(count) < 0.5
+
+    return (start_times.tolist(), end_times.tolist(), durations.tolist(), completed.tolist(),
+            content_column.tolist(), user_column.tolist())
+
+
 @with_db_connection
-def insert_user_metrics_data(conn, cursor):
-    cursor.execute('SELECT user_id FROM User')
-    user_ids = cursor.fetchall()
-
-    cursor.execute('SELECT content_id FROM Video_Content')
-    content_ids = cursor.fetchall()
-
-    for i in range(800):
-        user_id = random.choice(user_ids)[0]
-        content_id = random.choice(content_ids)[0]
-        start_time = fake.date_time_between(start_date='-1y', end_date='now')
-        duration = random.randint(10 * 60, 240 * 60)
-        end_time = start_time + timedelta(seconds=duration)
-        completed = random.choice([True, False])
-
-        cursor.execute('''
-            INSERT INTO User_Metrics (start_time, end_time, duration, completed, content_id, user_id)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        ''', (start_time, end_time, duration, completed, content_id, user_id))
-        conn.commit()
+def insert_user_metrics_data(conn, cursor, sessions=BASE_VOLUMES['user_metrics'], workers=1, **loader_options):
+    loader = BulkLoader(conn, cursor, **loader_options)
+    first_chunk = loader.resume('user_metrics')
+
+    user_ids = table_ids(cursor, 'User')
+    content_ids = table_ids(cursor, 'Video_Content')
+
+    chunks = generate_in_chunks('user_metrics', generate_user_metrics_rows, range(sessions), workers, first_chunk,
+                                user_ids=user_ids, content_ids=content_ids)
+    for index, metrics in enumerate(chunks, first_chunk):
+        loader.insert_columns('User_Metrics', metrics)
+        loader.checkpoint(index)
+
+    stats = loader.finish()
 
     print("-->  User Metrics Data Generated and Populated")
+    return stats
           
 
-def main():  
+# Generation stages in the order main() runs them
+STAGES = {
+    'users': insert_user_data,                                 # User, Profile, and Device Data
+    'movies': insert_movie_genre_actor_director_data,          # Video_Content, Movie, Genre, Actor, Director, Content_Actor, Content_Genre, Content_Director Data
+    'series': insert_series_data,                              # Video_Content, Series, Season, and Episode Data
+    'reviews': insert_review_data,                             # Review and Content_Review Data
+    'my_lists': insert_my_list_data,                           # My_List and Listed_Content Data
+    'user_metrics': insert_user_metrics_data,                  # User_Metrics Data
+}
+
+
+# Tables written by each stage, used to work out which stages can run
+# concurrently from the foreign keys in the schema
+STAGE_TABLES = {
+    'users': {'User', 'Profile', 'Device'},
+    'movies': {'Video_Content', 'Movie', 'Genre', 'Actor', 'Director', 'Content_Genre', 'Content_Actor', 'Content_Director'},
+    'series': {'Video_Content', 'Series', 'Season', 'Episode', 'Genre', 'Actor', 'Director', 'Content_Genre', 'Content_Actor', 'Content_Director'},
+    'reviews': {'Review', 'Content_Review'},
+    'my_lists': {'My_List', 'Listed_Content'},
+    'user_metrics': {'User_Metrics'},
+}
+
+
+# Parses a commit policy setting such as 'every:1000,series=row' into a
+# policy for each stage. Entries without a stage name set the default
+def parse_commit_policies(spec):
+    policies = dict.fromkeys(STAGES, 'stage')
+    overrides = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        stage, _, policy = entry.rpartition('=')
+        CommitPolicy(policy)
+        if not stage:
+            policies = dict.fromkeys(STAGES, policy)
+        elif stage in STAGES:
+            overrides[stage] = policy
+        else:
+            raise ValueError(f"Unknown stage in commit policy: {stage}")
+    policies.update(overrides)
+    return policies
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Generates the data for the Streamflix database.')
+    parser.add_argument('--loader', choices=LOADER_MODES, default='bulk',
+                        help="'bulk' buffers each stage and writes every table with executemany, "
+                             "'infile' loads each table from a temporary TSV file with LOAD DATA LOCAL INFILE, "
+                             "'row' inserts one row at a time")
+    parser.add_argument('--commit-policy', default=DEFAULT_COMMIT_POLICY,
+                        help="'row', 'every:N', or 'stage', optionally per stage, e.g. 'every:1000,series=row' "
+                             f"(default: STREAMFLIX_COMMIT_POLICY or 'stage'; stages: {', '.join(STAGES)})")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplies the number of users, user metrics, and reviews per title (default: 1)')
+    parser.add_argument('--users', type=int,
+                        help=f"number of users (default: {BASE_VOLUMES['users']} x scale)")
+    parser.add_argument('--user-metrics', type=int,
+                        help=f"number of User_Metrics sessions (default: {BASE_VOLUMES['user_metrics']} x scale)")
+    parser.add_argument('--reviews-per-title', type=int,
+                        help=f"maximum reviews per title (default: {BASE_VOLUMES['reviews_per_title']} x scale)")
+    parser.add_argument('--lists-per-user', type=int, default=BASE_VOLUMES['lists_per_user'],
+                        help=f"maximum lists per user (default: {BASE_VOLUMES['lists_per_user']})")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help=f'rows buffered before each flush (default: STREAMFLIX_CHUNK_SIZE or {CHUNK_SIZE})')
+    parser.add_argument('--series-ingest', choices=SERIES_INGEST_MODES, default='client',
+                        help="'client' resolves series genres, directors, and actors in Python, "
+                             "'staging' loads the raw series rows into staging tables and resolves them "
+                             "with INSERT ... SELECT on the server")
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes used to synthesize users, reviews, lists, and user metrics (default: 1)')
+    parser.add_argument('--seed', type=int,
+                        help='seed for reproducible data; the same seed always generates the same rows')
+    parser.add_argument('--as-of', type=datetime.fromisoformat,
+                        help='reference time for generated dates, e.g. 2024-09-18 '
+                             '(default: now, or 2024-09-18 when --seed is given)')
+    parser.add_argument('--schema-mode', choices=SCHEMA_MODES, default='standard',
+                        help="'standard' creates the tables with their indexes and foreign keys, "
+                             "'bulk' loads into bare tables with foreign key and unique checks off, "
+                             "then validates the foreign keys and adds the indexes and constraints")
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the run in the database instead of starting over: finished stages are '
+                             'skipped and the rest resume from their last checkpointed chunk')
+    parser.add_argument('--checkpoint-commits', action='store_true',
+                        help='also commit every chunk with its checkpoint, so --resume loses at most one chunk '
+                             'of a failed stage whatever the commit policy')
+    parser.add_argument('--stage-concurrency', type=int, default=1,
+                        help='stages that may run at the same time once their dependencies are loaded (default: 1)')
+    parser.add_argument('--instrument', action='store_true',
+                        help='time every statement and print the ones with the most total time at the end')
+    parser.add_argument('--top', type=int, default=15,
+                        help='statements listed in the --instrument report (default: 15)')
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help='write the --instrument statistics to FILE in the Prometheus text format '
+                             '(implies --instrument)')
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                        help='number of pooled MySQL connections (default: MYSQL_POOL_SIZE or 5)')
+    parser.add_argument('--backend', choices=BACKENDS, default=BACKEND,
+                        help="'mysql' connects to the MYSQL_HOST server, 'sqlite' generates into an embedded "
+                             "SQLite database (default: STREAMFLIX_BACKEND or 'mysql')")
+    parser.add_argument('--sqlite-path', default=SQLITE_PATH,
+                        help="SQLite database file, or ':memory:' for a database that lasts as long as the "
+                             "process (default: STREAMFLIX_SQLITE_PATH or ':memory:')")
+    args = parser.parse_args(argv)
+    try:
+        args.commit_policies = parse_commit_policies(args.commit_policy)
+    except ValueError as err:
+        parser.error(str(err))
+    if args.as_of is None and args.seed is not None:
+        args.as_of = SEEDED_REFERENCE_TIME
+    args.instrument = args.instrument or args.prometheus is not None
+    for volume in ('users', 'user_metrics', 'reviews_per_title'):
+        if getattr(args, volume) is None:
+            setattr(args, volume, max(1, round(BASE_VOLUMES[volume] * args.scale)))
+    return args
+
+
+# Volume and worker arguments for each stage, taken from the parsed command line
+def stage_arguments(args):
+    return {
+        'users': {'users': args.users, 'workers': args.workers},
+        'movies': {},
+        'series': {'ingest': args.series_ingest},
+        'reviews': {'reviews_per_title': args.reviews_per_title, 'workers': args.workers},
+        'my_lists': {'lists_per_user': args.lists_per_user, 'workers': args.workers},
+        'user_metrics': {'sessions': args.user_metrics, 'workers': args.workers},
+    }
+
+
+def print_stage_summary(stage_stats):
+    print('\n-->  Rows written, statements, and commits per stage')
+    for stage, stats in stage_stats.items():
+        if stats is None:
+            print(f"     {stage:<14} failed")
+            continue
+        print(f"     {stage:<14} {stats['rows']:>10} rows {stats['statements']:>8} statements "
+              f"{stats['commits']:>8} commits   ({stats['commit_policy']})")
+
+
+# Settings that decide which rows are generated. A run can only be resumed
+# with the settings it was started with
+def generation_settings(args):
+    return {
+        'users': args.users,
+        'user_metrics': args.user_metrics,
+        'reviews_per_title': args.reviews_per_title,
+        'lists_per_user': args.lists_per_user,
+        'series_ingest': args.series_ingest,
+        'schema_mode': args.schema_mode,
+        'generation_chunk_size': GENERATION_CHUNK_SIZE,
+    }
+
+
+# Records the seed, reference time, and settings of a new run, so that a
+# resumed run regenerates its remaining chunks exactly as this one would have
+@with_db_connection
+def record_run(conn, cursor, settings):
+    cursor.execute('INSERT INTO Generation_Run (run_id, seed, as_of, settings) VALUES (1, %s, %s, %s)',
+                   (generation_seed, reference_time, json.dumps(settings, sort_keys=True)))
+
+
+# Returns the seed, reference time, and settings of the run in the database,
+# and {stage: totals} for the stages it finished, or None when there is no
+# run to resume
+@with_db_connection
+def load_run(conn, cursor):
+    cursor.execute(f"SHOW DATABASES LIKE '{DATABASE_NAME}';")
+    if cursor.fetchone() is None:
+        return None
+    select_database(cursor)
+    cursor.execute("SHOW TABLES LIKE 'Generation_Run';")
+    if cursor.fetchone() is None:
+        return None
+    cursor.execute('SELECT seed, as_of, settings FROM Generation_Run WHERE run_id = 1')
+    run = cursor.fetchone()
+    if run is None:
+        return None
+
+    cursor.execute('SELECT stage, rows_written, commits FROM Generation_Checkpoint WHERE finished')
+    finished = {stage: {'rows': rows, 'commits': commits, 'statements': 0, 'commit_policy': 'finished earlier'}
+                for stage, rows, commits in cursor.fetchall()}
+    seed, as_of, settings = run
+    return seed, as_of, json.loads(settings), finished
+
+
+# Picks up the run in the database, or returns None when there is none.
+# Returns {stage: totals} for the stages that run already finished
+def resume_run(args, settings):
+    run = load_run()
+    if run is None:
+        print("-->  No run to resume, starting a new one")
+        return None
+
+    seed, as_of, run_settings, finished = run
+    changed = [name for name in settings if settings[name] != run_settings.get(name)]
+    if args.seed is not None and args.seed != seed:
+        changed.append('seed')
+    if changed:
+        raise SystemExit(f"Cannot resume: the run in the database was started with a different {', '.join(changed)}")
+    configure_generation(seed, as_of)
+    print(f"-->  Resuming the run started with seed {seed}, as of {as_of}")
+    return finished
+
+
+# Initializes the database and runs every stage with the parsed arguments.
+# With --resume, the run already in the database is continued instead:
+# finished stages are skipped and the others resume from their checkpoints.
+# wrap_stage, if given, is called with each stage's name and function and
+# returns the function to run in its place. Returns the stage dependencies,
+# {stage: stats}, {stage: (start, end)}, and the seconds spent initializing
+# the schema, applying deferred constraints, and building the aggregates
+def run_generation(args, wrap_stage=None):
+    configure_backend(args.backend, args.sqlite_path)
+    configure_pool(max(args.pool_size, args.stage_concurrency))
+    configure_generation(args.seed, args.as_of)
+    configure_instrumentation(args.instrument)
+
     # Initialize the database schema
-    initialize_database()
+    start = time.perf_counter()
+    schema = read_schema(SCHEMA_FILE)
+    bulk_schema = args.schema_mode == 'bulk'
+    bare_schema, deferred = defer_constraints(schema)
+    settings = generation_settings(args)
+    finished = resume_run(args, settings) if args.resume else None
+    if finished is None:
+        finished = {}
+        initialize_database(bare_schema if bulk_schema else schema)
+        partition_user_metrics()
+        record_run(settings)
+    phase_seconds = {'initialize_database': time.perf_counter() - start}
     
     # Generate and insert data
-    insert_user_data()                           # User, Profile, and Device Data
-    insert_movie_genre_actor_director_data()     # Video_Content, Movie, Genre, Actor, Director, Movie_Actor, Movie_Genre, Movie_Director Data
-    insert_series_data()                         # Video_Content, Series, Season, and Episode Data
-    insert_review_data()                         # Review and Content_Review Data
-    insert_my_list_data()                        # My_List and Listed_Content Data
-    insert_user_metrics_data()                   # User_Metrics Data
+    arguments = stage_arguments(args)
+    stages = {}
+    for stage, insert_data in STAGES.items():
+        if stage in finished:
+            print(f"-->  Skipping {stage}: finished in an earlier run")
+            stages[stage] = partial(dict, finished[stage])
+        else:
+            stages[stage] = partial(insert_data, **arguments[stage], mode=args.loader, chunk_size=args.chunk_size,
+                                    commit_policy=args.commit_policies[stage], deferred_checks=bulk_schema,
+                                    checkpoint_commits=args.checkpoint_commits)
+        if wrap_stage:
+            stages[stage] = wrap_stage(stage, stages[stage])
+    dependencies = stage_dependencies(STAGE_TABLES, foreign_keys(schema))
+    stage_stats, timings = run_stages(stages, dependencies, args.stage_concurrency)
     
+    if bulk_schema and 'deferred_constraints' not in finished:
+        if None in stage_stats.values():
+            print("-->  Indexes and foreign keys deferred until every stage has finished")
+        else:
+            start = time.perf_counter()
+            apply_deferred_constraints(schema, deferred)
+            phase_seconds['apply_deferred_constraints'] = time.perf_counter() - start
+
+    if None not in stage_stats.values():
+        start = time.perf_counter()
+        build_aggregates()
+        phase_seconds['build_aggregates'] = time.perf_counter() - start
+        start = time.perf_counter()
+        build_rollups()
+        phase_seconds['build_rollups'] = time.perf_counter() - start
+    return dependencies, stage_stats, timings, phase_seconds
+
+
+def main(argv=None):  
+    args = parse_args(argv)
+    dependencies, stage_stats, timings, _ = run_generation(args)
+
+    print_stage_summary(stage_stats)
+    print_schedule_report(dependencies, timings)
+    if statement_stats is not None:
+        print_statement_report(statement_stats, args.top)
+    if args.prometheus:
+        write_prometheus(statement_stats, args.prometheus)
+        print(f"-->  Statement metrics written to {args.prometheus}")
     print('\n\n-->  Data Generation Complete!\n\n')
 
 
 if __name__ == "__main__":
-    main()
+    main()
\ No newline at end of file
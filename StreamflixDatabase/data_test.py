@@ -5,128 +5,281 @@
    Authors: Ashley Davis
 '''
 
-from data_generation import with_db_connection
+from data_generation import (BACKEND, BACKENDS, POOL_SIZE, SQLITE_PATH, configure_backend, configure_pool, parse_args,
+                             run_generation, with_db_connection)
+from schema import SCHEMA_FILE, column_types, foreign_key_columns, orphan_query, primary_keys, read_schema
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import argparse, json, os, sys, time
+
+# Key values covered by one query of a chunked check. A chunk is a range
+# scan of the primary key, so this bounds the rows each query reads
+CHUNK_SIZE = int(os.getenv('STREAMFLIX_CHECK_CHUNK_SIZE', 1000000))
+
+# Longest the server may spend on one query, in milliseconds, and longest
+# the whole run may take, in seconds. Checks still waiting when the run
+# times out are reported as timed out
+STATEMENT_TIMEOUT_MS = int(os.getenv('STREAMFLIX_CHECK_STATEMENT_TIMEOUT_MS', 60000))
+RUN_TIMEOUT = float(os.getenv('STREAMFLIX_CHECK_TIMEOUT', 900))
+
+# An invariant of the generated data. The query counts, on the server, the
+# rows bearing it out (or breaking it), and the check passes when the count
+# equals expected. A check with a chunk key, (table, integer column), runs
+# its query once per range of that column, bound to its BETWEEN %s AND %s,
+# and adds up the counts
+Check = namedtuple('Check', 'name description query expected chunk_key', defaults=(None,))
+
+CheckResult = namedtuple('CheckResult', 'name description status observed expected chunks seconds query_seconds')
+
+DATA_CHECKS = [
+    Check('genre_count', 'According to our data, we have 40 unique genres',
+          'SELECT COUNT(*) FROM Genre', 40),
+    Check('aniston_titles', 'According to our data, Jennifer Aniston has acted in 1 Series and 2 Movies', '''
+        SELECT COUNT(*)
+        FROM Actor a
+        JOIN Content_Actor ca ON a.actor_id = ca.actor_id
+        JOIN Video_Content vc ON ca.content_id = vc.content_id
+        WHERE a.name = 'Jennifer Aniston'
+    ''', 3),
+    Check('fincher_titles', 'According to our data, David Fincher has directed 8 movies', '''
+        SELECT COUNT(*)
+        FROM Director d
+        JOIN Content_Director cd ON d.director_id = cd.director_id
+        JOIN Video_Content vc ON cd.content_id = vc.content_id
+        WHERE d.name = 'David Fincher'
+    ''', 8),
+    Check('device_limit', 'Based on the data design, no user should have more than 4 devices linked to their account', '''
+        SELECT COUNT(*)
+        FROM (SELECT user_id
+              FROM Device
+              WHERE user_id BETWEEN %s AND %s
+              GROUP BY user_id
+              HAVING COUNT(device_id) > 4) over_limit
+    ''', 0, ('Device', 'user_id')),
+    Check('duplicate_titles', 'Ensuring there are no duplicate video_content entries', '''
+        SELECT COUNT(*)
+        FROM (SELECT title
+              FROM Video_Content
+              GROUP BY title
+              HAVING COUNT(*) > 1) duplicates
+    ''', 0),
+    Check('metric_durations', 'Ensuring the watch duration of a user metric entry aligns with the start and end time', '''
+        SELECT COUNT(*)
+        FROM User_Metrics
+        WHERE metric_id BETWEEN %s AND %s
+          AND TIMESTAMPDIFF(SECOND, start_time, end_time) != duration
+    ''', 0, ('User_Metrics', 'metric_id')),
+    Check('movie_and_series_directors', 'There is one director who has produced at least 1 movie and 1 series', '''
+        SELECT COUNT(*)
+        FROM Director d
+        WHERE EXISTS (SELECT 1 FROM Content_Director cd JOIN Movie m ON cd.content_id = m.content_id
+                      WHERE cd.director_id = d.director_id)
+          AND EXISTS (SELECT 1 FROM Content_Director cd JOIN Series s ON cd.content_id = s.content_id
+                      WHERE cd.director_id = d.director_id)
+    ''', 1),
+]
+
+
+# One check per foreign key in the schema, counting orphaned rows in
+# ranges of the child table's primary key
+def foreign_key_checks(schema):
+    keys = primary_keys(schema)
+    types = column_types(schema)
+    checks = []
+    for table, column, parent, parent_column in foreign_key_columns(schema):
+        key = keys[table][0] if keys[table] else None
+        chunk_column = key if types[table].get(key) in ('INT', 'BIGINT') else None
+        checks.append(Check(f'{table}.{column}_references',
+                            f'Every {table}.{column} matches a {parent}.{parent_column}',
+                            orphan_query(table, column, parent, parent_column, chunk_column), 0,
+                            (table, chunk_column) if chunk_column else None))
+    return checks
+
+
+def all_checks():
+    return DATA_CHECKS + foreign_key_checks(read_schema(SCHEMA_FILE))
+
+
+# Caps the server time of a SELECT with an optimizer hint
+def with_statement_timeout(query, milliseconds):
+    query = query.strip()
+    return f'SELECT /*+ MAX_EXECUTION_TIME({milliseconds}) */{query[len("SELECT"):]}'
+
 
-# According to our data, we have 40 unique genres
-@with_db_connection
-def test1(conn, cursor):
-    cursor.execute("SELECT * FROM Genre;")
-    genres = cursor.fetchall()
-    if len(genres) == 40:
-        print("Test 1: \033[32mPASS\033[0m")
-        return
-    print("Test 1: \033[31mFAIL\033[0m")
-    
-    
-# According to our data, Jennifer Aniston has acted in 1 Series and 2 Movies
-@with_db_connection
-def test2(conn, cursor):
-    cursor.execute('''
-                   SELECT vc.title 
-                   FROM Actor a 
-                   JOIN Content_Actor ca ON a.actor_id = ca.actor_id 
-                   JOIN Video_Content vc ON ca.content_id = vc.content_id 
-                   WHERE a.name = 'Jennifer Aniston';
-                   ''')
-    content = cursor.fetchall()
-    if len(content) == 3:
-        print("Test 2: \033[32mPASS\033[0m")
-        return
-    print("Test 2: \033[31mFAIL\033[0m")
-    
-
-# According to our data, David Fincher has directed 8 movies
-@with_db_connection
-def test3(conn, cursor):
-    cursor.execute('''
-                   SELECT vc.title 
-                   FROM Director d 
-                   JOIN Content_Director cd ON d.director_id = cd.director_id 
-                   JOIN Video_Content vc ON cd.content_id = vc.content_id 
-                   WHERE d.name = 'David Fincher';
-                   ''')
-    content = cursor.fetchall()
-    if len(content) == 8:
-        print("Test 3: \033[32mPASS\033[0m")
-        return
-    print("Test 3: \033[31mFAIL\033[0m")
-    
-
-# Based on the data design, no user should have more than 4 devices linked to their account
-@with_db_connection
-def test4(conn, cursor):
-    cursor.execute('''
-                    SELECT user_id, COUNT(device_id) AS device_count
-                    FROM Device
-                    GROUP BY user_id
-                    HAVING COUNT(device_id) > 4;
-                   ''')
-    content = cursor.fetchall()
-    if not content:
-        print("Test 4: \033[32mPASS\033[0m")
-        return
-    print("Test 4: \033[31mFAIL\033[0m")
-    
-    
-# Ensuring there are no duplicate video_content entries
-@with_db_connection
-def test5(conn, cursor):
-    cursor.execute('''
-                    SELECT title, COUNT(*)
-                    FROM Video_Content
-                    GROUP BY title
-                    HAVING COUNT(*) > 1;
-                   ''')
-    content = cursor.fetchall()
-    if not content:
-        print("Test 5: \033[32mPASS\033[0m")
-        return
-    print("Test 5: \033[31mFAIL\033[0m")
-
-
-# Ensuring the watch duration of a user metric entry aligns with the start and end time
 @with_db_connection
-def test6(conn, cursor):
-    cursor.execute('''
-                    SELECT metric_id, TIMESTAMPDIFF(SECOND, start_time, end_time) AS calculated_duration, duration
-                    FROM User_Metrics
-                    WHERE TIMESTAMPDIFF(SECOND, start_time, end_time) != duration;
-                   ''')
-    content = cursor.fetchall()
-    if not content:
-        print("Test 6: \033[32mPASS\033[0m")
-        return
-    print("Test 6: \033[31mFAIL\033[0m")
-
-
-# There is one director who has produced at least 1 movie and 1 series
+def key_range(conn, cursor, table, column):
+    cursor.execute(f'SELECT MIN({column}), MAX({column}) FROM {table}')
+    return cursor.fetchone()
+
+
+# Returns the query parameters of each chunk of a check: one empty tuple
+# for an unchunked check, and none at all for an empty table
+def check_chunks(check, chunk_size):
+    if check.chunk_key is None:
+        return [()]
+    bounds = key_range(*check.chunk_key)
+    if bounds is None:
+        return None
+    low, high = bounds
+    if low is None:
+        return []
+    return [(start, min(start + chunk_size - 1, high)) for start in range(low, high + 1, chunk_size)]
+
+
 @with_db_connection
-def test7(conn, cursor):
-    cursor.execute('''
-                    SELECT DISTINCT d.name, d.director_id
-                    FROM Director d
-                    JOIN Content_Director cd_movie ON d.director_id = cd_movie.director_id
-                    JOIN Movie m ON cd_movie.content_id = m.content_id
-                    JOIN Content_Director cd_series ON d.director_id = cd_series.director_id
-                    JOIN Series s ON cd_series.content_id = s.content_id;
-                   ''')
-    content = cursor.fetchall()
-    if len(content) == 1:
-        print("Test 7: \033[32mPASS\033[0m")
-        return
-    print("Test 7: \033[31mFAIL\033[0m")
-
-
-def main():
-    test1()
-    test2()
-    test3()
-    test4()
-    test5()
-    test6()
-    test7()
+def run_chunk(conn, cursor, query, params):
+    start = time.perf_counter()
+    cursor.execute(query, params)
+    count = cursor.fetchone()[0]
+    return count, time.perf_counter() - start
+
+
+# Runs the checks' queries concurrently, at most jobs at a time, each on a
+# pooled connection. The key ranges of the chunked checks are looked up on
+# the same pool, and their chunks are queued as each range arrives, so the
+# small checks finish early while the chunks of the large tables keep every
+# connection busy. Everything, key range lookups included, stops at the
+# timeout. Returns a CheckResult per check, in order
+def run_checks(checks, jobs=POOL_SIZE, chunk_size=CHUNK_SIZE, timeout=RUN_TIMEOUT,
+               statement_timeout=STATEMENT_TIMEOUT_MS):
+    start = time.perf_counter()
+    deadline = start + timeout
+    progress = {check.name: {'observed': 0, 'pending': 0, 'chunks': 0, 'errors': 0, 'query_seconds': 0.0,
+                             'end': start} for check in checks}
+    queries = {check.name: with_statement_timeout(check.query, statement_timeout) for check in checks}
+
+    # Not a with block: leaving one waits for every running chunk, which would let a slow
+    # query hold the run past --timeout
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    timed_out = False
+    # Each future maps to its check, and whether it runs a chunk rather
+    # than looking up the check's key range
+    running = {}
+
+    def submit(check, is_chunk, function, *args):
+        running[executor.submit(function, *args)] = (check, is_chunk)
+        progress[check.name]['pending'] += 1
+
+    try:
+        for check in checks:
+            if check.chunk_key is None:
+                submit(check, True, run_chunk, queries[check.name], ())
+            else:
+                submit(check, False, check_chunks, check, chunk_size)
+
+        while running:
+            done, _ = wait(running, timeout=max(deadline - time.perf_counter(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                check, is_chunk = running.pop(future)
+                check_progress = progress[check.name]
+                check_progress['pending'] -= 1
+                if is_chunk:
+                    check_progress['chunks'] += 1
+                    check_progress['end'] = time.perf_counter()
+                # Failures with_db_connection reports come back as None; anything
+                # else it lets through is counted the same way
+                try:
+                    result = future.result()
+                except Exception as err:
+                    print(f"Error in {check.name}: {err!r}")
+                    result = None
+                if result is None:
+                    check_progress['errors'] += 1
+                    continue
+                if not is_chunk:
+                    for params in result:
+                        submit(check, True, run_chunk, queries[check.name], params)
+                    continue
+                count, seconds = result
+                check_progress['observed'] += count
+                check_progress['query_seconds'] += seconds
+            if running and time.perf_counter() >= deadline:
+                timed_out = True
+                break
+    finally:
+        executor.shutdown(wait=not timed_out, cancel_futures=timed_out)
+
+    results = []
+    for check in checks:
+        check_progress = progress[check.name]
+        if check_progress['errors']:
+            status = 'error'
+        elif check_progress['pending']:
+            status = 'timeout'
+        else:
+            status = 'pass' if check_progress['observed'] == check.expected else 'fail'
+        results.append(CheckResult(check.name, check.description, status, int(check_progress['observed']),
+                                   check.expected, check_progress['chunks'],
+                                   round(check_progress['end'] - start, 3),
+                                   round(check_progress['query_seconds'], 3)))
+    return results
+
+
+STATUS_LABELS = {
+    'pass': '\033[32mPASS\033[0m',
+    'fail': '\033[31mFAIL\033[0m',
+    'error': '\033[31mERROR\033[0m',
+    'timeout': '\033[33mTIMEOUT\033[0m',
+}
+
+
+def print_results(results, seconds):
+    width = max(len(result.name) for result in results)
+    for result in results:
+        detail = f'{result.observed}, expected {result.expected}' if result.status == 'fail' else ''
+        chunks = f'{result.chunks} chunks' if result.chunks != 1 else '1 chunk'
+        print(f"{result.name:<{width}}  {STATUS_LABELS[result.status]:<16} "
+              f"{result.seconds:>8.2f}s {result.query_seconds:>8.2f}s in queries {chunks:>12}   {detail}")
+    passed = sum(result.status == 'pass' for result in results)
+    print(f"\n-->  {passed} of {len(results)} checks passed in {seconds:.2f}s")
+
+
+def write_json(path, results, seconds):
+    with open(path, 'w') as json_file:
+        json.dump({'seconds': round(seconds, 3), 'checks': [result._asdict() for result in results]},
+                  json_file, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checks the invariants of the generated Streamflix data.')
+    parser.add_argument('--jobs', type=int, default=POOL_SIZE,
+                        help=f'queries run at the same time (default: MYSQL_POOL_SIZE or {POOL_SIZE})')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help=f'key values per query of a chunked check (default: {CHUNK_SIZE})')
+    parser.add_argument('--timeout', type=float, default=RUN_TIMEOUT,
+                        help=f'seconds before the remaining checks are abandoned (default: {RUN_TIMEOUT:g})')
+    parser.add_argument('--statement-timeout', type=int, default=STATEMENT_TIMEOUT_MS,
+                        help=f'milliseconds a single query may run (default: {STATEMENT_TIMEOUT_MS})')
+    parser.add_argument('--json', metavar='FILE', help='also write the results to FILE')
+    parser.add_argument('--backend', choices=BACKENDS, default=BACKEND,
+                        help=f"database to check, 'mysql' or 'sqlite' (default: STREAMFLIX_BACKEND or '{BACKEND}')")
+    parser.add_argument('--sqlite-path', default=SQLITE_PATH,
+                        help=f"SQLite database file (default: STREAMFLIX_SQLITE_PATH or '{SQLITE_PATH}')")
+    parser.add_argument('--generate', action='store_true',
+                        help='generate the data in this process before checking it, which an in-memory SQLite '
+                             'database needs. Other options are passed on to data_generation.py')
+    args, generator_args = parser.parse_known_args(argv)
+    if generator_args and not args.generate:
+        parser.error(f"unrecognized arguments: {' '.join(generator_args)}")
+
+    configure_backend(args.backend, args.sqlite_path)
+    if args.generate:
+        generator = parse_args(['--pool-size', str(max(args.jobs, POOL_SIZE))] + generator_args
+                               + ['--backend', args.backend, '--sqlite-path', args.sqlite_path])
+        _, stage_stats, _, _ = run_generation(generator)
+        if None in stage_stats.values():
+            raise SystemExit('Generation failed, nothing to check')
+    elif args.jobs > POOL_SIZE:
+        configure_pool(args.jobs)
+    start = time.perf_counter()
+    results = run_checks(all_checks(), args.jobs, args.chunk_size, args.timeout, args.statement_timeout)
+    seconds = time.perf_counter() - start
+    print_results(results, seconds)
+    if args.json:
+        write_json(args.json, results, seconds)
+    return 0 if all(result.status == 'pass' for result in results) else 1
 
 
 if __name__ == "__main__":
    print('Testing Creation of Generated Data...\n')
-   main()
\ No newline at end of file
+   sys.exit(main())
@@ -0,0 +1,193 @@
+'''
+   Streamflix Database Statement Instrumentation
+   Script: instrumentation.py
+   Description: Wraps database connections and cursors to count and time the
+                statements they run, grouped by normalized SQL text.
+   Authors: Ashley Davis
+'''
+
+from bisect import bisect_left
+import re, threading, time
+
+# Upper bounds, in seconds, of the latency histogram buckets: 25µs doubling
+# up to about 105s, with everything slower in a final +Inf bucket
+LATENCY_BUCKETS = tuple(0.000025 * 2 ** power for power in range(23))
+
+# Longer statements, e.g. whole scripts, are cut to this many characters
+MAX_STATEMENT_LENGTH = 300
+
+COMMENT = re.compile(r'/\*.*?\*/|--[^\n]*', re.DOTALL)
+STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+MULTI_ROW_INSERT = re.compile(r'^\s*INSERT\b.*\bVALUES\b', re.IGNORECASE | re.DOTALL)
+
+
+# Reduces a statement to its shape, so that statements differing only in
+# their values, comments, whitespace, or IN list length are counted together
+def normalize_sql(sql):
+    sql = STRING_LITERAL.sub('?', COMMENT.sub(' ', sql))
+    sql = ' '.join(sql.split()).rstrip(';')
+    sql = IN_LIST.sub('IN (?)', NUMBER_LITERAL.sub('?', sql.replace('%s', '?')))
+    return sql if len(sql) <= MAX_STATEMENT_LENGTH else sql[:MAX_STATEMENT_LENGTH - 3] + '...'
+
+
+# Counts, latency histogram, rows affected, and round trips of one
+# normalized statement
+class StatementRecord:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.rows = 0
+        self.round_trips = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds, rows, round_trips):
+        self.calls += 1
+        self.seconds += seconds
+        self.slowest = max(self.slowest, seconds)
+        self.rows += max(rows, 0)
+        self.round_trips += round_trips
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    # Estimates a latency quantile by interpolating within the histogram
+    # bucket that contains it, the way Prometheus' histogram_quantile does
+    def quantile(self, q):
+        target = q * self.calls
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            if count and seen + count >= target:
+                lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+                upper = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else self.slowest
+                return lower + (min(upper, self.slowest) - lower) * (target - seen) / count
+            seen += count
+        return 0.0
+
+
+# Thread-safe {normalized SQL: StatementRecord} shared by every
+# instrumented connection
+class StatementStats:
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def observe(self, sql, seconds, rows=0, round_trips=1):
+        statement = normalize_sql(sql)
+        with self.lock:
+            record = self.records.get(statement)
+            if record is None:
+                record = self.records[statement] = StatementRecord()
+            record.observe(seconds, rows, round_trips)
+
+    # The n statements with the most total time, as (SQL, record)
+    def top(self, n):
+        with self.lock:
+            return sorted(self.records.items(), key=lambda item: item[1].seconds, reverse=True)[:n]
+
+
+# Times execute() and executemany() on a cursor and forwards everything else
+class InstrumentedCursor:
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    # multi is only passed on when it is set, since newer connectors'
+    # execute() has no multi keyword
+    def execute(self, operation, params=None, multi=False):
+        options = {'multi': True} if multi else {}
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, params, **options)
+        finally:
+            self._stats.observe(operation, time.perf_counter() - start, self._cursor.rowcount)
+
+    # mysql-connector sends an INSERT ... VALUES executemany as multi-row
+    # INSERTs; any other statement is sent once per parameter set
+    def executemany(self, operation, seq_params):
+        seq_params = list(seq_params)
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, seq_params)
+        finally:
+            round_trips = 1 if MULTI_ROW_INSERT.match(operation) else len(seq_params)
+            self._stats.observe(operation, time.perf_counter() - start, self._cursor.rowcount, round_trips)
+
+
+# Hands out instrumented cursors and times commits and rollbacks
+class InstrumentedConnection:
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self._stats)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return self._conn.commit()
+        finally:
+            self._stats.observe('COMMIT', time.perf_counter() - start)
+
+    def rollback(self):
+        start = time.perf_counter()
+        try:
+            return self._conn.rollback()
+        finally:
+            self._stats.observe('ROLLBACK', time.perf_counter() - start)
+
+
+def print_statement_report(stats, n=15):
+    print(f'\n-->  Top {n} statements by total time')
+    print(f"     {'calls':>8} {'total s':>9} {'p50 ms':>9} {'p99 ms':>9} {'rows':>10} {'trips':>8}   statement")
+    for statement, record in stats.top(n):
+        text = statement if len(statement) <= 100 else statement[:97] + '...'
+        print(f"     {record.calls:>8} {record.seconds:>9.3f} {record.quantile(0.5) * 1000:>9.3f} "
+              f"{record.quantile(0.99) * 1000:>9.3f} {record.rows:>10} {record.round_trips:>8}   {text}")
+
+
+def prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Renders the statistics in the Prometheus text exposition format
+def prometheus_text(stats, prefix='streamflix_sql'):
+    with stats.lock:
+        records = sorted(stats.records.items())
+    lines = [
+        f'# HELP {prefix}_statement_duration_seconds Time spent running each normalized statement.',
+        f'# TYPE {prefix}_statement_duration_seconds histogram',
+    ]
+    for statement, record in records:
+        label = f'statement="{prometheus_label(statement)}"'
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), record.buckets):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else f'{bound:g}'
+            lines.append(f'{prefix}_statement_duration_seconds_bucket{{{label},le="{le}"}} {cumulative}')
+        lines.append(f'{prefix}_statement_duration_seconds_sum{{{label}}} {record.seconds:.6f}')
+        lines.append(f'{prefix}_statement_duration_seconds_count{{{label}}} {record.calls}')
+
+    for metric, attribute, description in (('rows_total', 'rows', 'Rows affected by each normalized statement.'),
+                                           ('round_trips_total', 'round_trips',
+                                            'Client-server round trips made by each normalized statement.')):
+        lines.append(f'# HELP {prefix}_{metric} {description}')
+        lines.append(f'# TYPE {prefix}_{metric} counter')
+        for statement, record in records:
+            lines.append(f'{prefix}_{metric}{{statement="{prometheus_label(statement)}"}} {getattr(record, attribute)}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(stats, path):
+    with open(path, 'w') as metrics_file:
+        metrics_file.write(prometheus_text(stats))
@@ -0,0 +1,142 @@
+'''
+   Streamflix Database Partitions
+   Script: partitions.py
+   Description: Splits User_Metrics into monthly partitions on start_time,
+                adds the partitions of the coming months, and drops the
+                partitions that have aged out of the retention window.
+   Authors: Ashley Davis
+'''
+
+from datetime import date, datetime
+import argparse, os, sys
+
+PARTITIONED_TABLE = 'User_Metrics'
+
+# Months ahead of the current one that always have a partition, and months
+# of sessions kept before their partitions are dropped. The daily rollups
+# of a dropped month are kept
+FUTURE_MONTHS = int(os.getenv('STREAMFLIX_PARTITION_FUTURE_MONTHS', 3))
+RETENTION_MONTHS = int(os.getenv('STREAMFLIX_PARTITION_RETENTION_MONTHS', 24))
+
+# Takes the sessions past the last monthly partition, so an insert never
+# fails for want of a partition. It is split when new months are added
+CATCH_ALL = 'pfuture'
+
+
+def month_start(moment):
+    return date(moment.year, moment.month, 1)
+
+
+def add_months(month, count):
+    years, month_index = divmod(month.month - 1 + count, 12)
+    return date(month.year + years, month_index + 1, 1)
+
+
+def month_range(first_month, last_month):
+    month = first_month
+    while month <= last_month:
+        yield month
+        month = add_months(month, 1)
+
+
+# Partition pYYYYMM holds the sessions started before the next month. Range
+# partitions only have an upper bound, so the first one also holds anything
+# older
+def partition_definition(month):
+    return (f"PARTITION p{month:%Y%m} "
+            f"VALUES LESS THAN (UNIX_TIMESTAMP('{add_months(month, 1):%Y-%m-%d} 00:00:00'))")
+
+
+def partition_definitions(months):
+    return ', '.join([partition_definition(month) for month in months]
+                     + [f'PARTITION {CATCH_ALL} VALUES LESS THAN MAXVALUE'])
+
+
+# Partitions the table by month from first_month to last_month. The table
+# is rebuilt, so this is meant for a freshly created, empty table
+def partition_table(conn, cursor, first_month, last_month):
+    months = list(month_range(month_start(first_month), month_start(last_month)))
+    cursor.execute(f'ALTER TABLE {PARTITIONED_TABLE} PARTITION BY RANGE (UNIX_TIMESTAMP(start_time)) '
+                   f'({partition_definitions(months)})')
+    print(f"-->  {PARTITIONED_TABLE} partitioned by month from {months[0]:%Y-%m} to {months[-1]:%Y-%m}")
+    return months
+
+
+# Returns [(month, rows)] for the monthly partitions in order, without the
+# catch-all. Row counts are the server's estimates. Empty when the table
+# is not partitioned
+def partition_months(cursor):
+    cursor.execute('''
+        SELECT PARTITION_NAME, TABLE_ROWS
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    ''', (PARTITIONED_TABLE,))
+    return [(datetime.strptime(name, 'p%Y%m').date(), rows)
+            for name, rows in cursor.fetchall() if name != CATCH_ALL]
+
+
+# Adds partitions up to future_months past the month of today, splitting
+# them off the catch-all, and drops the partitions whose sessions all
+# started more than retention_months before it (None keeps everything).
+# Returns the (added, dropped) months, or None when the table is not
+# partitioned
+def maintain_partitions(conn, cursor, today=None, future_months=FUTURE_MONTHS, retention_months=RETENTION_MONTHS):
+    months = [month for month, _ in partition_months(cursor)]
+    if not months:
+        print(f"-->  {PARTITIONED_TABLE} is not partitioned")
+        return None
+    current = month_start(today or date.today())
+
+    added = list(month_range(add_months(months[-1], 1), add_months(current, future_months)))
+    if added:
+        cursor.execute(f'ALTER TABLE {PARTITIONED_TABLE} REORGANIZE PARTITION {CATCH_ALL} '
+                       f'INTO ({partition_definitions(added)})')
+        print(f"-->  Added {PARTITIONED_TABLE} partitions {added[0]:%Y-%m} to {added[-1]:%Y-%m}")
+
+    dropped = []
+    if retention_months is not None:
+        cutoff = add_months(current, -retention_months)
+        dropped = [month for month in months if month < cutoff]
+        if dropped:
+            cursor.execute(f"ALTER TABLE {PARTITIONED_TABLE} DROP PARTITION "
+                           f"{', '.join(f'p{month:%Y%m}' for month in dropped)}")
+            print(f"-->  Dropped {PARTITIONED_TABLE} partitions {dropped[0]:%Y-%m} to {dropped[-1]:%Y-%m}")
+
+    if not added and not dropped:
+        print(f"-->  {PARTITIONED_TABLE} partitions already up to date")
+    return added, dropped
+
+
+def print_partitions(conn, cursor):
+    months = partition_months(cursor)
+    if not months:
+        print(f"-->  {PARTITIONED_TABLE} is not partitioned")
+    for month, rows in months:
+        print(f"p{month:%Y%m}  {rows:>12} rows")
+    return months
+
+
+def main(argv=None):
+    # Imported here rather than at the top, as data_generation partitions
+    # the table with this module when it creates the schema
+    from data_generation import with_db_connection
+
+    parser = argparse.ArgumentParser(description='Maintains the monthly partitions of User_Metrics.')
+    parser.add_argument('command', choices=('maintain', 'show'),
+                        help="'maintain' adds the coming months and drops the expired ones, "
+                             "'show' lists the partitions")
+    parser.add_argument('--future-months', type=int, default=FUTURE_MONTHS,
+                        help=f'months ahead that get a partition (default: {FUTURE_MONTHS})')
+    parser.add_argument('--retention-months', type=int, default=RETENTION_MONTHS,
+                        help=f'months of sessions kept (default: {RETENTION_MONTHS}, 0 keeps everything)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'show':
+        return 0 if with_db_connection(print_partitions)() else 1
+    maintained = with_db_connection(maintain_partitions)(None, args.future_months, args.retention_months or None)
+    return 0 if maintained is not None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+'''
+   Streamflix Database Query Plan Tests
+   Script: plan_test.py
+   Description: Checks that the data_test.py check queries are planned
+                against indexes rather than full table scans or filesorts
+   Authors: Ashley Davis
+'''
+
+from data_generation import with_db_connection
+from data_test import CHUNK_SIZE, all_checks
+import argparse, json, os, sys
+
+# Estimated rows above which a full table scan or a filesort fails a plan
+ROW_THRESHOLD = int(os.getenv('STREAMFLIX_PLAN_ROW_THRESHOLD', 1000))
+
+# Largest row estimate anywhere under a node of the plan
+def estimated_rows(node):
+    if isinstance(node, list):
+        return max((estimated_rows(child) for child in node), default=0)
+    if not isinstance(node, dict):
+        return 0
+    rows = max(node.get('rows_examined_per_scan', 0), node.get('rows_produced_per_join', 0))
+    return max([rows] + [estimated_rows(child) for child in node.values()])
+
+
+# Walks an EXPLAIN FORMAT=JSON plan. Returns the tables it reads as
+# (table, access type, key, estimated rows), and the estimated rows
+# behind each filesort
+def plan_operations(plan):
+    tables = []
+    filesorts = []
+
+    def visit(node):
+        if isinstance(node, list):
+            for child in node:
+                visit(child)
+            return
+        if not isinstance(node, dict):
+            return
+        if 'access_type' in node:
+            tables.append((node.get('table_name'), node['access_type'], node.get('key'),
+                           node.get('rows_examined_per_scan', 0)))
+        if node.get('using_filesort'):
+            filesorts.append(estimated_rows(node))
+        for child in node.values():
+            visit(child)
+
+    visit(plan)
+    return tables, filesorts
+
+
+# Returns what is wrong with a plan at the given row threshold
+def plan_problems(plan, threshold=ROW_THRESHOLD):
+    tables, filesorts = plan_operations(plan)
+    problems = []
+    for table, access_type, _, rows in tables:
+        if access_type == 'ALL' and rows > threshold:
+            problems.append(f"full table scan of {table} (~{rows} rows)")
+    for rows in filesorts:
+        if rows > threshold:
+            problems.append(f"filesort of ~{rows} rows")
+    return problems
+
+
+@with_db_connection
+def explain(conn, cursor, query, params=()):
+    cursor.execute(f'EXPLAIN FORMAT=JSON {query.strip()}', params)
+    return json.loads(cursor.fetchone()[0])
+
+
+# Chunked checks are explained over their first chunk of keys
+def check_plan(check, threshold):
+    name = check.name
+    plan = explain(check.query, (1, CHUNK_SIZE) if check.chunk_key else ())
+    label = f"{name} plan"
+    if plan is None:
+        print(f"{label}: \033[31mFAIL\033[0m")
+        return False
+
+    problems = plan_problems(plan, threshold)
+    if not problems:
+        print(f"{label}: \033[32mPASS\033[0m")
+        return True
+
+    print(f"{label}: \033[31mFAIL\033[0m")
+    for problem in problems:
+        print(f"     {problem}")
+    for table, access_type, key, rows in plan_operations(plan)[0]:
+        print(f"     {table:<18} {access_type:<8} key={key or '-':<24} ~{rows} rows")
+    return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checks the query plans of the data_test.py checks.')
+    parser.add_argument('--threshold', type=int, default=ROW_THRESHOLD,
+                        help='estimated rows above which a full table scan or filesort fails '
+                             f'(default: STREAMFLIX_PLAN_ROW_THRESHOLD or {ROW_THRESHOLD})')
+    args = parser.parse_args(argv)
+
+    results = [check_plan(check, args.threshold) for check in all_checks()]
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+   print('Checking Query Plans...\n')
+   sys.exit(main())
@@ -0,0 +1,267 @@
+'''
+   Streamflix Database Playback Stream
+   Script: playback_stream.py
+   Description: Streams generated User_Metrics playback sessions into the
+                database at a target rate, in micro-batches, for load testing.
+   Authors: Ashley Davis
+'''
+
+from data_generation import FLUSH_BATCH_SIZE, configure_pool, draw_ids, table_ids, with_db_connection
+from instrumentation import StatementRecord
+from aggregates import refresh_aggregates
+from partitions import maintain_partitions
+from rollups import rollup_days
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+import numpy as np
+import argparse, queue, sys, threading, time
+
+# Interval at which events are emitted; each tick emits the events due since
+# the last one in a single vectorized draw
+TICK_SECONDS = 0.01
+
+INSERT_METRICS = '''
+    INSERT INTO User_Metrics (start_time, end_time, duration, completed, content_id, user_id)
+    VALUES (%s, %s, %s, %s, %s, %s)
+'''
+
+# Rows written in one transaction, and the (emit time, events) of each tick
+# they came from, for the end-to-end latency
+MicroBatch = namedtuple('MicroBatch', ['rows', 'ticks'])
+
+
+# Counters shared by the producer, the writers, and the reporter. Latencies,
+# from a tick's emission to the commit of its rows, are kept per tick in the
+# same histograms as the statement instrumentation, for the current report
+# interval and for the whole run
+class StreamStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.emitted = self.written = self.batches = 0
+        self.throttled_seconds = 0.0
+        self.latency = StatementRecord()
+        self.interval_latency = StatementRecord()
+
+    def emitted_events(self, count):
+        with self.lock:
+            self.emitted += count
+
+    def throttled(self, seconds):
+        with self.lock:
+            self.throttled_seconds += seconds
+
+    def committed(self, batch, committed_at):
+        with self.lock:
+            self.written += len(batch.rows)
+            self.batches += 1
+            for emitted_at, _ in batch.ticks:
+                self.latency.observe(committed_at - emitted_at, 0, 0)
+                self.interval_latency.observe(committed_at - emitted_at, 0, 0)
+
+    # Returns the totals so far and the latency histogram of the interval
+    # since the last snapshot
+    def snapshot(self):
+        with self.lock:
+            interval_latency, self.interval_latency = self.interval_latency, StatementRecord()
+            return self.emitted, self.written, self.batches, self.throttled_seconds, interval_latency
+
+
+@with_db_connection
+def load_ids(conn, cursor):
+    return table_ids(cursor, 'User'), table_ids(cursor, 'Video_Content')
+
+
+# Draws count sessions that have just ended: 10 to 240 minutes long, ending
+# at now, with duration matching their start and end times exactly
+def playback_rows(rng, count, user_ids, content_ids, now):
+    durations = rng.integers(10 * 60, 240 * 60 + 1, count)
+    end_time = np.datetime64(now, 's')
+    start_times = end_time - durations.astype('timedelta64[s]')
+    return list(zip(start_times.tolist(), [end_time.tolist()] * count, durations.tolist(),
+                    (rng.random(count) < 0.5).tolist(), draw_ids(rng, content_ids, count).tolist(),
+                    draw_ids(rng, user_ids, count).tolist()))
+
+
+# Emits events at rate per second and hands them to the writers in batches
+# of batch_size rows, or fewer once the oldest row has waited max_delay
+# seconds. The queue holds at most max_pending batches: when the writers
+# fall behind, putting a batch blocks, and the events that would have been
+# emitted meanwhile are skipped rather than made up in a burst afterwards.
+# Emission ends when stop is set; the rows already emitted are still handed
+# over unless every writer has failed
+def produce(batches, stats, stop, failed, rng, user_ids, content_ids, rate, batch_size, max_delay, deadline):
+    rows, ticks = [], []
+    oldest = None
+    last_tick = time.monotonic()
+    owed = 0.0
+
+    def hand_over():
+        nonlocal rows, ticks, oldest
+        batch = MicroBatch(rows, ticks)
+        rows, ticks, oldest = [], [], None
+        blocked_from = time.monotonic()
+        while not failed.is_set():
+            try:
+                batches.put(batch, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        blocked = time.monotonic() - blocked_from
+        if blocked > TICK_SECONDS:
+            stats.throttled(blocked)
+        return blocked
+
+    while not stop.is_set() and (deadline is None or time.monotonic() < deadline):
+        now = time.monotonic()
+        owed = min(owed + rate * (now - last_tick), batch_size)
+        last_tick = now
+        count = int(owed)
+        if count:
+            owed -= count
+            rows.extend(playback_rows(rng, count, user_ids, content_ids, datetime.now()))
+            ticks.append((now, count))
+            stats.emitted_events(count)
+            if oldest is None:
+                oldest = now
+        if rows and (len(rows) >= batch_size or now - oldest >= max_delay):
+            if hand_over() > TICK_SECONDS:
+                last_tick = time.monotonic()
+        time.sleep(max(0.0, last_tick + TICK_SECONDS - time.monotonic()))
+
+    if rows:
+        hand_over()
+
+
+# Writes batches from the queue until it receives None. Each writer keeps
+# one pooled connection and commits every batch as its own transaction
+@with_db_connection
+def write_batches(conn, cursor, batches, stats):
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return True
+        for start in range(0, len(batch.rows), FLUSH_BATCH_SIZE):
+            cursor.executemany(INSERT_METRICS, batch.rows[start:start + FLUSH_BATCH_SIZE])
+        conn.commit()
+        stats.committed(batch, time.monotonic())
+
+
+def print_progress(stats, previous, elapsed, interval, queued):
+    emitted, written, batches, throttled, latency = stats.snapshot()
+    print(f"-->  {elapsed:>7.1f}s  emitted {(emitted - previous[0]) / interval:>9.0f}/s  "
+          f"written {(written - previous[1]) / interval:>9.0f}/s  batches {batches - previous[2]:>5}  "
+          f"queued {queued:>3}  throttled {min(1.0, (throttled - previous[3]) / interval):>4.0%}  "
+          f"latency p50 {latency.quantile(0.5) * 1000:>8.1f}ms p99 {latency.quantile(0.99) * 1000:>8.1f}ms")
+    return emitted, written, batches, throttled
+
+
+def print_summary(stats, seconds):
+    print(f"\n-->  Emitted {stats.emitted} sessions and wrote {stats.written} in {stats.batches} batches "
+          f"over {seconds:.1f}s")
+    print(f"     throughput {stats.written / seconds:.0f} rows/s, throttled {stats.throttled_seconds:.1f}s, "
+          f"latency p50 {stats.latency.quantile(0.5) * 1000:.1f}ms p99 {stats.latency.quantile(0.99) * 1000:.1f}ms "
+          f"max {stats.latency.slowest * 1000:.1f}ms")
+
+
+# Runs the stream until duration seconds have passed, or until interrupted
+# when duration is None, and returns its StreamStats
+def run_stream(rate, duration=None, batch_size=5000, max_delay=0.25, writers=4, max_pending=8,
+               report_interval=1.0, seed=None):
+    configure_pool(writers + 1)
+    ids = load_ids()
+    if ids is None:
+        raise SystemExit("Could not read the User and Video_Content IDs")
+    user_ids, content_ids = ids
+    if not len(user_ids) or not len(content_ids):
+        raise SystemExit("Generate the data before streaming playback sessions")
+
+    # Sessions end at the current time, so the partitions of this month and
+    # the next few are made sure of before streaming. Nothing is dropped here
+    with_db_connection(maintain_partitions)(retention_months=None)
+
+    stats = StreamStats()
+    stop = threading.Event()
+    failed = threading.Event()
+    batches = queue.Queue(maxsize=max_pending)
+    deadline = None if duration is None else stats.start + duration
+    rng = np.random.default_rng(seed)
+
+    failures = []
+
+    # A writer that fails stops the emission, and once every writer has
+    # failed, nothing waits on the queue any more
+    def writer():
+        if write_batches(batches, stats) is None:
+            stop.set()
+            failures.append(True)
+            if len(failures) == writers:
+                failed.set()
+
+    with ThreadPoolExecutor(max_workers=writers + 1) as executor:
+        for _ in range(writers):
+            executor.submit(writer)
+        producer = executor.submit(produce, batches, stats, stop, failed, rng, user_ids, content_ids, rate,
+                                   batch_size, max_delay, deadline)
+        previous = (0, 0, 0, 0.0)
+        next_report = stats.start + report_interval
+        try:
+            while not producer.done():
+                time.sleep(max(0.0, min(next_report - time.monotonic(), 0.1)))
+                if time.monotonic() >= next_report:
+                    previous = print_progress(stats, previous, next_report - stats.start, report_interval,
+                                              batches.qsize())
+                    next_report += report_interval
+        except KeyboardInterrupt:
+            print("\n-->  Stopping: flushing the batches already emitted")
+        stop.set()
+        producer.result()
+        for _ in range(writers):
+            while not failed.is_set():
+                try:
+                    batches.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    print_summary(stats, time.monotonic() - stats.start)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Streams generated playback sessions into User_Metrics for load testing.')
+    parser.add_argument('--rate', type=float, default=1000, help='sessions emitted per second (default: 1000)')
+    parser.add_argument('--duration', type=float,
+                        help='seconds to stream for (default: until interrupted with Ctrl-C)')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='most rows written per transaction (default: 5000)')
+    parser.add_argument('--max-delay', type=float, default=0.25,
+                        help='seconds a session may wait for its batch to fill (default: 0.25)')
+    parser.add_argument('--writers', type=int, default=4,
+                        help='batches written at the same time, each on its own connection (default: 4)')
+    parser.add_argument('--max-pending', type=int, default=8,
+                        help='batches waiting for a writer before generation is slowed down (default: 8)')
+    parser.add_argument('--report-interval', type=float, default=1.0,
+                        help='seconds between progress reports (default: 1)')
+    parser.add_argument('--seed', type=int, help='seed for the generated sessions')
+    parser.add_argument('--refresh-aggregates', action='store_true',
+                        help='fold the streamed sessions into Content_Stats and User_Stats, and recompute '
+                             'the daily rollups of the days they started on, once streaming stops')
+    args = parser.parse_args(argv)
+
+    first_day = date.today() - timedelta(days=1)
+    stats = run_stream(args.rate, args.duration, args.batch_size, args.max_delay, args.writers, args.max_pending,
+                       args.report_interval, args.seed)
+    # Writers commit out of metric_id order, so the aggregates are only
+    # refreshed once every batch has been committed. Sessions last up to
+    # four hours, so the first ones may have started the day before
+    if args.refresh_aggregates:
+        with_db_connection(refresh_aggregates)()
+        with_db_connection(rollup_days)(first_day, date.today())
+    return 0 if stats.written == stats.emitted else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+'''
+   Streamflix Database Daily Rollups
+   Script: rollups.py
+   Description: Rolls the User_Metrics sessions up into per-user and
+                per-title daily totals in Daily_User_Activity and
+                Daily_Content_Activity.
+   Authors: Ashley Davis
+'''
+
+from partitions import add_months, month_start
+from datetime import date, datetime, timedelta
+import argparse, sys, time
+
+USER_DAYS = '''
+    INSERT INTO Daily_User_Activity (user_id, activity_date, sessions, watch_seconds, completed_sessions,
+                                     distinct_titles)
+    SELECT user_id, DATE(start_time), COUNT(*), SUM(duration), SUM(completed), COUNT(DISTINCT content_id)
+    FROM User_Metrics
+    WHERE start_time >= %s AND start_time < %s AND user_id IS NOT NULL
+    GROUP BY user_id, DATE(start_time)
+'''
+
+CONTENT_DAYS = '''
+    INSERT INTO Daily_Content_Activity (content_id, activity_date, sessions, watch_seconds, completed_sessions,
+                                        distinct_viewers)
+    SELECT content_id, DATE(start_time), COUNT(*), SUM(duration), SUM(completed), COUNT(DISTINCT user_id)
+    FROM User_Metrics
+    WHERE start_time >= %s AND start_time < %s AND content_id IS NOT NULL
+    GROUP BY content_id, DATE(start_time)
+'''
+
+# {rollup table: statement recomputing it for a range of start times}
+ROLLUPS = {
+    'Daily_User_Activity': USER_DAYS,
+    'Daily_Content_Activity': CONTENT_DAYS,
+}
+
+
+# Recomputes the rollups of every day from first_day to last_day, one
+# calendar month per transaction. Days are replaced as a whole rather than
+# added to, so rerunning a day is harmless and the distinct counts stay
+# exact. A month's days are grouped in one pass per rollup table, and a
+# month is one User_Metrics partition, so each pass reads its sessions
+# once, through the start_time index. Returns the days rolled up
+def rollup_days(conn, cursor, first_day, last_day):
+    start = time.perf_counter()
+    month_first = first_day
+    while month_first <= last_day:
+        month_last = min(last_day, add_months(month_start(month_first), 1) - timedelta(days=1))
+        sessions_from = datetime.combine(month_first, datetime.min.time())
+        sessions_until = datetime.combine(month_last + timedelta(days=1), datetime.min.time())
+        for table, statement in ROLLUPS.items():
+            cursor.execute(f'DELETE FROM {table} WHERE activity_date BETWEEN %s AND %s', (month_first, month_last))
+            cursor.execute(statement, (sessions_from, sessions_until))
+        conn.commit()
+        month_first = month_last + timedelta(days=1)
+    days = (last_day - first_day).days + 1
+    print(f"-->  Rolled up {max(days, 0)} days of sessions in {time.perf_counter() - start:.2f}s")
+    return max(days, 0)
+
+
+# Recomputes the rollups of every day with sessions
+def rebuild_rollups(conn, cursor):
+    for table in ROLLUPS:
+        cursor.execute(f'TRUNCATE TABLE {table}')
+    cursor.execute('SELECT MIN(start_time), MAX(start_time) FROM User_Metrics')
+    first, last = cursor.fetchone()
+    conn.commit()
+    if first is None:
+        print("-->  No sessions to roll up")
+        return 0
+    return rollup_days(conn, cursor, first.date(), last.date())
+
+
+def main(argv=None):
+    # Imported here rather than at the top, as data_generation builds the
+    # rollups with this module after generating the data
+    from data_generation import with_db_connection
+
+    today = date.today()
+    parser = argparse.ArgumentParser(description='Rolls User_Metrics up into daily per-user and per-title totals.')
+    parser.add_argument('command', choices=('refresh', 'rebuild'),
+                        help="'refresh' recomputes the days from --since to --until, "
+                             "'rebuild' recomputes every day with sessions")
+    parser.add_argument('--since', type=date.fromisoformat, default=today - timedelta(days=1),
+                        help='first day to recompute, as YYYY-MM-DD (default: yesterday, as sessions are '
+                             'written when they end and may have started before midnight)')
+    parser.add_argument('--until', type=date.fromisoformat, default=today,
+                        help='last day to recompute, as YYYY-MM-DD (default: today)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'rebuild':
+        days = with_db_connection(rebuild_rollups)()
+    else:
+        days = with_db_connection(rollup_days)(args.since, args.until)
+    return 0 if days is not None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
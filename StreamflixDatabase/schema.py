@@ -0,0 +1,128 @@
+'''
+   Streamflix Database Schema
+   Script: schema.py
+   Description: Reads the table definitions and foreign keys out of the
+                Streamflix schema script, and splits it for bulk loading.
+   Authors: Ashley Davis
+'''
+
+import re
+
+SCHEMA_FILE = 'StreamflixDatabase/streamflix-db.sql'
+
+TABLE_PATTERN = re.compile(r'CREATE TABLE IF NOT EXISTS `(\w+)`\s*\((.*?)\n\);', re.DOTALL)
+FOREIGN_KEY_PATTERN = re.compile(r'FOREIGN KEY \((\w+)\) REFERENCES `(\w+)`\s*\((\w+)\)')
+PRIMARY_KEY_PATTERN = re.compile(r'PRIMARY KEY \(([\w\s,]+)\)')
+
+# Table definitions that the bulk schema mode adds after the load
+DEFERRED_DEFINITIONS = ('FOREIGN KEY', 'INDEX', 'KEY', 'UNIQUE', 'FULLTEXT')
+
+SCHEMA_MODES = ('standard', 'bulk')
+
+
+def read_schema(path=SCHEMA_FILE):
+    with open(path, 'r') as sql_file:
+        return sql_file.read()
+
+
+# Returns {table: definition body} for every CREATE TABLE in the script
+def table_definitions(schema):
+    return {table: body for table, body in TABLE_PATTERN.findall(schema)}
+
+
+# References the schema cannot declare, as (table, column, referenced
+# table, referenced column): partitioned tables cannot have foreign keys.
+# They still order the generation stages and are still checked for orphans
+UNDECLARED_FOREIGN_KEYS = (
+    ('User_Metrics', 'content_id', 'Video_Content', 'content_id'),
+    ('User_Metrics', 'user_id', 'User', 'user_id'),
+)
+
+
+# Returns {table: {referenced tables}} from the foreign keys
+def foreign_keys(schema):
+    references = {table: set() for table in table_definitions(schema)}
+    for table, _, parent, _ in foreign_key_columns(schema):
+        references[table].add(parent)
+    return references
+
+
+# Returns (table, column, referenced table, referenced column) for every
+# FOREIGN KEY clause, in schema order, then for the undeclared references
+def foreign_key_columns(schema):
+    definitions = table_definitions(schema)
+    declared = [(table, column, parent, parent_column)
+                for table, body in definitions.items()
+                for column, parent, parent_column in FOREIGN_KEY_PATTERN.findall(body)]
+    return declared + [key for key in UNDECLARED_FOREIGN_KEYS if key[0] in definitions]
+
+
+# Splits a CREATE TABLE body on the commas between its definitions
+def table_items(body):
+    items = []
+    depth = start = 0
+    for position, char in enumerate(body):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(body[start:position])
+            start = position + 1
+    items.append(body[start:])
+    return [item.strip() for item in items if item.strip()]
+
+
+# Returns {table: [primary key columns]}
+def primary_keys(schema):
+    keys = {}
+    for table, body in table_definitions(schema).items():
+        match = PRIMARY_KEY_PATTERN.search(body)
+        keys[table] = [column.strip() for column in match.group(1).split(',')] if match else []
+    return keys
+
+
+# Returns {table: {column: SQL type}}, with the type upper-cased and
+# without its length or values, e.g. 'VARCHAR' or 'ENUM'
+def column_types(schema):
+    types = {}
+    for table, body in table_definitions(schema).items():
+        types[table] = {}
+        for item in table_items(body):
+            if not item.upper().startswith(DEFERRED_DEFINITIONS + ('PRIMARY KEY',)):
+                column, sql_type = item.split()[:2]
+                types[table][column] = sql_type.split('(')[0].upper()
+    return types
+
+
+# Splits the schema for the bulk schema mode. Returns the script with each
+# table reduced to its columns and primary key, and {table: ALTER TABLE
+# statement} adding its secondary indexes and foreign keys back afterwards
+def defer_constraints(schema):
+    deferred = {}
+
+    def bare_table(match):
+        table, body = match.groups()
+        columns = []
+        for item in table_items(body):
+            if item.upper().startswith(DEFERRED_DEFINITIONS):
+                deferred.setdefault(table, []).append(' '.join(item.split()))
+            else:
+                columns.append(item)
+        return f'CREATE TABLE IF NOT EXISTS `{table}`\n(\n    ' + ',\n    '.join(columns) + '\n);'
+
+    bare_schema = TABLE_PATTERN.sub(bare_table, schema)
+    return bare_schema, {table: f'ALTER TABLE `{table}` ADD ' + ', ADD '.join(definitions)
+                         for table, definitions in deferred.items()}
+
+
+# Counts the rows of a table whose foreign key matches no referenced row.
+# With a range column, only the rows with that column BETWEEN two query
+# parameters are counted
+def orphan_query(table, column, parent, parent_column, range_column=None):
+    query = (f'SELECT COUNT(*) FROM `{table}` child LEFT JOIN `{parent}` parent '
+             f'ON child.{column} = parent.{parent_column} '
+             f'WHERE child.{column} IS NOT NULL AND parent.{parent_column} IS NULL')
+    if range_column:
+        query += f' AND child.{range_column} BETWEEN %s AND %s'
+    return query
@@ -0,0 +1,306 @@
+'''
+   Streamflix Database Title Search
+   Script: search.py
+   Description: Ranked keyword search over Video_Content titles and
+                descriptions, through the FULLTEXT index or, for databases
+                without one, an inverted index kept on disk.
+   Authors: Ashley Davis
+'''
+
+from data_generation import database_identity, with_db_connection
+from catalog_queries import CatalogQueries
+from collections import namedtuple
+import numpy as np
+import mysql.connector
+import argparse, hashlib, os, re, sys, time
+
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'search_cache')
+
+# Bump when the index layout or tokenization changes, so older caches are
+# not reused
+SEARCH_INDEX_VERSION = 1
+
+CONTENT_TYPES = ('Movie', 'Series')
+
+# A title word counts as many times as TITLE_WEIGHT description words.
+# BM25_K1 and BM25_B are the usual term frequency saturation and length
+# normalization of BM25
+TITLE_WEIGHT = 3
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r'\w+')
+STOPWORDS = frozenset('''a an and are as at be by for from has he her his in is it its of on or that the their
+                         they this to was were while who will with'''.split())
+
+SearchResult = namedtuple('SearchResult', ['content_id', 'title', 'release_year', 'content_type', 'relevance'])
+
+CATALOG_ROWS = '''
+    SELECT vc.content_id, vc.title, vc.description, vc.release_year,
+           CASE WHEN EXISTS (SELECT 1 FROM Movie m WHERE m.content_id = vc.content_id) THEN 'Movie'
+                WHEN EXISTS (SELECT 1 FROM Series s WHERE s.content_id = vc.content_id) THEN 'Series'
+           END AS content_type
+    FROM Video_Content vc
+    ORDER BY vc.content_id
+'''
+
+# Changes whenever titles are added or removed or their genres or types
+# change. Titles are not edited after they are loaded, so their text is
+# not read
+CATALOG_FINGERPRINT = '''
+    SELECT (SELECT COUNT(*) FROM Video_Content), (SELECT MAX(content_id) FROM Video_Content),
+           (SELECT COUNT(*) FROM Content_Genre), (SELECT COUNT(*) FROM Movie), (SELECT COUNT(*) FROM Series)
+'''
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall((text or '').lower())
+            if len(token) > 1 and token not in STOPWORDS]
+
+
+# Groups (key, document) pairs into sorted keys with a postings list each:
+# the documents of keys[i] are documents[offsets[i]:offsets[i + 1]], in
+# document order, with their summed weights
+def postings(keys, documents, weights):
+    if not len(keys):
+        return keys, np.zeros(1, dtype=np.int64), documents, weights
+    order = np.lexsort((documents, keys))
+    keys, documents, weights = keys[order], documents[order], weights[order]
+    starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]) | (documents[1:] != documents[:-1])])
+    keys, documents, weights = keys[starts], documents[starts], np.add.reduceat(weights, starts)
+    unique_keys, first = np.unique(keys, return_index=True)
+    return unique_keys, np.r_[first, len(keys)], documents, weights
+
+
+# An inverted index of the catalog, held as flat NumPy arrays so that it
+# saves to, and loads from, a single .npz file without pickling. Documents
+# are the titles in content_id order, and each term's postings give the
+# titles containing it with its weighted count. Genre postings work the
+# same way and serve the genre filter
+class SearchIndex:
+    FIELDS = ('content_ids', 'titles', 'release_years', 'content_types', 'lengths', 'terms', 'term_offsets',
+              'term_documents', 'term_weights', 'genres', 'genre_offsets', 'genre_documents')
+
+    def __init__(self, **arrays):
+        for field in self.FIELDS:
+            setattr(self, field, arrays[field])
+        self.average_length = float(self.lengths.mean()) if len(self.lengths) else 0.0
+
+    @classmethod
+    def build(cls, catalog_rows, genre_rows):
+        content_ids, titles, descriptions, release_years, content_types = list(zip(*catalog_rows)) or [()] * 5
+        content_ids = np.array(content_ids, dtype=np.int64)
+        keys, documents, weights = [], [], []
+        for document, (title, description) in enumerate(zip(titles, descriptions)):
+            for text, weight in ((title, TITLE_WEIGHT), (description, 1)):
+                tokens = tokenize(text)
+                keys.extend(tokens)
+                documents.extend([document] * len(tokens))
+                weights.extend([weight] * len(tokens))
+        documents = np.array(documents, dtype=np.int64)
+        weights = np.array(weights, dtype=np.float32)
+        terms, term_offsets, term_documents, term_weights = postings(np.array(keys, dtype=str), documents, weights)
+
+        genre_ids, genre_names = list(zip(*genre_rows)) or [()] * 2
+        genre_ids = np.array(genre_ids, dtype=np.int64)
+        genre_documents = np.searchsorted(content_ids, genre_ids)
+        known = genre_documents < len(content_ids)
+        known[known] = content_ids[genre_documents[known]] == genre_ids[known]
+        genres, genre_offsets, genre_documents, _ = postings(
+            np.array([name.lower() for name in genre_names], dtype=str)[known], genre_documents[known],
+            np.ones(int(known.sum()), dtype=np.float32))
+
+        return cls(content_ids=content_ids, titles=np.array(titles, dtype=str),
+                   release_years=np.array([year or '' for year in release_years], dtype=str),
+                   content_types=np.array([content_type or '' for content_type in content_types], dtype=str),
+                   lengths=np.bincount(documents, weights, minlength=len(content_ids)).astype(np.float32),
+                   terms=terms, term_offsets=term_offsets, term_documents=term_documents.astype(np.int32),
+                   term_weights=term_weights, genres=genres, genre_offsets=genre_offsets,
+                   genre_documents=genre_documents.astype(np.int32))
+
+    def save(self, path):
+        with open(path, 'wb') as index_file:
+            np.savez(index_file, **{field: getattr(self, field) for field in self.FIELDS})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(**{field: arrays[field] for field in cls.FIELDS})
+
+    # Returns the slice of the postings arrays holding a key's postings,
+    # empty when the key is not indexed
+    @staticmethod
+    def lookup(keys, offsets, key):
+        position = np.searchsorted(keys, key)
+        if position == len(keys) or keys[position] != key:
+            return slice(0, 0)
+        return slice(offsets[position], offsets[position + 1])
+
+    # Scores the titles against the query with BM25, keeps those passing the
+    # filters, and returns the best limit, most relevant first
+    def search(self, text, genre=None, content_type=None, limit=20):
+        documents = len(self.content_ids)
+        scores = np.zeros(documents)
+        for term in set(tokenize(text)):
+            matches = self.lookup(self.terms, self.term_offsets, term)
+            matched, frequency = self.term_documents[matches], self.term_weights[matches]
+            if not len(matched):
+                continue
+            idf = np.log(1 + (documents - len(matched) + 0.5) / (len(matched) + 0.5))
+            length = self.lengths[matched] / self.average_length
+            saturation = frequency + BM25_K1 * (1 - BM25_B + BM25_B * length)
+            scores[matched] += idf * frequency * (BM25_K1 + 1) / saturation
+
+        keep = scores > 0
+        if genre is not None:
+            in_genre = np.zeros(documents, dtype=bool)
+            in_genre[self.genre_documents[self.lookup(self.genres, self.genre_offsets, genre.lower())]] = True
+            keep &= in_genre
+        if content_type is not None:
+            keep &= self.content_types == content_type
+        candidates = np.flatnonzero(keep)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.lexsort((self.content_ids[candidates], -scores[candidates]))]
+        return tuple(SearchResult(int(self.content_ids[document]), str(self.titles[document]),
+                                  str(self.release_years[document]) or None,
+                                  str(self.content_types[document]) or None, float(scores[document]))
+                     for document in candidates)
+
+
+@with_db_connection
+def catalog_fingerprint(conn, cursor):
+    cursor.execute(CATALOG_FINGERPRINT)
+    return cursor.fetchone()
+
+
+@with_db_connection
+def build_search_index(conn, cursor):
+    cursor.execute(CATALOG_ROWS)
+    catalog_rows = cursor.fetchall()
+    cursor.execute('SELECT cg.content_id, g.name FROM Content_Genre cg JOIN Genre g ON cg.genre_id = g.genre_id')
+    return SearchIndex.build(catalog_rows, cursor.fetchall())
+
+
+# Returns the inverted index of the catalog as it is now. The index is
+# cached on disk under the database's identity and the catalog's
+# fingerprint, so it is only rebuilt after the catalog changes and never
+# reused for another database. An in-memory database has no identity
+# outside its process, so its index is not cached. Returns None if the
+# database cannot be read
+def load_search_index(rebuild=False):
+    fingerprint = catalog_fingerprint()
+    if fingerprint is None:
+        return None
+    identity = database_identity()
+    path = None
+    if identity is not None:
+        digest = hashlib.sha256(f'search-v{SEARCH_INDEX_VERSION}:{identity}:{fingerprint}'.encode()).hexdigest()
+        path = os.path.join(CACHE_DIRECTORY, f'search-index-{digest[:16]}.npz')
+        if os.path.exists(path) and not rebuild:
+            return SearchIndex.load(path)
+
+    start = time.perf_counter()
+    index = build_search_index()
+    if index is None:
+        return None
+    if path is not None:
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        index.save(path + '.tmp')
+        os.replace(path + '.tmp', path)
+    print(f"-->  Search index of {len(index.content_ids)} titles and {len(index.terms)} terms built "
+          f"in {time.perf_counter() - start:.2f}s")
+    return index
+
+
+# Databases without information_schema have no FULLTEXT indexes either, so
+# a failed probe is an answer rather than an error
+@with_db_connection
+def has_fulltext_index(conn, cursor):
+    try:
+        cursor.execute('''
+            SELECT COUNT(*)
+            FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Video_Content' AND INDEX_TYPE = 'FULLTEXT'
+        ''')
+    except mysql.connector.Error:
+        return False
+    return cursor.fetchone()[0] > 0
+
+
+# Keyword search over the catalog. The 'fulltext' backend runs the
+# search_titles lookup, so it shares the prepared statements and the
+# result cache of CatalogQueries. The 'index' backend searches the
+# inverted index in process. 'auto' uses the FULLTEXT index when the
+# database has one, which it does not until the bulk schema mode has
+# added the deferred indexes, or on a server without FULLTEXT support
+class TitleSearch:
+    def __init__(self, backend='auto', queries=None):
+        self.backend = backend
+        self.queries = queries
+        self.index = None
+
+    def resolve_backend(self):
+        if self.backend == 'auto':
+            self.backend = 'fulltext' if has_fulltext_index() else 'index'
+        return self.backend
+
+    # Returns up to limit SearchResults, most relevant first, optionally
+    # only in genre and of content_type ('Movie' or 'Series'), or None on
+    # a database error
+    def search(self, text, genre=None, content_type=None, limit=20):
+        if self.resolve_backend() == 'fulltext':
+            if self.queries is None:
+                self.queries = CatalogQueries()
+            rows = self.queries.run('search_titles', text, text, genre, genre, content_type, content_type, limit)
+            return None if rows is None else tuple(SearchResult(*row) for row in rows)
+        if self.index is None:
+            self.index = load_search_index()
+            if self.index is None:
+                return None
+        return self.index.search(text, genre, content_type, limit)
+
+    def close(self):
+        if self.queries is not None:
+            self.queries.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Searches the titles and descriptions of the catalog.')
+    parser.add_argument('query', help='keywords to search for')
+    parser.add_argument('--genre', help='only titles in this genre')
+    parser.add_argument('--type', choices=CONTENT_TYPES, help='only movies or only series')
+    parser.add_argument('--limit', type=int, default=20, help='most results returned (default: 20)')
+    parser.add_argument('--backend', choices=('auto', 'fulltext', 'index'), default='auto',
+                        help="'fulltext' uses the FULLTEXT index, 'index' the inverted index cached on disk, "
+                             "'auto' the FULLTEXT index when there is one (default: auto)")
+    parser.add_argument('--rebuild-index', action='store_true', help='rebuild the cached inverted index')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='run the search this many times, to compare cold and warm latency')
+    args = parser.parse_args(argv)
+
+    with TitleSearch(args.backend) as search:
+        if args.rebuild_index and search.resolve_backend() == 'index':
+            search.index = load_search_index(rebuild=True)
+        for attempt in range(args.repeat):
+            start = time.perf_counter()
+            results = search.search(args.query, args.genre, args.type, args.limit)
+            elapsed = time.perf_counter() - start
+            if results is None:
+                return 1
+            if attempt == 0:
+                for result in results:
+                    print(f"     {result.relevance:>8.3f}  {result.content_id:>7}  {result.title} "
+                          f"({result.release_year}, {result.content_type})")
+            print(f"-->  {len(results)} results from the {search.backend} backend in {elapsed * 1000:.3f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+'''
+   Streamflix Database Similar Titles
+   Script: similarity.py
+   Description: Computes the most similar titles of every Video_Content row
+                from the genres, actors, and directors they share, and keeps
+                them in Similar_Content for "more like this" lookups.
+   Authors: Ashley Davis
+'''
+
+from data_generation import with_db_connection
+from collections import namedtuple
+import numpy as np
+import scipy.sparse as sp
+import argparse, hashlib, os, sys, time
+
+# Similar titles kept per title
+TOP_K = int(os.getenv('STREAMFLIX_SIMILAR_TITLES', 20))
+
+# Titles scored against the whole catalog per sparse product. Titles that
+# share a genre share a feature, so a block's product holds up to
+# SIMILARITY_BLOCK_SIZE x titles scores
+SIMILARITY_BLOCK_SIZE = int(os.getenv('STREAMFLIX_SIMILARITY_BLOCK_SIZE', 256))
+
+# Rows per executemany, and IDs per IN list
+WRITE_BATCH_SIZE = 10000
+
+# {bridge table: feature column}. A title's features are the genres,
+# actors, and directors the bridges link it to
+FEATURE_SOURCES = {
+    'Content_Genre': 'genre_id',
+    'Content_Actor': 'actor_id',
+    'Content_Director': 'director_id',
+}
+
+INSERT_SIMILAR = '''
+    INSERT INTO Similar_Content (content_id, similar_rank, similar_content_id, score)
+    VALUES (%s, %s, %s, %s)
+'''
+
+# The catalog as a sparse matrix: one row per title, in content_id order,
+# and one column per feature. Each feature is weighted by its inverse
+# document frequency, so a shared director counts for more than a shared
+# genre, and each row has unit length, so the product of two rows is their
+# cosine similarity. signatures holds a digest of each title's features
+Features = namedtuple('Features', ['content_ids', 'matrix', 'signatures'])
+
+
+# Digest of each title's feature keys, as a signed 64-bit integer for a
+# BIGINT column. rows and keys are sorted by row, then key
+def feature_signatures(rows, keys, titles):
+    bounds = np.searchsorted(rows, np.arange(titles + 1))
+    return np.array([int.from_bytes(hashlib.blake2b(keys[bounds[row]:bounds[row + 1]].tobytes(),
+                                                    digest_size=8).digest(), 'big', signed=True)
+                     for row in range(titles)], dtype=np.int64)
+
+
+def load_features(cursor):
+    cursor.execute('SELECT content_id FROM Video_Content ORDER BY content_id')
+    content_ids = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+    # Feature keys carry their source in the high bits, so genre 7 and
+    # actor 7 stay apart
+    rows, keys = [], []
+    for source, (table, column) in enumerate(FEATURE_SOURCES.items()):
+        cursor.execute(f'SELECT content_id, {column} FROM {table}')
+        pairs = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+        positions = np.searchsorted(content_ids, pairs[:, 0])
+        known = positions < len(content_ids)
+        known[known] = content_ids[positions[known]] == pairs[known, 0]
+        rows.append(positions[known])
+        keys.append((source << 32) | pairs[known, 1])
+    rows, keys = np.concatenate(rows), np.concatenate(keys)
+    order = np.lexsort((keys, rows))
+    rows, keys = rows[order], keys[order]
+
+    feature_keys, columns = np.unique(keys, return_inverse=True)
+    matrix = sp.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(content_ids), len(feature_keys)))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1.0
+    document_frequency = matrix.getnnz(axis=0)
+    idf = np.log((1 + len(content_ids)) / (1 + document_frequency)) + 1
+    matrix = matrix @ sp.diags(idf)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    matrix = (sp.diags(np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)) @ matrix).tocsr()
+    return Features(content_ids, matrix, feature_signatures(rows, keys, len(content_ids)))
+
+
+# Scores the given rows against every title, block by block, and yields
+# the (row, similar row, rank, score) arrays of each row's k best matches.
+# The ranking is done for the whole block at once: the scores are sorted
+# by row, then best score first, and each score's rank is its offset from
+# the start of its row. Ties go to the lower content_id
+def top_similar(matrix, rows, k=TOP_K, block_size=SIMILARITY_BLOCK_SIZE):
+    transposed = matrix.T.tocsr()
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        scores = (matrix[block_rows] @ transposed).tocoo()
+        row, column, score = block_rows[scores.row], scores.col, scores.data
+        keep = (column != row) & (score > 0)
+        row, column, score = row[keep], column[keep], score[keep]
+        order = np.lexsort((column, -score, row))
+        row, column, score = row[order], column[order], score[order]
+        rank = np.arange(len(row)) - np.searchsorted(row, row)
+        best = rank < k
+        yield block_rows, row[best], column[best], rank[best] + 1, score[best]
+
+
+def id_batches(ids):
+    ids = [int(content_id) for content_id in ids]
+    for start in range(0, len(ids), WRITE_BATCH_SIZE):
+        yield ids[start:start + WRITE_BATCH_SIZE]
+
+
+# Replaces the similar titles of the given rows, one block per
+# transaction, so a title's list is never seen half written. Returns the
+# rows written
+def write_similar(conn, cursor, features, rows, k, block_size, replace=True):
+    content_ids = features.content_ids
+    written = 0
+    for block_rows, row, column, rank, score in top_similar(features.matrix, rows, k, block_size):
+        if replace:
+            for batch in id_batches(content_ids[block_rows]):
+                cursor.execute(f"DELETE FROM Similar_Content WHERE content_id IN ({', '.join(['%s'] * len(batch))})",
+                               batch)
+        similar = list(zip(content_ids[row].tolist(), rank.tolist(), content_ids[column].tolist(),
+                           score.tolist()))
+        for start in range(0, len(similar), WRITE_BATCH_SIZE):
+            cursor.executemany(INSERT_SIMILAR, similar[start:start + WRITE_BATCH_SIZE])
+        conn.commit()
+        written += len(similar)
+    return written
+
+
+# Records the signatures of the given rows once their lists are written,
+# and forgets the titles that no longer exist
+def write_signatures(conn, cursor, features, rows, removed=()):
+    signatures = list(zip(features.content_ids[rows].tolist(), features.signatures[rows].tolist()))
+    for start in range(0, len(signatures), WRITE_BATCH_SIZE):
+        cursor.executemany('REPLACE INTO Similarity_Signature (content_id, feature_hash) VALUES (%s, %s)',
+                           signatures[start:start + WRITE_BATCH_SIZE])
+    for batch in id_batches(removed):
+        cursor.execute(f"DELETE FROM Similarity_Signature WHERE content_id IN ({', '.join(['%s'] * len(batch))})",
+                       batch)
+    conn.commit()
+
+
+# Recomputes the similar titles of every title
+def rebuild_similar_titles(conn, cursor, k=TOP_K, block_size=SIMILARITY_BLOCK_SIZE):
+    start = time.perf_counter()
+    features = load_features(cursor)
+    cursor.execute('TRUNCATE TABLE Similar_Content')
+    cursor.execute('TRUNCATE TABLE Similarity_Signature')
+    conn.commit()
+    rows = np.arange(len(features.content_ids))
+    written = write_similar(conn, cursor, features, rows, k, block_size, replace=False)
+    write_signatures(conn, cursor, features, rows)
+    print(f"-->  {written} similar titles computed for {len(rows)} titles "
+          f"in {time.perf_counter() - start:.2f}s")
+    return {'titles': len(rows), 'rows': written}
+
+
+# Returns the rows whose similar titles may have changed since they were
+# computed: titles whose features changed or that are new, titles listing
+# a changed or deleted title, and titles a changed title now scores at
+# least as well with as their current k-th best. Returns them with the
+# changed rows and the deleted content_ids
+def affected_rows(cursor, features, k):
+    content_ids = features.content_ids
+    cursor.execute('SELECT content_id, feature_hash FROM Similarity_Signature ORDER BY content_id')
+    stored = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+    positions = np.searchsorted(stored[:, 0], content_ids)
+    known = positions < len(stored)
+    known[known] = stored[positions[known], 0] == content_ids[known]
+    unchanged = known.copy()
+    unchanged[known] = stored[positions[known], 1] == features.signatures[known]
+    changed = np.flatnonzero(~unchanged)
+    removed = np.setdiff1d(stored[:, 0], content_ids)
+
+    affected = [changed]
+    referrers = []
+    for batch in id_batches(np.concatenate([content_ids[changed], removed])):
+        cursor.execute(f"SELECT DISTINCT content_id FROM Similar_Content "
+                       f"WHERE similar_content_id IN ({', '.join(['%s'] * len(batch))})", batch)
+        referrers.extend(row[0] for row in cursor.fetchall())
+    referrers = np.asarray(referrers, dtype=np.int64)
+    affected.append(np.searchsorted(content_ids, referrers[np.isin(referrers, content_ids)]))
+
+    if len(changed):
+        cursor.execute('SELECT content_id, MIN(score), COUNT(*) FROM Similar_Content GROUP BY content_id')
+        lists = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 3)
+        lists = lists[np.isin(lists[:, 0], content_ids)]
+        threshold = np.zeros(len(content_ids))
+        full = lists[:, 2] >= k
+        threshold[np.searchsorted(content_ids, lists[full, 0].astype(np.int64))] = lists[full, 1]
+        best = (features.matrix @ features.matrix[changed].T).max(axis=1).toarray().ravel()
+        affected.append(np.flatnonzero((best > 0) & (best >= threshold)))
+    return np.unique(np.concatenate(affected)), changed, removed
+
+
+# Recomputes the similar titles that the bridge changes since the last run
+# can have affected. Feature weights are recomputed from the whole catalog
+# each time, but only the affected titles are rescored with them, so
+# rebuild after large catalog changes to rescore everything
+def refresh_similar_titles(conn, cursor, k=TOP_K, block_size=SIMILARITY_BLOCK_SIZE):
+    start = time.perf_counter()
+    features = load_features(cursor)
+    rows, changed, removed = affected_rows(cursor, features, k)
+    conn.commit()
+    if not len(rows) and not len(removed):
+        print("-->  Similar titles already up to date")
+        return {'titles': 0, 'rows': 0}
+    written = write_similar(conn, cursor, features, rows, k, block_size)
+    write_signatures(conn, cursor, features, changed, removed)
+    print(f"-->  {len(changed)} titles changed and {len(removed)} removed, {written} similar titles "
+          f"recomputed for {len(rows)} titles in {time.perf_counter() - start:.2f}s")
+    return {'titles': len(rows), 'rows': written}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Computes the similar titles of every title from shared '
+                                                 'genres, actors, and directors.')
+    parser.add_argument('command', choices=('refresh', 'rebuild'),
+                        help="'refresh' recomputes the titles affected by bridge changes since the last run, "
+                             "'rebuild' recomputes every title")
+    parser.add_argument('--top-k', type=int, default=TOP_K,
+                        help=f'similar titles kept per title (default: {TOP_K})')
+    parser.add_argument('--block-size', type=int, default=SIMILARITY_BLOCK_SIZE,
+                        help=f'titles scored per sparse product (default: {SIMILARITY_BLOCK_SIZE})')
+    args = parser.parse_args(argv)
+
+    update = rebuild_similar_titles if args.command == 'rebuild' else refresh_similar_titles
+    return 0 if with_db_connection(update)(args.top_k, args.block_size) is not None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
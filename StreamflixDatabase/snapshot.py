@@ -0,0 +1,253 @@
+'''
+   Streamflix Database Snapshots
+   Script: snapshot.py
+   Description: Exports every table of a generated Streamflix database to a
+                compressed Arrow file, with a manifest, and restores them
+                through the bulk loading path.
+   Authors: Ashley Davis
+'''
+
+import data_generation
+from data_generation import (TABLE_COLUMNS, BulkLoader, apply_deferred_constraints, initialize_database,
+                             parse_args, run_generation, with_db_connection)
+from schema import SCHEMA_FILE, column_types, defer_constraints, foreign_keys, primary_keys, read_schema
+from stage_scheduler import run_stages, stage_dependencies
+from partitions import FUTURE_MONTHS, PARTITIONED_TABLE, add_months, month_start, partition_table
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+import argparse, hashlib, json, os, time
+
+MANIFEST_FILE = 'manifest.json'
+SNAPSHOT_FORMAT = 1
+
+# Rows fetched from the server, and written to the file, per record batch
+EXPORT_BATCH_SIZE = 50000
+
+ARROW_TYPES = {
+    'INT': pa.int64(),
+    'BIGINT': pa.int64(),
+    'BOOLEAN': pa.int8(),
+    'FLOAT': pa.float32(),
+    'VARCHAR': pa.string(),
+    'LONGTEXT': pa.string(),
+    'ENUM': pa.string(),
+    'DATE': pa.date32(),
+    'DATETIME': pa.timestamp('us'),
+    'TIMESTAMP': pa.timestamp('us'),
+}
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as snapshot_file:
+        for block in iter(lambda: snapshot_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Columns of each table in the order they are exported and loaded: the
+# loader's order for generated tables, the schema's for the others
+def snapshot_columns(schema):
+    return {table: list(TABLE_COLUMNS.get(table, types)) for table, types in column_types(schema).items()}
+
+
+# Streams a table, in primary key order, into a zstd-compressed Arrow IPC
+# file, so its rows never all sit in memory. Returns the rows written
+@with_db_connection
+def export_table(conn, cursor, table, columns, types, key, path):
+    arrow_schema = pa.schema([(column, ARROW_TYPES[types[column]]) for column in columns])
+    options = pa.ipc.IpcWriteOptions(compression='zstd')
+    cursor.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {', '.join(key)}")
+
+    rows_written = 0
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, arrow_schema, options=options) as writer:
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), arrow_schema)]
+            writer.write_batch(pa.record_batch(arrays, schema=arrow_schema))
+            rows_written += len(rows)
+    return rows_written
+
+
+# Reads the seed, reference time, and settings of the generation run, if
+# the database records one
+@with_db_connection
+def read_generation_run(conn, cursor):
+    cursor.execute('SELECT seed, as_of, settings FROM Generation_Run WHERE run_id = 1')
+    run = cursor.fetchone()
+    if run is None:
+        return None
+    seed, as_of, settings = run
+    return {'seed': seed, 'as_of': as_of.isoformat(), 'settings': json.loads(settings)}
+
+
+def export_snapshot(directory):
+    schema = read_schema(SCHEMA_FILE)
+    columns = snapshot_columns(schema)
+    types = column_types(schema)
+    keys = primary_keys(schema)
+    os.makedirs(directory, exist_ok=True)
+
+    tables = {}
+    for table in columns:
+        start = time.perf_counter()
+        file_name = f'{table}.arrow'
+        path = os.path.join(directory, file_name)
+        rows = export_table(table, columns[table], types[table], keys[table], path)
+        if rows is None:
+            raise SystemExit(f"Could not export {table}")
+        tables[table] = {'file': file_name, 'rows': rows, 'columns': columns[table], 'sha256': file_sha256(path)}
+        print(f"-->  Exported {rows} {table} rows in {time.perf_counter() - start:.2f}s")
+
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'schema_sha256': hashlib.sha256(schema.encode()).hexdigest(),
+        'generation': read_generation_run(),
+        'tables': tables,
+    }
+    with open(os.path.join(directory, MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    print(f"-->  Snapshot written to {directory}")
+    return manifest
+
+
+# Loads one table from its snapshot file, a record batch at a time. Tables
+# the generator writes go through its BulkLoader, so they get the same
+# LOAD DATA path and fallback; the small metadata tables use executemany
+@with_db_connection
+def restore_table(conn, cursor, table, columns, path, loader_options):
+    reader = pa.ipc.open_file(pa.memory_map(path))
+    if table not in TABLE_COLUMNS:
+        statement = (f"INSERT INTO {table} ({', '.join(columns)}) "
+                     f"VALUES ({', '.join(['%s'] * len(columns))})")
+        rows = 0
+        for index in range(reader.num_record_batches):
+            batch = reader.get_batch(index)
+            if batch.num_rows:
+                cursor.executemany(statement, list(zip(*(column.to_pylist() for column in batch.columns))))
+                rows += batch.num_rows
+        return {'rows': rows}
+
+    loader = BulkLoader(conn, cursor, **loader_options)
+    for index in range(reader.num_record_batches):
+        batch = reader.get_batch(index)
+        if batch.num_rows:
+            loader.append_columns(table, [column.to_pylist() for column in batch.columns])
+    return loader.finish()
+
+
+# Returns the earliest and latest start_time in a User_Metrics snapshot
+# file, a record batch at a time, or None when it has no rows
+def start_time_range(path):
+    reader = pa.ipc.open_file(pa.memory_map(path))
+    first = last = None
+    for index in range(reader.num_record_batches):
+        bounds = pc.min_max(reader.get_batch(index).column('start_time')).as_py()
+        if bounds['min'] is not None:
+            first = bounds['min'] if first is None else min(first, bounds['min'])
+            last = bounds['max'] if last is None else max(last, bounds['max'])
+    return None if first is None else (first, last)
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST_FILE)) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest['format'] != SNAPSHOT_FORMAT:
+        raise SystemExit(f"Unsupported snapshot format {manifest['format']}")
+    return manifest
+
+
+# Recreates the database from a snapshot. By default the tables are created
+# bare and loaded concurrently with foreign key checks off, and the indexes
+# and foreign keys are added after the load. With the standard schema mode
+# each table waits for the tables it references
+def restore_snapshot(directory, loader='infile', schema_mode='bulk', jobs=4, verify=True):
+    manifest = read_manifest(directory)
+    schema = read_schema(SCHEMA_FILE)
+    if manifest['schema_sha256'] != hashlib.sha256(schema.encode()).hexdigest():
+        raise SystemExit(f"The snapshot in {directory} was taken with a different {SCHEMA_FILE}")
+
+    tables = manifest['tables']
+    columns = snapshot_columns(schema)
+    for table, entry in tables.items():
+        path = os.path.join(directory, entry['file'])
+        if entry['columns'] != columns.get(table):
+            raise SystemExit(f"The columns of {table} in the snapshot do not match the schema")
+        if verify and file_sha256(path) != entry['sha256']:
+            raise SystemExit(f"{path} does not match the checksum in the manifest")
+
+    start = time.perf_counter()
+    bulk_schema = schema_mode == 'bulk'
+    bare_schema, deferred = defer_constraints(schema)
+    initialize_database(bare_schema if bulk_schema else schema)
+    # SQLite has no partitioning, so the table is left whole there
+    if PARTITIONED_TABLE in tables and data_generation.BACKEND != 'sqlite':
+        bounds = start_time_range(os.path.join(directory, tables[PARTITIONED_TABLE]['file']))
+        first, last = bounds or (datetime.now(), datetime.now())
+        with_db_connection(partition_table)(first, add_months(month_start(last), FUTURE_MONTHS))
+
+    loader_options = {'mode': loader, 'deferred_checks': bulk_schema}
+    restores = {table: (lambda table=table: restore_table(table, tables[table]['columns'],
+                                                          os.path.join(directory, tables[table]['file']),
+                                                          loader_options))
+                for table in tables}
+    dependencies = stage_dependencies({table: {table} for table in tables},
+                                      {} if bulk_schema else foreign_keys(schema))
+    results, _ = run_stages(restores, dependencies, jobs)
+
+    failed = [table for table, stats in results.items() if stats is None]
+    if failed:
+        raise SystemExit(f"Could not restore {', '.join(failed)}")
+    for table, stats in results.items():
+        if stats['rows'] != tables[table]['rows']:
+            raise SystemExit(f"Restored {stats['rows']} {table} rows, the snapshot has {tables[table]['rows']}")
+    if bulk_schema:
+        apply_deferred_constraints(schema, deferred)
+
+    rows = sum(entry['rows'] for entry in tables.values())
+    print(f"-->  Restored {rows} rows from {directory} in {time.perf_counter() - start:.2f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Exports and restores Streamflix database snapshots.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    create = commands.add_parser('create', help='generate the data with a fixed seed, then export it. '
+                                                'Other options are passed on to data_generation.py')
+    create.add_argument('directory')
+    export = commands.add_parser('export', help='export the database as it is')
+    export.add_argument('directory')
+    restore = commands.add_parser('restore', help='recreate the database from a snapshot')
+    restore.add_argument('directory')
+    restore.add_argument('--loader', choices=('infile', 'bulk'), default='infile',
+                         help="'infile' loads each table with LOAD DATA LOCAL INFILE, falling back to "
+                              "batch inserts when the server does not allow it (default: infile)")
+    restore.add_argument('--schema-mode', choices=('bulk', 'standard'), default='bulk',
+                         help="'bulk' loads bare tables and adds the indexes and foreign keys afterwards "
+                              "(default: bulk)")
+    restore.add_argument('--jobs', type=int, default=4, help='tables loaded at the same time (default: 4)')
+    restore.add_argument('--no-verify', action='store_true', help='skip checking the file checksums')
+
+    args, generator_args = parser.parse_known_args(argv)
+    if args.command == 'create':
+        generator = parse_args(generator_args)
+        if generator.seed is None:
+            parser.error('create needs --seed, so that the snapshot can be reproduced')
+        _, stage_stats, _, _ = run_generation(generator)
+        if None in stage_stats.values():
+            raise SystemExit('Generation failed, no snapshot taken')
+        export_snapshot(args.directory)
+    elif generator_args:
+        parser.error(f"unrecognized arguments: {' '.join(generator_args)}")
+    elif args.command == 'export':
+        export_snapshot(args.directory)
+    else:
+        restore_snapshot(args.directory, args.loader, args.schema_mode, args.jobs, not args.no_verify)
+
+
+if __name__ == "__main__":
+    main()
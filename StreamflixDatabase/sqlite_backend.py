@@ -0,0 +1,473 @@
+'''
+   Streamflix Database SQLite Backend
+   Script: sqlite_backend.py
+   Description: An embedded SQLite database, in memory or in a file, behind
+                the connection pool interface of mysql.connector, so the
+                generation stages, checks, and tools run in-process without
+                a MySQL server.
+   Authors: Ashley Davis
+'''
+
+from schema import table_items
+from mysql.connector import errorcode, errors
+from datetime import date, datetime
+import re, sqlite3, threading
+
+DATABASE_NAME = 'Streamflix'
+
+# A random version 4 UUID, standing in for MySQL's UUID() column default
+UUID_EXPRESSION = ("lower(hex(randomblob(4))) || '-' || lower(hex(randomblob(2))) || '-4' || "
+                   "substr(lower(hex(randomblob(2))), 2) || '-' || substr('89ab', 1 + abs(random()) % 4, 1) || "
+                   "substr(lower(hex(randomblob(2))), 2) || '-' || lower(hex(randomblob(6)))")
+
+# The information_schema tables the tools read. They stay empty, as SQLite
+# has neither partitions nor FULLTEXT indexes, so partitions.py reports the
+# table as not partitioned and search.py uses its own index
+INFORMATION_SCHEMA = '''
+    CREATE TABLE information_schema.PARTITIONS (TABLE_SCHEMA TEXT, TABLE_NAME TEXT, PARTITION_NAME TEXT,
+                                                PARTITION_ORDINAL_POSITION INTEGER, TABLE_ROWS INTEGER);
+    CREATE TABLE information_schema.STATISTICS (TABLE_SCHEMA TEXT, TABLE_NAME TEXT, INDEX_NAME TEXT,
+                                                INDEX_TYPE TEXT, COLUMN_NAME TEXT);
+'''
+
+# Seconds per TIMESTAMPDIFF unit
+TIMESTAMPDIFF_UNITS = {'SECOND': 1, 'MINUTE': 60, 'HOUR': 3600, 'DAY': 86400, 'WEEK': 604800}
+
+COMMENTS = re.compile(r'/\*.*?\*/|--[^\n]*', re.DOTALL)
+CREATE_TABLE = re.compile(r'^CREATE\s+(TEMPORARY\s+)?TABLE\s+(IF NOT EXISTS\s+)?`?(\w+)`?\s*\((.*)\)$',
+                          re.DOTALL | re.IGNORECASE)
+ALTER_TABLE = re.compile(r'^ALTER\s+TABLE\s+`?(\w+)`?\s+(.*)$', re.DOTALL | re.IGNORECASE)
+AUTO_INCREMENT = re.compile(r'^(`?\w+`?)\s+(?:BIG)?INT(?:EGER)?\s+AUTO_INCREMENT(?:\s+PRIMARY\s+KEY)?',
+                            re.IGNORECASE)
+ENUM = re.compile(r'\bENUM\s*(\([^)]*\))', re.IGNORECASE)
+UUID_DEFAULT = re.compile(r'\bDEFAULT\s*\(\s*UUID\(\)\s*\)', re.IGNORECASE)
+ON_UPDATE_TIMESTAMP = re.compile(r'\s+ON\s+UPDATE\s+CURRENT_TIMESTAMP\b', re.IGNORECASE)
+INDEX_ITEM = re.compile(r'^(UNIQUE\s+|FULLTEXT\s+)?(?:INDEX|KEY)?\s*`?\w*`?\s*\(([^)]*)\)$', re.IGNORECASE)
+UPSERT = re.compile(r'\bON\s+DUPLICATE\s+KEY\s+UPDATE\b', re.IGNORECASE)
+TRAILING_ALIAS = re.compile(r'\bAS\s+(\w+)\s*$', re.IGNORECASE)
+DATETIME_TEXT = re.compile(r'^\d{4}-\d{2}-\d{2}(?: \d{2}:\d{2}:\d{2}(?:\.\d{1,6})?)?$')
+
+# MySQL spellings with a direct SQLite equivalent. Division is made real,
+# as MySQL's / never truncates to an integer
+REWRITES = [
+    (re.compile(r'^INSERT\s+IGNORE\b', re.IGNORECASE), 'INSERT OR IGNORE'),
+    (re.compile(r'^TRUNCATE\s+TABLE\b', re.IGNORECASE), 'DELETE FROM'),
+    (re.compile(r'\bGREATEST\(', re.IGNORECASE), 'MAX('),
+    (re.compile(r'\bLEAST\(', re.IGNORECASE), 'MIN('),
+    (re.compile(r'\bTIMESTAMPDIFF\(\s*(\w+)\s*,', re.IGNORECASE), r"timestampdiff('\1',"),
+    (re.compile(r'\bDATABASE\(\)', re.IGNORECASE), f"'{DATABASE_NAME}'"),
+    (re.compile(r'\s+FOR\s+UPDATE\s*$', re.IGNORECASE), ''),
+    (re.compile(r'\s/\s'), ' * 1.0 / '),
+]
+
+# {sqlite3 exception: mysql.connector exception}, so the callers' handling
+# of database errors is unchanged
+ERRORS = {
+    sqlite3.IntegrityError: errors.IntegrityError,
+    sqlite3.ProgrammingError: errors.ProgrammingError,
+    sqlite3.OperationalError: errors.OperationalError,
+    sqlite3.NotSupportedError: errors.NotSupportedError,
+}
+
+
+# Datetimes are stored as MySQL prints them, which is also the text
+# SQLite's own date functions read and write. Columns are read back by
+# their declared type, so a date stored in a DATETIME column comes back as
+# midnight of that day and a datetime in a DATE column as its day, as they
+# would from MySQL
+sqlite3.register_adapter(datetime, lambda value: value.strftime('%Y-%m-%d %H:%M:%S'))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter('DATE', lambda value: date.fromisoformat(value.decode()[:10]))
+
+
+def parse_datetime(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def timestampdiff(unit, start, end):
+    start, end = parse_datetime(start), parse_datetime(end)
+    if start is None or end is None:
+        return None
+    return int((end - start).total_seconds() / TIMESTAMPDIFF_UNITS[unit.upper()])
+
+
+# Expressions have no declared type, so dates and datetimes computed by a
+# query, such as MIN(start_time) or DATE(start_time), come back as text and
+# are recognized by their format
+def convert_value(value):
+    if isinstance(value, str) and DATETIME_TEXT.match(value):
+        return date.fromisoformat(value) if len(value) == 10 else datetime.fromisoformat(value)
+    return value
+
+
+def convert_row(row):
+    return None if row is None else tuple(convert_value(value) for value in row)
+
+
+# Splits a script into its statements, without comments or the semicolons
+def split_script(script):
+    return [statement.strip() for statement in COMMENTS.sub('', script).split(';') if statement.strip()]
+
+
+def unquote(name):
+    return name.strip().strip('`')
+
+
+# CREATE INDEX for an INDEX, KEY, or UNIQUE item of a table definition or
+# ALTER TABLE, or None for a FULLTEXT index
+def index_statement(table, item):
+    match = INDEX_ITEM.match(item.strip())
+    if match is None:
+        raise errors.NotSupportedError(msg=f"Unsupported index definition: {item}")
+    kind, columns = match.groups()
+    if kind and kind.strip().upper() == 'FULLTEXT':
+        return None
+    columns = [unquote(column) for column in columns.split(',')]
+    unique = 'UNIQUE ' if kind else ''
+    return (f"CREATE {unique}INDEX IF NOT EXISTS {table}_{'_'.join(columns)} "
+            f"ON {table} ({', '.join(columns)})")
+
+
+# Rewrites a MySQL column definition for SQLite. An AUTO_INCREMENT column
+# becomes the INTEGER PRIMARY KEY rowid alias, which numbers rows the same way
+def column_definition(item):
+    match = AUTO_INCREMENT.match(item)
+    if match:
+        item = f'{match.group(1)} INTEGER PRIMARY KEY{item[match.end():]}'
+    name = unquote(item.split(None, 1)[0])
+    item = ENUM.sub(lambda values: f'TEXT CHECK ({name} IN {values.group(1)})', item)
+    item = UUID_DEFAULT.sub(f'DEFAULT ({UUID_EXPRESSION})', item)
+    return ON_UPDATE_TIMESTAMP.sub('', item)
+
+
+# Translates a CREATE TABLE into the SQLite CREATE TABLE, its CREATE INDEX
+# statements, and a trigger for each ON UPDATE CURRENT_TIMESTAMP column.
+# FULLTEXT indexes are left out
+def translate_create_table(match):
+    temporary, if_not_exists, table, body = match.groups()
+    columns, indexes, triggers = [], [], []
+    row_id = None
+    for item in table_items(body):
+        upper = item.upper()
+        if upper.startswith(('INDEX', 'KEY', 'UNIQUE', 'FULLTEXT')):
+            indexes.append(index_statement(table, item))
+        elif upper.startswith('PRIMARY KEY'):
+            # The rowid alias is already the key. The partitioned
+            # User_Metrics key adds start_time to it, which a rowid makes
+            # unique on its own
+            key = table_items(item[item.index('(') + 1:item.rindex(')')])
+            if row_id is None or unquote(key[0]) != row_id:
+                columns.append(item)
+        elif upper.startswith(('FOREIGN KEY', 'CONSTRAINT', 'CHECK')):
+            columns.append(item)
+        else:
+            if AUTO_INCREMENT.match(item):
+                row_id = unquote(item.split(None, 1)[0])
+            if ON_UPDATE_TIMESTAMP.search(item):
+                column = unquote(item.split(None, 1)[0])
+                triggers.append(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_{column}_on_update AFTER UPDATE ON {table}
+                    FOR EACH ROW WHEN NEW.{column} IS OLD.{column}
+                    BEGIN UPDATE {table} SET {column} = CURRENT_TIMESTAMP WHERE rowid = NEW.rowid; END
+                ''')
+            columns.append(column_definition(item))
+    create = (f"CREATE {'TEMPORARY ' if temporary else ''}TABLE {if_not_exists or ''}{table} "
+              f"({', '.join(columns)})")
+    return [create] + [index for index in indexes if index] + triggers
+
+
+# Translates an ALTER TABLE. Indexes are created; FULLTEXT indexes and
+# partitioning have no SQLite equivalent and are skipped, as are foreign
+# keys, which SQLite only declares with the table. The bulk schema mode
+# still validates them with its orphan scan before this point
+def translate_alter_table(match):
+    table, changes = match.groups()
+    if re.match(r'(PARTITION\s+BY|REORGANIZE\s+PARTITION|DROP\s+PARTITION|REMOVE\s+PARTITIONING)\b',
+                changes, re.IGNORECASE):
+        return []
+    statements = []
+    for item in table_items(changes):
+        if not item.upper().startswith('ADD '):
+            raise errors.NotSupportedError(msg=f"Unsupported ALTER TABLE change: {item}")
+        item = item[4:].strip()
+        upper = item.upper()
+        if upper.startswith(('INDEX', 'KEY', 'UNIQUE', 'FULLTEXT')):
+            statements.append(index_statement(table, item))
+        elif not upper.startswith(('FOREIGN KEY', 'CONSTRAINT')):
+            item = re.sub(r'^COLUMN\s+', '', item, flags=re.IGNORECASE)
+            statements.append(f'ALTER TABLE {table} ADD COLUMN {column_definition(item)}')
+    return [statement for statement in statements if statement]
+
+
+# Rewrites ON DUPLICATE KEY UPDATE as an upsert. The row alias, or the
+# derived table alias of INSERT ... SELECT, becomes excluded, and the
+# SELECT gets a WHERE so its FROM clause doesn't swallow the ON CONFLICT
+def translate_upsert(statement):
+    insert, update = UPSERT.split(statement, 1)
+    update = re.sub(r'\bVALUES\((\w+)\)', r'excluded.\1', update, flags=re.IGNORECASE)
+    alias = TRAILING_ALIAS.search(insert)
+    selects = re.search(r'\bSELECT\b', insert, re.IGNORECASE) is not None
+    if alias:
+        update = re.sub(rf'\b{alias.group(1)}\.', 'excluded.', update)
+        if not selects:
+            insert = insert[:alias.start()]
+    return f"{insert.rstrip()}{' WHERE true' if selects else ''} ON CONFLICT DO UPDATE SET {update.strip()}"
+
+
+# Rewrites a data statement, and its %s parameter markers when it has
+# parameters, for SQLite
+def translate_statement(statement, parameterized):
+    if parameterized:
+        statement = statement.replace('%s', '?').replace('%%', '%')
+    if UPSERT.search(statement):
+        statement = translate_upsert(statement)
+    for pattern, replacement in REWRITES:
+        statement = pattern.sub(replacement, statement)
+    return statement
+
+
+def database_error(err):
+    return ERRORS.get(type(err), errors.DatabaseError)(msg=str(err))
+
+
+# The embedded database shared by every connection of a pool. SQLite
+# allows one writer at a time, so a connection owns the database from its
+# first statement until it commits, rolls back, or closes, which makes
+# every transaction serializable as it is under InnoDB's locking. Other
+# connections wait up to timeout seconds for it
+class SQLiteDatabase:
+    def __init__(self, path=':memory:', timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.released = threading.Condition()
+        self.owner = None
+        self.db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self.db.create_function('timestampdiff', 3, timestampdiff, deterministic=True)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.execute("ATTACH DATABASE ':memory:' AS information_schema")
+        self.db.executescript(INFORMATION_SCHEMA)
+        # A file left by an earlier run already holds the database
+        self.created = self.table_names() != []
+
+    def table_names(self, pattern='%'):
+        return [row[0] for row in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND name LIKE ? "
+            "ORDER BY name", (pattern,))]
+
+    # DROP DATABASE drops every table. Foreign keys are switched off for it,
+    # which SQLite only allows outside a transaction
+    def drop(self):
+        self.db.commit()
+        self.db.execute('PRAGMA foreign_keys = OFF')
+        try:
+            for table in self.table_names():
+                self.db.execute(f'DROP TABLE {table}')
+            self.db.commit()
+        finally:
+            self.db.execute('PRAGMA foreign_keys = ON')
+        self.created = False
+
+
+# Stands in for MySQLConnectionPool: every connection it hands out shares
+# the one embedded database
+class SQLitePool:
+    def __init__(self, path=':memory:', timeout=30):
+        self.database = SQLiteDatabase(path, timeout)
+
+    def get_connection(self):
+        return SQLiteConnection(self.database)
+
+    # The database is always selected
+    def set_config(self, **config):
+        pass
+
+
+class SQLiteConnection:
+    def __init__(self, database):
+        self.database = database
+        self.thread = None
+        self.connected = True
+        self.statements = 0
+
+    def cursor(self, *args, **kwargs):
+        return SQLiteCursor(self)
+
+    # Takes ownership of the database for the transaction. Another
+    # connection's transaction on the same thread could never end while
+    # this one waits, and under MySQL it would not see this one's writes,
+    # so it is refused rather than shared
+    def begin(self):
+        database = self.database
+        with database.released:
+            if database.owner is not self:
+                thread = threading.get_ident()
+                if database.owner is not None and database.owner.thread == thread:
+                    raise errors.InternalError(msg='Another connection on this thread has a transaction open '
+                                                   'on the SQLite database')
+                if not database.released.wait_for(lambda: database.owner is None, database.timeout):
+                    raise errors.DatabaseError(msg=f'Waited {database.timeout:g}s for another connection '
+                                                   f'to finish its transaction',
+                                               errno=errorcode.ER_LOCK_WAIT_TIMEOUT)
+                database.owner = self
+                self.thread = thread
+        self.statements += 1
+
+    def end(self, finish):
+        database = self.database
+        if database.owner is not self:
+            return
+        try:
+            finish()
+        except sqlite3.Error as err:
+            raise database_error(err) from err
+        finally:
+            with database.released:
+                database.owner = None
+                self.thread = None
+                database.released.notify_all()
+
+    def commit(self):
+        self.end(self.database.db.commit)
+
+    def rollback(self):
+        self.end(self.database.db.rollback)
+
+    # Like a pooled MySQL connection returned to its pool, closing ends the
+    # open transaction without committing it
+    def close(self):
+        self.rollback()
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+
+# Runs MySQL statements on the embedded database: data statements are
+# rewritten for SQLite, DDL is translated from the MySQL schema, and the
+# administrative statements the tools issue are answered here
+class SQLiteCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.database = connection.database
+        self.cursor = None
+        self.rows = None
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    @property
+    def column_names(self):
+        return tuple(column[0] for column in self.description or ())
+
+    @property
+    def with_rows(self):
+        return self.description is not None
+
+    def execute(self, operation, params=None, multi=False):
+        self.connection.begin()
+        if multi:
+            for statement in split_script(operation):
+                self.run(statement, ())
+            return iter(())
+        self.run(operation.strip().rstrip(';').strip(), params)
+
+    def executemany(self, operation, seq_params):
+        self.connection.begin()
+        statement = translate_statement(operation.strip().rstrip(';'), True)
+        self.rows = None
+        try:
+            self.cursor = self.database.db.executemany(statement, seq_params)
+        except sqlite3.Error as err:
+            raise database_error(err) from err
+        self.description = None
+        self.rowcount = self.cursor.rowcount
+        self.lastrowid = self.cursor.lastrowid
+
+    def respond(self, columns, rows):
+        self.cursor = None
+        self.rows = list(rows)
+        self.description = [(column,) + (None,) * 6 for column in columns] if columns else None
+        self.rowcount = len(self.rows)
+
+    def run(self, statement, params):
+        words = statement.split()
+        keyword = ' '.join(words[:3]).upper()
+        if keyword.startswith('SHOW DATABASES'):
+            return self.respond(['Database'], [(DATABASE_NAME,)] if self.database.created else [])
+        if keyword.startswith('SHOW TABLES'):
+            pattern = re.search(r"LIKE\s+'([^']*)'", statement, re.IGNORECASE)
+            return self.respond(['Tables_in_Streamflix'],
+                                [(name,) for name in self.database.table_names(pattern.group(1) if pattern else '%')])
+        if keyword.startswith('SHOW SESSION STATUS'):
+            return self.respond(['Variable_name', 'Value'], [('Questions', str(self.connection.statements))])
+        if keyword.startswith('CREATE DATABASE'):
+            self.database.created = True
+            return self.respond(None, [])
+        if keyword.startswith('DROP DATABASE'):
+            self.database.drop()
+            return self.respond(None, [])
+        if keyword.startswith('USE '):
+            return self.respond(None, [])
+        if keyword.startswith('SET '):
+            return self.set_session(statement)
+        if keyword.startswith('LOAD DATA'):
+            raise errors.DatabaseError(msg='LOAD DATA is not supported by the SQLite backend',
+                                       errno=errorcode.ER_CLIENT_LOCAL_FILES_DISABLED)
+        if keyword.startswith('DROP TEMPORARY TABLE'):
+            tables = statement.split(None, 3)[3]
+            return self.run_all([f'DROP TABLE {table.strip()}' for table in tables.split(',')], ())
+
+        match = CREATE_TABLE.match(statement)
+        if match:
+            return self.run_all(translate_create_table(match), ())
+        match = ALTER_TABLE.match(statement)
+        if match:
+            return self.run_all(translate_alter_table(match), ())
+        return self.run_all([translate_statement(statement, params is not None)], params or ())
+
+    def run_all(self, statements, params):
+        self.rows = None
+        self.description = None
+        try:
+            for statement in statements:
+                self.cursor = self.database.db.execute(statement, params)
+        except sqlite3.Error as err:
+            raise database_error(err) from err
+        if self.cursor is not None:
+            self.description = self.cursor.description
+            self.rowcount = self.cursor.rowcount
+            self.lastrowid = self.cursor.lastrowid
+
+    # Session settings have no SQLite counterpart apart from the foreign
+    # key checks, which apply to the whole database
+    def set_session(self, statement):
+        match = re.search(r'\bforeign_key_checks\s*=\s*(\d)', statement, re.IGNORECASE)
+        if match:
+            self.database.db.execute(f"PRAGMA foreign_keys = {'ON' if match.group(1) == '1' else 'OFF'}")
+        return self.respond(None, [])
+
+    def fetchone(self):
+        if self.rows is not None:
+            return self.rows.pop(0) if self.rows else None
+        return convert_row(self.cursor.fetchone()) if self.cursor is not None else None
+
+    def fetchmany(self, size=1):
+        if self.rows is not None:
+            rows, self.rows = self.rows[:size], self.rows[size:]
+            return rows
+        return [convert_row(row) for row in self.cursor.fetchmany(size)] if self.cursor is not None else []
+
+    def fetchall(self):
+        if self.rows is not None:
+            rows, self.rows = self.rows, []
+            return rows
+        return [convert_row(row) for row in self.cursor.fetchall()] if self.cursor is not None else []
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self.cursor = None
+        self.rows = None
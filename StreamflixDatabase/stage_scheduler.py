@@ -0,0 +1,110 @@
+'''
+   Streamflix Database Stage Scheduler
+   Script: stage_scheduler.py
+   Description: Runs the data generation stages concurrently, in an order
+                derived from the foreign keys in the schema.
+   Authors: Ashley Davis
+'''
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import time
+
+
+# A stage depends on an earlier stage when it writes a table with a foreign
+# key to a table the earlier stage writes, or when both write the same
+# table, since their client-assigned IDs and name caches would collide
+def stage_dependencies(stage_tables, foreign_keys):
+    dependencies = {}
+    earlier_stages = []
+    for stage, tables in stage_tables.items():
+        referenced = set().union(*(foreign_keys.get(table, set()) for table in tables))
+        dependencies[stage] = {earlier for earlier in earlier_stages
+                               if stage_tables[earlier] & (tables | referenced)}
+        earlier_stages.append(stage)
+    return dependencies
+
+
+# Runs each stage once all of its dependencies have finished, with at most
+# concurrency stages at a time. Ready stages start in the order they are
+# listed, so a concurrency of 1 runs them in that order. A stage that raises
+# or returns None counts as failed, and the stages depending on it are
+# skipped. Returns {stage: result} and {stage: (start, end)} wall times
+def run_stages(stages, dependencies, concurrency=1):
+    results = {}
+    timings = {}
+    failed = set()
+    waiting = list(stages)
+    running = {}
+
+    def timed(stage):
+        start = time.perf_counter()
+        try:
+            return stages[stage]()
+        finally:
+            timings[stage] = (start, time.perf_counter())
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while waiting or running:
+            for stage in list(waiting):
+                if dependencies[stage] & failed:
+                    waiting.remove(stage)
+                    failed.add(stage)
+                    results[stage] = None
+                    print(f"-->  Skipping {stage}: a stage it depends on failed")
+                elif len(running) < concurrency and dependencies[stage] <= results.keys():
+                    waiting.remove(stage)
+                    running[executor.submit(timed, stage)] = stage
+
+            if not running:
+                if waiting:
+                    raise RuntimeError(f"Unsatisfiable stage dependencies: {', '.join(waiting)}")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage] = future.result()
+                except Exception as err:
+                    print(f"-->  Stage {stage} failed: {err!r}")
+                    results[stage] = None
+                if results[stage] is None:
+                    failed.add(stage)
+
+    return results, timings
+
+
+# Returns the chain of dependent stages with the largest total wall time
+def critical_path(dependencies, durations):
+    longest = {}
+    previous = {}
+    for stage in dependencies:
+        before = max((dep for dep in dependencies[stage] if dep in longest),
+                     key=longest.get, default=None)
+        longest[stage] = durations.get(stage, 0.0) + (longest[before] if before else 0.0)
+        previous[stage] = before
+
+    stage = max(longest, key=longest.get, default=None)
+    path = []
+    while stage is not None:
+        path.append(stage)
+        stage = previous[stage]
+    return path[::-1], (longest[path[0]] if path else 0.0)
+
+
+def print_schedule_report(dependencies, timings):
+    if not timings:
+        return
+    run_start = min(start for start, _ in timings.values())
+    durations = {stage: end - start for stage, (start, end) in timings.items()}
+
+    print('\n-->  Stage wall times')
+    for stage in dependencies:
+        if stage in timings:
+            start, end = timings[stage]
+            after = ', '.join(sorted(dependencies[stage])) or '-'
+            print(f"     {stage:<14} {durations[stage]:>9.2f}s   "
+                  f"(started at {start - run_start:.2f}s, after: {after})")
+
+    path, length = critical_path(dependencies, durations)
+    total = max(end for _, end in timings.values()) - run_start
+    print(f"     critical path: {' -> '.join(path)} ({length:.2f}s of {total:.2f}s total)")
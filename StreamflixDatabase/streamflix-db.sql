@@ -31,7 +31,8 @@ CREATE TABLE IF NOT EXISTS `Genre`
 (
     genre_id INT AUTO_INCREMENT,
     name VARCHAR(30) NOT NULL,
-    PRIMARY KEY (genre_id)
+    PRIMARY KEY (genre_id),
+    INDEX(name)
 );
 
 
@@ -53,6 +54,7 @@ CREATE TABLE IF NOT EXISTS `Device`
     ip_address VARCHAR(18),
     user_id INT NOT NULL,
     PRIMARY KEY (device_id),
+    INDEX(user_id),
     FOREIGN KEY (user_id) REFERENCES `User`(user_id)
         ON DELETE CASCADE
         ON UPDATE CASCADE
@@ -69,7 +71,8 @@ CREATE TABLE IF NOT EXISTS `Video_Content`
     release_year varchar(4),
     language VARCHAR(100),
     PRIMARY KEY (content_id),
-    INDEX(title)
+    INDEX(title),
+    FULLTEXT INDEX(title, description)
 );
 
 
@@ -128,7 +131,8 @@ CREATE TABLE IF NOT EXISTS `Actor`
     gender VARCHAR(10),
     biography LONGTEXT,
     content_id INT,
-    PRIMARY KEY (actor_id)
+    PRIMARY KEY (actor_id),
+    INDEX(name)
 );
 
 
@@ -139,7 +143,8 @@ CREATE TABLE IF NOT EXISTS `Director`
     date_of_birth DATE NOT NULL,
     biography LONGTEXT NOT NULL,
     content_id INT,
-    PRIMARY KEY (director_id)
+    PRIMARY KEY (director_id),
+    INDEX(name)
 );
 
 
@@ -151,6 +156,7 @@ CREATE TABLE IF NOT EXISTS `Review`
     stars INT NOT NULL CHECK (stars BETWEEN 1 AND 5),
     user_id INT,
     PRIMARY KEY (review_id),
+    INDEX(user_id),
     FOREIGN KEY (user_id) REFERENCES `User`(user_id)
         ON DELETE CASCADE
         ON UPDATE CASCADE
@@ -176,6 +182,7 @@ CREATE TABLE IF NOT EXISTS `Content_Genre`
     content_id INT,
     genre_id INT,
     PRIMARY KEY (content_id, genre_id),
+    INDEX(genre_id, content_id),
     FOREIGN KEY (content_id) REFERENCES `Video_Content`(content_id)
         ON DELETE CASCADE
         ON UPDATE CASCADE,
@@ -190,6 +197,7 @@ CREATE TABLE IF NOT EXISTS `Content_Actor`
     content_id INT,
     actor_id INT,
     PRIMARY KEY (content_id, actor_id),
+    INDEX(actor_id, content_id),
     FOREIGN KEY (content_id) REFERENCES `Video_Content`(content_id)
         ON DELETE CASCADE
         ON UPDATE CASCADE,
@@ -204,6 +212,7 @@ CREATE TABLE IF NOT EXISTS `Content_Director`
     content_id INT,
     director_id INT,
     PRIMARY KEY (content_id, director_id),
+    INDEX(director_id, content_id),
      FOREIGN KEY (content_id) REFERENCES `Video_Content`(content_id)
         ON DELETE CASCADE
         ON UPDATE CASCADE,
@@ -213,6 +222,10 @@ CREATE TABLE IF NOT EXISTS `Content_Director`
 );
 
 
+-- Partitioned by month on start_time once created (see partitions.py). A
+-- partitioned table's primary key has to include start_time, and it cannot
+-- have foreign keys: its references to Video_Content and User are listed in
+-- schema.py instead
 CREATE TABLE IF NOT EXISTS `User_Metrics` (
     metric_id INT AUTO_INCREMENT,
     start_time TIMESTAMP NOT NULL,
@@ -221,13 +234,10 @@ CREATE TABLE IF NOT EXISTS `User_Metrics` (
     completed BOOLEAN DEFAULT FALSE,
     content_id INT,
     user_id INT,
-    PRIMARY KEY (metric_id),
-    FOREIGN KEY (content_id) REFERENCES `Video_Content` (content_id)
-        ON DELETE CASCADE
-        ON UPDATE CASCADE,
-    FOREIGN KEY (user_id) REFERENCES `User` (user_id)
-        ON DELETE CASCADE
-        ON UPDATE CASCADE
+    PRIMARY KEY (metric_id, start_time),
+    INDEX(start_time),
+    INDEX(user_id, start_time),
+    INDEX(content_id)
 );
 
 
@@ -254,4 +264,140 @@ CREATE TABLE IF NOT EXISTS `Listed_Content`
     FOREIGN KEY (content_id) REFERENCES `Video_Content`(content_id)
         ON DELETE CASCADE
         ON UPDATE CASCADE
-);
\ No newline at end of file
+);
+
+
+/*******************************************************************************
+   Aggregates
+********************************************************************************/
+CREATE TABLE IF NOT EXISTS `Content_Stats`
+(
+    content_id INT,
+    review_count INT NOT NULL DEFAULT 0,
+    star_total BIGINT NOT NULL DEFAULT 0,
+    watch_count INT NOT NULL DEFAULT 0,
+    watch_seconds BIGINT NOT NULL DEFAULT 0,
+    completed_count INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (content_id),
+    INDEX(watch_count),
+    FOREIGN KEY (content_id) REFERENCES `Video_Content`(content_id)
+        ON DELETE CASCADE
+        ON UPDATE CASCADE
+);
+
+
+CREATE TABLE IF NOT EXISTS `User_Stats`
+(
+    user_id INT,
+    review_count INT NOT NULL DEFAULT 0,
+    star_total BIGINT NOT NULL DEFAULT 0,
+    watch_count INT NOT NULL DEFAULT 0,
+    watch_seconds BIGINT NOT NULL DEFAULT 0,
+    completed_count INT NOT NULL DEFAULT 0,
+    last_watched TIMESTAMP NULL,
+    PRIMARY KEY (user_id),
+    FOREIGN KEY (user_id) REFERENCES `User`(user_id)
+        ON DELETE CASCADE
+        ON UPDATE CASCADE
+);
+
+
+CREATE TABLE IF NOT EXISTS `Aggregate_Watermark`
+(
+    source VARCHAR(30),
+    last_id INT NOT NULL,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (source)
+);
+
+
+/*******************************************************************************
+   Daily Rollups
+********************************************************************************/
+CREATE TABLE IF NOT EXISTS `Daily_User_Activity`
+(
+    user_id INT,
+    activity_date DATE,
+    sessions INT NOT NULL,
+    watch_seconds BIGINT NOT NULL,
+    completed_sessions INT NOT NULL,
+    distinct_titles INT NOT NULL,
+    PRIMARY KEY (user_id, activity_date),
+    INDEX(activity_date),
+    FOREIGN KEY (user_id) REFERENCES `User`(user_id)
+        ON DELETE CASCADE
+        ON UPDATE CASCADE
+);
+
+
+CREATE TABLE IF NOT EXISTS `Daily_Content_Activity`
+(
+    content_id INT,
+    activity_date DATE,
+    sessions INT NOT NULL,
+    watch_seconds BIGINT NOT NULL,
+    completed_sessions INT NOT NULL,
+    distinct_viewers INT NOT NULL,
+    PRIMARY KEY (content_id, activity_date),
+    INDEX(activity_date),
+    FOREIGN KEY (content_id) REFERENCES `Video_Content`(content_id)
+        ON DELETE CASCADE
+        ON UPDATE CASCADE
+);
+
+
+/*******************************************************************************
+   Similar Titles
+********************************************************************************/
+-- similar_content_id has no foreign key, so rows naming a deleted title
+-- stay behind for similarity.py to find and recompute
+CREATE TABLE IF NOT EXISTS `Similar_Content`
+(
+    content_id INT,
+    similar_rank INT,
+    similar_content_id INT NOT NULL,
+    score FLOAT NOT NULL,
+    PRIMARY KEY (content_id, similar_rank),
+    INDEX(similar_content_id),
+    FOREIGN KEY (content_id) REFERENCES `Video_Content`(content_id)
+        ON DELETE CASCADE
+        ON UPDATE CASCADE
+);
+
+
+-- A digest of each title's genres, actors, and directors when its similar
+-- titles were last computed. It has no foreign key, so a deleted title's
+-- digest outlives it and similarity.py can tell that it went away
+CREATE TABLE IF NOT EXISTS `Similarity_Signature`
+(
+    content_id INT,
+    feature_hash BIGINT NOT NULL,
+    PRIMARY KEY (content_id)
+);
+
+
+/*******************************************************************************
+   Generation Metadata
+********************************************************************************/
+CREATE TABLE IF NOT EXISTS `Generation_Run`
+(
+    run_id INT,
+    seed BIGINT NOT NULL,
+    as_of DATETIME NOT NULL,
+    settings LONGTEXT NOT NULL,
+    started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (run_id)
+);
+
+
+CREATE TABLE IF NOT EXISTS `Generation_Checkpoint`
+(
+    stage VARCHAR(30),
+    next_chunk INT NOT NULL,
+    id_marks LONGTEXT NOT NULL,
+    rows_written BIGINT NOT NULL,
+    commits INT NOT NULL,
+    finished BOOLEAN DEFAULT FALSE,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (stage)
+);